@@ -0,0 +1,196 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Device control benchmarks
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+
+Measures control transfer count and wall time of the device control operations on the simulated device.
+    python benchmarks/benchM026.py --output results.json
+    python benchmarks/benchM026.py --baseline results.json
+Exits with status 1 if a benchmark regressed against the baseline.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+from m026Device import *
+from m026Simulator import *
+from tvChannels import frequencyDict
+
+#===============================================================================
+
+class Benchmarks(object):
+    """Device control benchmarks on a simulated device."""
+
+    def __init__(self,args):
+        self.args=args
+        self.lockFrequencies=list(frequencyDict.values())[::args.lock_every]
+        self.results={}
+
+    def device(self):
+        return SimulatedDevice(lockFrequencies=self.lockFrequencies,tunerSettleTime=self.args.settle,
+                               sbiWriteDelay=self.args.sbi_delay,sbiReadDelay=self.args.sbi_delay,
+                               transferLatency=self.args.latency)
+
+    def open(self,video_source=None):
+        """Return a found and opened M026Device on a new simulated device, with video_source set."""
+        dev=self.device()
+        m026=M026Device()
+        m026.usbContext=SimulatedContext(dev)
+        m026.find()
+        m026.open()
+        m026.shadow_enable(True)
+        m026.tunerSettleMax=self.args.settle_max
+        m026.vdVideoStandardTv=VIDEO_STANDARD_PAL_B_G_H_I_N
+        m026.vdVideoStandardComposite=VIDEO_STANDARD_PAL_B_G_H_I_N
+        m026.tvTunerFrequency=self.lockFrequencies[0]
+        if video_source is not None :
+            m026.set_video_source(video_source)
+        return m026,dev
+
+    def measure(self,name,setup,operation):
+        """Run operation(m026) repeat times, each after setup() returned a fresh (m026,dev)."""
+        times=[]
+        transfers=0
+        extra={}
+        for i in range(self.args.repeat) :
+            m026,dev=setup()
+            n0=dev.writes+dev.reads
+            t0=time.perf_counter()
+            r=operation(m026)
+            times.append(time.perf_counter()-t0)
+            transfers=dev.writes+dev.reads-n0
+            if isinstance(r,dict) :
+                extra=r
+        result={"transfers":transfers,"time":min(times),"mean":sum(times)/len(times)}
+        result.update(extra)
+        self.results[name]=result
+
+    def run(self):
+        only=self.args.only
+        benchmarks=[
+            ("set_video_source_tv",self.open,lambda m: m.set_video_source(VIDEO_SOURCE_TV)),
+            ("set_video_source_composite",self.open,lambda m: m.set_video_source(VIDEO_SOURCE_COMPOSITE)),
+            ("set_video_source_s_video",self.open,lambda m: m.set_video_source(VIDEO_SOURCE_S_VIDEO)),
+            ("switch_differential",lambda: self.open(VIDEO_SOURCE_TV),self.switch_differential),
+            ("set_tv_tuner_vhf_l",lambda: self.open(VIDEO_SOURCE_TV),lambda m: m.set_tv_tuner(self.band_frequency(0x01))),
+            ("set_tv_tuner_vhf_h",lambda: self.open(VIDEO_SOURCE_TV),lambda m: m.set_tv_tuner(self.band_frequency(0x02))),
+            ("set_tv_tuner_uhf",lambda: self.open(VIDEO_SOURCE_TV),lambda m: m.set_tv_tuner(self.band_frequency(0x08))),
+            ("vdi_set_capture_frame",lambda: self.open(VIDEO_SOURCE_TV),lambda m: m.vdi_set_capture_frame(Frame(Position(20,10),Position(1420,298)))),
+            ("get_video_capture",lambda: self.open(VIDEO_SOURCE_TV),lambda m: m.get_video_capture()),
+            ("pal_sweep",lambda: self.open(VIDEO_SOURCE_TV),self.pal_sweep),
+        ]
+        if not only or "find_open" in only :
+            self.measure_find_open()
+        for name,setup,operation in benchmarks :
+            if only and name not in only :
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.measure(name,setup,operation)
+
+    def band_frequency(self,bb):
+        """Return a lock frequency of a tuner band."""
+        m026=M026Device()
+        for f in self.lockFrequencies :
+            if m026.tv_tuner_select_band(f) == bb :
+                return f
+        return self.lockFrequencies[0]
+
+    def measure_find_open(self):
+        """find and open do no control transfers, only the time is measured."""
+        times=[]
+        for i in range(self.args.repeat) :
+            m026=M026Device()
+            m026.usbContext=SimulatedContext(self.device())
+            t0=time.perf_counter()
+            m026.find()
+            m026.open()
+            times.append(time.perf_counter()-t0)
+        self.results["find_open"]={"transfers":0,"time":min(times),"mean":sum(times)/len(times)}
+
+    def switch_differential(self,m026):
+        m026.differentialSwitching=True
+        m026.set_video_source(VIDEO_SOURCE_COMPOSITE)
+        m026.set_video_source(VIDEO_SOURCE_TV)
+
+    def pal_sweep(self,m026):
+        """Tune every frequency of frequencyDict and detect video, as the channel scanner does."""
+        detected=0
+        for name in frequencyDict :
+            m026.set_tv_tuner(frequencyDict[name])
+            if m026.vdVideoDetected :
+                detected+=1
+        return {"channels":len(frequencyDict),"detected":detected}
+
+    def config(self):
+        return {"latency":self.args.latency,"sbi_delay":self.args.sbi_delay,"settle":self.args.settle,
+                "settle_max":self.args.settle_max,"lock_every":self.args.lock_every,"repeat":self.args.repeat}
+
+    def compare(self,baseline):
+        """Print the results against a baseline, return the names of the regressed benchmarks."""
+        regressed=[]
+        tolerance=self.args.tolerance
+        print("{n:<28} {t:>10} {bt:>10} {r:>7} {x:>8} {bx:>8}".format(n="benchmark",t="time ms",bt="base ms",r="ratio",x="xfers",bx="base"))
+        for name,result in self.results.items() :
+            base=baseline.get("results",{}).get(name)
+            if base is None :
+                print("{n:<28} {t:>10.3f} {b:>10}".format(n=name,t=1000*result["time"],b="-"))
+                continue
+            ratio=result["time"]/base["time"] if base["time"] else 1.0
+            worse=result["time"] > base["time"]*(1+tolerance)+self.args.slack or result["transfers"] > base["transfers"]
+            if worse :
+                regressed.append(name)
+            print("{n:<28} {t:>10.3f} {bt:>10.3f} {r:>7.2f} {x:>8} {bx:>8}{w}".format(n=name,t=1000*result["time"],bt=1000*base["time"],
+                  r=ratio,x=result["transfers"],bx=base["transfers"],w="  REGRESSED" if worse else ""))
+        return regressed
+
+    def print(self):
+        print("{n:<28} {t:>10} {m:>10} {x:>8}".format(n="benchmark",t="time ms",m="mean ms",x="xfers"))
+        for name,result in self.results.items() :
+            print("{n:<28} {t:>10.3f} {m:>10.3f} {x:>8}".format(n=name,t=1000*result["time"],m=1000*result["mean"],x=result["transfers"]))
+
+#===============================================================================
+
+def main():
+    parser=argparse.ArgumentParser(description="Device control benchmarks on the simulated device")
+    parser.add_argument("--latency",type=float,default=0.000125,help="control transfer latency in seconds")
+    parser.add_argument("--sbi-delay",type=float,default=0.0003,help="serial bus transfer time in seconds")
+    parser.add_argument("--settle",type=float,default=0.15,help="tuner settle time in seconds")
+    parser.add_argument("--settle-max",type=float,default=0.5,help="maximum tuner settle time (M026Device.tunerSettleMax)")
+    parser.add_argument("--lock-every",type=int,default=5,help="every nth frequency of frequencyDict has a signal")
+    parser.add_argument("--repeat",type=int,default=3)
+    parser.add_argument("--only",nargs="*",help="benchmarks to run")
+    parser.add_argument("--output",help="write results as JSON")
+    parser.add_argument("--baseline",help="compare with results of an earlier run")
+    parser.add_argument("--tolerance",type=float,default=0.10,help="allowed relative time increase against the baseline")
+    parser.add_argument("--slack",type=float,default=0.002,help="allowed absolute time increase in seconds against the baseline")
+    args=parser.parse_args()
+
+    benchmarks=Benchmarks(args)
+    benchmarks.run()
+    results={"time":time.time(),"config":benchmarks.config(),"results":benchmarks.results}
+    if args.output :
+        with open(args.output,"w") as f:
+            json.dump(results,f,indent=2)
+    if args.baseline :
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        regressed=benchmarks.compare(baseline)
+        if regressed :
+            print("Regressed:",", ".join(regressed))
+            sys.exit(1)
+    else :
+        benchmarks.print()
+
+if __name__ == "__main__":
+    main()
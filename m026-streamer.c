@@ -15,6 +15,7 @@
 #include <signal.h>
 #include <errno.h>
 #include <stdbool.h>
+#include <string.h>
 #include <fcntl.h>
 #include <sys/ioctl.h>
 #include <assert.h>
@@ -44,6 +45,11 @@ unsigned char ctrl_rx(int index){
 }
 
 static char v4l2_device[16];
+
+// Device selection: -1 / empty matches any device
+static int usb_bus = -1;
+static char usb_port[64] = "";
+static char usb_serial[128] = "";
 int dev_fd;
 
 char isobuf0[64 * 3072];
@@ -289,6 +295,49 @@ void getData_M026(struct libusb_transfer *trf){
     iTransfer++;
 }
 
+// Open the first device matching the bus number, the port path (e.g. "1.4") and the serial number
+struct libusb_device_handle *openDevice(libusb_context *ctx){
+    libusb_device **list;
+    struct libusb_device_handle *h = NULL;
+    ssize_t n = libusb_get_device_list(ctx, &list);
+    if (n < 0)
+        return NULL;
+    for (ssize_t i = 0; i < n && h == NULL; i++) {
+        libusb_device *d = list[i];
+        struct libusb_device_descriptor desc;
+        if (libusb_get_device_descriptor(d, &desc) != 0)
+            continue;
+        if (desc.idVendor != VENDOR_ID || desc.idProduct != PRODUCT_ID)
+            continue;
+        if (usb_bus >= 0 && libusb_get_bus_number(d) != usb_bus)
+            continue;
+        if (usb_port[0]) {
+            uint8_t ports[8];
+            char path[64] = "";
+            int np = libusb_get_port_numbers(d, ports, sizeof(ports));
+            for (int j = 0; j < np; j++)
+                sprintf(path + strlen(path), j ? ".%d" : "%d", ports[j]);
+            if (strcmp(path, usb_port) != 0)
+                continue;
+        }
+        struct libusb_device_handle *dh;
+        if (libusb_open(d, &dh) != 0)
+            continue;
+        if (usb_serial[0]) {
+            unsigned char serial[128] = "";
+            if (desc.iSerialNumber == 0 ||
+                libusb_get_string_descriptor_ascii(dh, desc.iSerialNumber, serial, sizeof(serial)) < 0 ||
+                strcmp((char *)serial, usb_serial) != 0) {
+                libusb_close(dh);
+                continue;
+            }
+        }
+        h = dh;
+    }
+    libusb_free_device_list(list, 1);
+    return h;
+}
+
 void signalHandler(int signal){
     fprintf(stderr, "\n* --> Signal: %d\n",signal);
     if (signal == SIGINT || signal == SIGTERM || signal == SIGQUIT || signal == SIGTSTP) 
@@ -310,7 +359,7 @@ int main (int argc, char **argv) {
     sprintf(v4l2_device,"%s","/dev/video0");
     printf("* <----------------\n* Streamer started!\n");
     int opt;
-    while((opt = getopt(argc, argv, ":id:w:h:v")) != -1)
+    while((opt = getopt(argc, argv, ":id:w:h:vb:p:s:")) != -1)
     {
         switch(opt)
         {
@@ -329,6 +378,18 @@ int main (int argc, char **argv) {
             case 'v' :
                 verbose = true;
                 break;
+            case 'b' :
+                usb_bus = atoi(optarg);
+                fprintf(stderr, "*  - USB bus: %d\n", usb_bus);
+                break;
+            case 'p' :
+                snprintf(usb_port, sizeof(usb_port), "%s", optarg);
+                fprintf(stderr, "*  - USB port: %s\n", usb_port);
+                break;
+            case 's' :
+                snprintf(usb_serial, sizeof(usb_serial), "%s", optarg);
+                fprintf(stderr, "*  - USB serial number: %s\n", usb_serial);
+                break;
             case '?' :
                 fprintf(stderr, "*  - Unknown option: %c\n", optopt);
             break;
@@ -360,7 +421,10 @@ int main (int argc, char **argv) {
        exit(1);
     }
 
-    devh = libusb_open_device_with_vid_pid(NULL, VENDOR_ID,PRODUCT_ID);
+    if (usb_bus < 0 && !usb_port[0] && !usb_serial[0])
+        devh = libusb_open_device_with_vid_pid(NULL, VENDOR_ID,PRODUCT_ID);
+    else
+        devh = openDevice(usb_context);
     if (!devh) {
        fprintf(stderr, "* Error finding USB device\n");
        goto out;
@@ -0,0 +1,370 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Asynchronous hardware control module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+"""
+
+import asyncio
+import contextlib
+import select
+import time
+import usb1 as usb
+
+from m026Device import *
+
+#===============================================================================
+
+class AsyncM026Device():
+    """asyncio companion of M026Device.
+    Control transfers are submitted as usb1 asynchronous transfers and libusb events are
+    handled by the running asyncio loop through the poll file descriptors of the USB context,
+    so many control transfers can be in flight while the loop keeps running.
+    The device state (video source, video standards, capture frames, tuner frequency, register
+    shadow) is kept in the wrapped M026Device, which has to be found and opened.
+    Serial bus transfers must be done inside serial_bus(), which holds the bus and selects
+    the slave device:
+        async with m026a.serial_bus(0xba):
+            status1=await m026a.sbi_read(0x88)
+    The serial bus interface has one address and data register pair, so the register reads and
+    writes on the bus run one after another, also when they are gathered.
+    """
+
+    def __init__(self,m026):
+        self.m026=m026
+        self.loop=None
+        self.sbiLock=None
+        self.sbiOpLock=None
+        self.pollFDs=set()
+        self.timeoutHandle=None
+        self.transferPool=[]
+        self.ctrlTimeout=1000
+
+    def attach(self):
+        """Handle libusb events in the running asyncio loop."""
+        self.loop=asyncio.get_running_loop()
+        self.sbiLock=asyncio.Lock()
+        # Held by a register read or write from its address write to its data read
+        self.sbiOpLock=asyncio.Lock()
+        context=self.m026.usbContext
+        for fd,events in context.getPollFDList():
+            self.fd_added(fd,events)
+        context.setPollFDNotifiers(self.fd_added_notify,self.fd_removed_notify)
+
+    def detach(self):
+        """Stop handling libusb events in the asyncio loop."""
+        self.m026.usbContext.setPollFDNotifiers(None,None)
+        for fd in list(self.pollFDs):
+            self.fd_removed(fd)
+        if self.timeoutHandle :
+            self.timeoutHandle.cancel()
+            self.timeoutHandle=None
+
+    def fd_added_notify(self,fd,events,user_data=None):
+        self.loop.call_soon_threadsafe(self.fd_added,fd,events)
+
+    def fd_removed_notify(self,fd,user_data=None):
+        self.loop.call_soon_threadsafe(self.fd_removed,fd)
+
+    def fd_added(self,fd,events):
+        if events & select.POLLIN :
+            self.loop.add_reader(fd,self.handle_events)
+        if events & select.POLLOUT :
+            self.loop.add_writer(fd,self.handle_events)
+        self.pollFDs.add(fd)
+
+    def fd_removed(self,fd):
+        if fd in self.pollFDs :
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+            self.pollFDs.discard(fd)
+
+    def handle_events(self):
+        """Handle pending libusb events without blocking and schedule the next libusb timeout."""
+        if self.timeoutHandle :
+            self.timeoutHandle.cancel()
+            self.timeoutHandle=None
+        context=self.m026.usbContext
+        context.handleEventsTimeout(0)
+        timeout=context.getNextTimeout()
+        if timeout is not None :
+            self.timeoutHandle=self.loop.call_later(timeout,self.handle_events)
+
+    #---------------------------------------------------------------------------
+
+    async def control(self,request_type,request,value,index,buffer_or_len):
+        """Submit a control transfer and wait for its completion."""
+        if self.transferPool :
+            transfer=self.transferPool.pop()
+        else :
+            transfer=self.m026.usbDevh.getTransfer()
+        future=self.loop.create_future()
+        m026=self.m026
+        stack=None
+        t0=0
+        if m026.ctrlHooks :
+            stack=m026.ctrl_stack(self)
+            t0=time.perf_counter()
+        direction="r" if request_type & 0x80 else "w"
+        transfer.setControl(request_type,request,value,index,buffer_or_len,callback=self.completed,user_data=(future,direction,index,value,stack,t0),timeout=self.ctrlTimeout)
+        transfer.submit()
+        if self.timeoutHandle is None :
+            self.handle_events()
+        return await future
+
+    def completed(self,transfer):
+        """Resolve the future of a completed control transfer and put the transfer back to the pool."""
+        future,direction,index,value,stack,t0=transfer.getUserData()
+        status=transfer.getStatus()
+        data=b''
+        if status == usb.TRANSFER_COMPLETED :
+            data=bytes(transfer.getBuffer()[:transfer.getActualLength()])
+        if not future.done() :
+            if status == usb.TRANSFER_COMPLETED :
+                future.set_result(data)
+            else :
+                future.set_exception(M026TransactionError([(index,value,status)]))
+        if stack is not None :
+            if direction == "r" :
+                value=data[0] if data else None
+            self.m026.ctrl_hook(direction,index,value,t0,stack)
+        self.transferPool.append(transfer)
+
+    async def ctrl_tx(self,index,value):
+        """Do a USB control write."""
+        await self.control(0x40,1,value,index,b'')
+        m026=self.m026
+        if m026.shadowEnabled and index in dc1100.SHADOWED :
+            m026.shadowRegisters[index]=value
+
+    async def ctrl_tx_many(self,writes):
+        """Do USB control writes [(index,value),...] as a pipeline, in order."""
+        await asyncio.gather(*[self.ctrl_tx(index,value) for index,value in writes])
+
+    async def ctrl_rx(self,index):
+        """Do a USB control read."""
+        r=await self.control(0xc0,0,0x0000,index,1)
+        m026=self.m026
+        if m026.shadowEnabled and index in dc1100.SHADOWED :
+            m026.shadowRegisters[index]=r[0]
+        return r[0]
+
+    async def ctrl_rx_shadow(self,index):
+        """Return the shadowed value of a USB control register, read it if it isn't shadowed."""
+        m026=self.m026
+        if m026.shadowEnabled and index not in dc1100.VOLATILE :
+            if index in m026.shadowRegisters :
+                m026.shadowHits+=1
+                return m026.shadowRegisters[index]
+            m026.shadowMisses+=1
+        return await self.ctrl_rx(index)
+
+    #---------------------------------------------------------------------------
+
+    @contextlib.asynccontextmanager
+    async def serial_bus(self,*sda):
+        """Hold the serial bus and select the serial bus device(s) sda, in order."""
+        async with self.sbiLock:
+            for a in sda :
+                await self.sbi_select_device(a)
+            yield self
+
+    async def sbi_select_device(self,sda):
+        """Select a serial bus device."""
+        if self.m026.sbi_select_skippable(sda) :
+            return
+        await self.ctrl_tx(dc1100.SICTL+3,sda)
+
+    async def sbi_read(self,ra):
+        """Do register read from a serial bus device.
+        Raises M026SerialBusError if the read doesn't complete in sbiTimeout seconds.
+        """
+        m026=self.m026
+        async with self.sbiOpLock:
+            t0=time.perf_counter()
+            await self.ctrl_tx_many([(dc1100.SBUSR,ra),(dc1100.SICTL,0x0020)])   # Read now
+            rf,polls=await self.sbi_wait(0x01,m026.sbiTimeout)
+            m026.sbiReadStats.add(time.perf_counter()-t0,polls,rf)
+            if not rf :
+                raise M026SerialBusError("sbi_read: Serial bus interface can not read register 0x{r:02x}!".format(r=ra))
+            rd=await self.ctrl_rx(dc1100.SBUSR+1)
+        return rd
+
+    async def sbi_write(self,wa,wd,force=False):
+        """Write register of a serial bus device, unless it is known to hold wd and not force.
+        Raises M026SerialBusError if the write doesn't complete in sbiTimeout seconds.
+        """
+        m026=self.m026
+        key=m026.sbi_register_key(wa)
+        if not force and m026.sbi_write_skippable(key,wd) :
+            return
+        async with self.sbiOpLock:
+            t0=time.perf_counter()
+            await self.ctrl_tx_many([(dc1100.SBUSW,wa),(dc1100.SBUSW+1,wd),(dc1100.SICTL,0x0005)]) # Retry Write on Failed ACK + Access Immediately
+            wf,polls=await self.sbi_wait(0x04,m026.sbiTimeout)
+            m026.sbiWriteStats.add(time.perf_counter()-t0,polls,wf)
+        if key is not None :
+            if wf :
+                m026.sbiRegisters[key]=wd
+            else :
+                m026.sbiRegisters.pop(key,None)
+        if not wf :
+            raise M026SerialBusError("sbi_write: Serial bus interface can not write register 0x{r:02x}!".format(r=wa))
+
+    async def sbi_wait(self,done,timeout):
+        """Poll serial bus status until it is done (0x04: write, 0x01: read) or timeout seconds passed.
+        Same adaptive poll interval as M026Device.sbi_wait. Return (completed, number of status reads).
+        """
+        m026=self.m026
+        deadline=time.perf_counter()+timeout
+        interval=m026.sbiPollInterval
+        q=1
+        c=await self.ctrl_rx(dc1100.SICTL+1)
+        while c != done :
+            now=time.perf_counter()
+            if now >= deadline :
+                return False,q
+            await asyncio.sleep(min(interval,deadline-now))
+            interval=min(2*interval,m026.sbiPollIntervalMax)
+            c=await self.ctrl_rx(dc1100.SICTL+1)
+            q+=1
+        return True,q
+
+    async def run_programs(self,names,params=None):
+        """Run register programs like M026Device.run_programs.
+        Consecutive control writes are submitted as a pipeline; the serial bus is held
+        while the programs run.
+        """
+        ops=self.m026.programs_compile(names,params)
+        writes=[]
+        async with self.sbiLock:
+            for op in ops :
+                if op[0] == "ctrl" or op[0] == "ctrl_force" :
+                    writes.append((op[1],op[2]))
+                    continue
+                if writes :
+                    await self.ctrl_tx_many(writes)
+                    writes=[]
+                if op[0] == "ctrl_read" :
+                    await self.ctrl_rx_shadow(op[1])
+                elif op[0] == "select" :
+                    await self.sbi_select_device(op[1])
+                elif op[0] == "sbi" :
+                    await self.sbi_write(op[1],op[2])
+                elif op[0] == "sbi_force" :
+                    await self.sbi_write(op[1],op[2],force=True)
+                elif op[0] == "sbi_read" :
+                    await self.sbi_read(op[1])
+            if writes :
+                await self.ctrl_tx_many(writes)
+
+    #---------------------------------------------------------------------------
+
+    async def vdi_start_capture(self):
+        """Start video capture."""
+        await self.ctrl_tx(dc1100.DCTRL,0xb3)
+
+    async def vdi_stop_capture(self):
+        """Stop video capture."""
+        await self.ctrl_tx(dc1100.DCTRL,0x33)
+
+    async def vdi_set_capture_frame(self,frame):
+        """Set capture frame."""
+        m026=self.m026
+        x0,y0,x1,y1=m026.vdi_capture_frame_registers(*frame.coordinates())
+        await self.run_programs(["capture_frame"],m026.vdi_capture_frame_params(x0,y0,x1,y1))
+        m026.vdi_store_capture_frame(x0,y0,x1,y1)
+        m026.configured['frame']=(x0,y0,x1,y1)
+
+    async def get_video_capture(self):
+        """Get start position, end position and size of video capture frame, read back only
+        if the capture frame isn't valid, like M026Device.get_video_capture.
+        """
+        m026=self.m026
+        if m026.captureFrameValid :
+            m026.video_capture_update()
+            return
+        await self.refresh()
+
+    async def refresh(self):
+        """Read the capture frame back from the device and update the video capture."""
+        r=await asyncio.gather(*[self.ctrl_rx(dc1100.CFSPO+i) for i in range(8)])
+        x0=256*r[1]+r[0]
+        y0=256*r[3]+r[2]
+        x1=256*r[5]+r[4]
+        y1=256*r[7]+r[6]
+        m026=self.m026
+        m026.vdi_store_capture_frame(x0,y0,x1,y1)
+        m026.video_capture_update()
+
+    async def set_audio_source(self,audio_source):
+        """Select audio source."""
+        m026=self.m026
+        if audio_source in audio_source_programs :
+            await self.run_programs([audio_source_programs[audio_source]])
+            m026.audioSource=audio_source
+        m026.configured['audio']=audio_source
+
+    async def tv_tuner_wait_lock(self):
+        """Poll sync lock of the video decoder after tuning, like M026Device.tv_tuner_wait_lock."""
+        m026=self.m026
+        t0=time.perf_counter()
+        deadline=t0+m026.tunerSettleMax
+        await asyncio.sleep(m026.tunerSettleMin)
+        locked=0
+        polls=0
+        while True :
+            async with self.serial_bus(0xba):    # TVP5150AM1 Chip
+                status1=await self.sbi_read(0x88)
+            polls+=1
+            if status1 & 0x06 == 0x06 :
+                locked+=1
+            else :
+                locked=0
+            now=time.perf_counter()
+            if locked >= m026.tunerLockReads or now >= deadline :
+                break
+            await asyncio.sleep(min(m026.tunerPollInterval,deadline-now))
+        return locked >= m026.tunerLockReads,now-t0,polls,status1
+
+    async def set_tv_tuner(self,frequencyMHz):
+        """Set TV tuner."""
+        m026=self.m026
+        VFRQ=int(16*frequencyMHz)+618
+        DB2=VFRQ&0x00FF
+        DB1=(VFRQ>>8)&0x00FF
+        BB=m026.tv_tuner_select_band(frequencyMHz)
+        await self.run_programs(["tuner_frequency"],{"db1":DB1,"db2":DB2,"bb":BB})
+        locked,settle,polls,status1=await self.tv_tuner_wait_lock()
+        band=m026.tv_tuner_band_name(frequencyMHz)
+        if band not in m026.tunerSettleStats :
+            m026.tunerSettleStats[band]=TunerSettleStats(band)
+        m026.tunerSettleStats[band].add(settle,polls,locked)
+        m026.video_decoder_store_sync_status(status1)
+        await self.run_programs(["tuner_if"])
+        m026.tvTunerFrequency=frequencyMHz
+        m026.configured['tuner']=frequencyMHz
+        return True
+
+    async def set_video_source(self,video_source):
+        """Select video source.
+        Runs the same register programs as M026Device.set_video_source.
+        """
+        m026=self.m026
+        print("Setting video source:",list_video_sources[video_source])
+        m026.configured={}
+        standard,frame,vsel,misc,audio=m026.video_source_config(video_source)
+        frameRegisters=m026.vdi_capture_frame_registers(*frame.coordinates())
+        params=m026.vdi_capture_frame_params(*frameRegisters)
+        params['standard']=standard
+        m026.videoSource=video_source
+        await self.run_programs([video_source_programs[video_source]],params)
+        m026.video_source_configured(video_source,standard,frameRegisters,vsel,misc,audio)
+        if video_source == VIDEO_SOURCE_TV :
+            await self.set_tv_tuner(m026.tvTunerFrequency)
+        await self.get_video_capture()
+        await self.vdi_start_capture()
+        m026.configured['base']=True
@@ -8,9 +8,16 @@ Author:     Sinan Güngör
 """
 
 import os
+import re
+import sys
 import time
+import bisect
+import contextlib
+import threading
 import usb1 as usb
 
+from m026Programs import RegisterPrograms
+
 #===============================================================================
 
 class DC1100():
@@ -20,6 +27,9 @@ class DC1100():
     # Remote Wakeup Control
     RMCTL=0x00C
 
+    # PLL Setting
+    PLLSO=0x018
+
     # Decoder Control Register
     DCTRL=0x100
 
@@ -46,6 +56,21 @@ class DC1100():
     # Serial Bus Read
     SBUSR=0x208
 
+    # Registers mirrored by the register shadow of M026Device
+    SHADOWED=frozenset(
+        list(range(GCTRL,GCTRL+4)) +
+        list(range(RMCTL,RMCTL+4)) +
+        [PLLSO,PLLSO+1,DCTRL] +
+        list(range(CFSPO,CFEPO+4)) +
+        [SICTL+2,SICTL+3])
+
+    # Registers changed by the hardware, never served from the shadow
+    VOLATILE=frozenset([SICTL,SICTL+1,SBUSR+1])
+
+    # Serial bus devices whose written registers are tracked by the register shadow:
+    # TVP5150AM1 video decoder and the IF demodulator of the tuner module
+    SBI_SHADOWED=frozenset([0xba,0x86])
+
 dc1100=DC1100()
 
 #===============================================================================
@@ -66,6 +91,14 @@ list_video_standards=["Autoswitch", "Reserved", "NTSC (M,J)", "Reserved", "PAL (
 list_audio_sources=["None","Aux","Tv Tuner"]
 list_video_sources=["Tv","Composite","S-Video"]
 
+# Video standards of the video standard bits (3:0) of status #5 of the TVP5150AM1
+status_video_standards={1:VIDEO_STANDARD_NTSC_M_J,3:VIDEO_STANDARD_PAL_B_G_H_I_N,5:VIDEO_STANDARD_PAL_M,
+                        7:VIDEO_STANDARD_PAL_Nc,9:VIDEO_STANDARD_NTSC,11:VIDEO_STANDARD_SECAM}
+
+# Register programs of the video sources and audio sources, see m026Programs
+video_source_programs={VIDEO_SOURCE_TV:"source_tv",VIDEO_SOURCE_COMPOSITE:"source_composite",VIDEO_SOURCE_S_VIDEO:"source_svideo"}
+audio_source_programs={AUDIO_SOURCE_NONE:"audio_none",AUDIO_SOURCE_AUX:"audio_aux",AUDIO_SOURCE_TV_TUNER:"audio_tv_tuner"}
+
 #===============================================================================
 
 class Utils():
@@ -88,7 +121,99 @@ utils = Utils()
 
 #===============================================================================
 
+class M026Error(Exception):
+    """Base class of the errors raised by M026Device."""
+
+class M026TransactionError(M026Error):
+    """Control transfers of a transaction failed.
+    failures is a list of (index, value, status) of the failed writes.
+    """
+    def __init__(self,failures):
+        self.failures=failures
+        text=", ".join("0x{i:03x}=0x{v:02x} ({s})".format(i=i,v=v,s=s) for i,v,s in failures)
+        M026Error.__init__(self,"{n} control transfer(s) failed: {t}".format(n=len(failures),t=text))
+
+class M026SerialBusError(M026Error):
+    """A serial bus transfer did not complete."""
+
+#===============================================================================
+
+def parse_device_id(deviceId):
+    """Return the device selection (bus, port path, serial number) of a device id:
+    bus-port path as in sysfs, e.g. "3-1.4", or else a serial number.
+    """
+    m=re.match(r"^(\d+)-(\d+(?:\.\d+)*)$",deviceId)
+    if m :
+        return int(m.group(1)),m.group(2),None
+    return None,None,deviceId
+
+#===============================================================================
+
+class SerialBusStats(object):
+    """Latency and poll count histograms of serial bus transfers."""
+    # Upper bounds of the histogram bins, the last bin counts the larger values
+    LATENCY_BINS=(0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1)
+    POLL_BINS=(1,2,3,4,8,16,32,64)
+    TITLE="Serial bus {n}: {c} transfers, {f} failed"
+
+    def __init__(self,name):
+        self.name=name
+        self.reset()
+
+    def reset(self):
+        self.count=0
+        self.failures=0
+        self.latencyTotal=0.0
+        self.latencyMax=0.0
+        self.polls=0
+        self.latencyHistogram=[0]*(len(self.LATENCY_BINS)+1)
+        self.pollHistogram=[0]*(len(self.POLL_BINS)+1)
+
+    def add(self,latency,polls,ok):
+        """Add a transfer which took latency seconds and polls status reads."""
+        self.count+=1
+        if not ok :
+            self.failures+=1
+        self.latencyTotal+=latency
+        self.latencyMax=max(self.latencyMax,latency)
+        self.polls+=polls
+        self.latencyHistogram[bisect.bisect_left(self.LATENCY_BINS,latency)]+=1
+        self.pollHistogram[bisect.bisect_left(self.POLL_BINS,polls)]+=1
+
+    def print(self):
+        print(self.TITLE.format(n=self.name,c=self.count,f=self.failures))
+        if self.count == 0 :
+            return
+        print(" Latency: mean {m:.3f} ms, max {x:.3f} ms".format(m=1000*self.latencyTotal/self.count,x=1000*self.latencyMax))
+        for b,n in zip(self.LATENCY_BINS+(None,),self.latencyHistogram):
+            label="<= {t:g} ms".format(t=1000*b) if b else " > {t:g} ms".format(t=1000*self.LATENCY_BINS[-1])
+            print("  {l:>12} : {n}".format(l=label,n=n))
+        print(" Polls: mean {m:.2f}".format(m=self.polls/self.count))
+        for b,n in zip(self.POLL_BINS+(None,),self.pollHistogram):
+            label="<= {t}".format(t=b) if b else " > {t}".format(t=self.POLL_BINS[-1])
+            print("  {l:>12} : {n}".format(l=label,n=n))
+
+class TunerSettleStats(SerialBusStats):
+    """Settle time and status read histograms of the tunes in a tuner band."""
+    LATENCY_BINS=(0.02,0.05,0.1,0.15,0.2,0.3,0.4,0.5)
+    POLL_BINS=(1,2,4,8,16,32,64,128)
+    TITLE="Tuner band {n}: {c} tunes, {f} without lock"
+
+#===============================================================================
+
+def frame_to_pixels(x0,y0,x1,y1):
+    """Return the video capture (X0,Y0,X1,Y1,W,H) in pixels of a capture frame in register coordinates.
+    Register x counts bytes of a YUYV line, 2 bytes a pixel; register y counts lines of a field, half the lines of a frame.
+    W and H are the frame size the streamer computes from the capture frame registers.
+    """
+    return x0//2,y0*2,x1//2,y1*2,(x1-x0)//2,(y1-y0)*2
+
+def frame_from_pixels(X,Y,W,H):
+    """Return the capture frame (x0,y0,x1,y1) in register coordinates of a video capture WxH+X+Y in pixels."""
+    return X*2,Y//2,(X+W)*2,(Y+H)//2
+
 class Position(object):
+    __slots__=("x","y")
     def __init__(self,x,y):
         self.x = x
         self.y = y
@@ -98,8 +223,12 @@ class Position(object):
         return self.x
     def get_y(self):
         return self.y
+    def set(self,x,y):
+        self.x = x
+        self.y = y
 
 class Frame(object):
+    __slots__=("start","end")
     def __init__(self,start,end):
         self.start = start
         self.end = end
@@ -109,8 +238,16 @@ class Frame(object):
         return self.start
     def get_end(self):
         return self.end
+    def set(self,x0,y0,x1,y1):
+        """Update start and end in place."""
+        self.start.set(x0,y0)
+        self.end.set(x1,y1)
+    def coordinates(self):
+        """Return (x0,y0,x1,y1)."""
+        return self.start.x,self.start.y,self.end.x,self.end.y
 
 class Size(object):
+    __slots__=("width","height")
     def __init__(self,w,h):
         self.width = w
         self.height = h
@@ -120,6 +257,32 @@ class Size(object):
         return self.width
     def get_height(self):
         return self.height
+    def set(self,w,h):
+        self.width = w
+        self.height = h
+
+class DecoderStatus(object):
+    """Status block of the video decoder chip TVP5150AM1: status #1 - #5 and the vertical line count,
+    with the sync lock and the detected video standard decoded.
+    """
+    __slots__=("time","status","lineCount","hSyncLocked","vSyncLocked","locked","standard","autoSwitched")
+
+    def __init__(self,t,status,lineCount):
+        self.time=t
+        self.status=status
+        self.lineCount=lineCount
+        # Status #1: bit 2 vertical sync locked, bit 1 horizontal sync locked
+        self.vSyncLocked=bool(status[0]&0x04)
+        self.hSyncLocked=bool(status[0]&0x02)
+        self.locked=self.vSyncLocked and self.hSyncLocked
+        # Status #5: bit 7 autoswitch mode, bits 3:0 detected video standard
+        self.standard=status_video_standards.get(status[4]&0x0f)
+        self.autoSwitched=bool(status[4]&0x80)
+
+    def __str__(self):
+        standard=list_video_standards[self.standard] if self.standard is not None else "-"
+        return "locked: {l} standard: {s} lines: {n} status: {st}".format(l=self.locked,s=standard,n=self.lineCount,
+               st=" ".join("0x{s:02x}".format(s=s) for s in self.status))
 
 #===============================================================================
 
@@ -140,9 +303,14 @@ class M026Device():
     def __init__(self):
         self.VENDOR_ID=0x07ca
         self.PRODUCT_ID=0x0026
+        self.usbContext = None
         self.usbDev = None
         self.usbDevh = None
         self.usbOpened = False
+        # Device selection of find(), None matches any device
+        self.usbBus = None
+        self.usbPort = None
+        self.usbSerial = None
         
         self.colorBrightness0 = 0.5
         self.colorBrightness = 0.5
@@ -168,6 +336,9 @@ class M026Device():
         self.vdCaptureFrameComposite=Frame(Position(0,0),Position(1280,240))
         self.vdCaptureFrameSVideo=Frame(Position(0,0),Position(1280,240))
         self.vdCaptureFrameTv=Frame(Position(0,0),Position(1280,240))
+        self.vd_capture_frame=Frame(Position(0,0),Position(1280,240))
+        # vd_capture_frame holds the capture frame registers, kept up to date on write
+        self.captureFrameValid=False
         self.vdVideoSizeClass="576"
         self.vdVerticalLineCount=625
         self.vdVerticalSyncLocked=0
@@ -175,39 +346,403 @@ class M026Device():
         self.vdVideoDetected=False
 
         self.tvTunerFrequency=500.25
+        self.tunerSettleMin=0.02
+        self.tunerSettleMax=0.5
+        self.tunerPollInterval=0.01
+        self.tunerLockReads=3
+        self.tunerSettleStats={}
+
+        self.differentialSwitching=False
+        self.configured={}
+
+        self.shadowEnabled=False
+        self.shadowRegisters={}
+        self.shadowHits=0
+        self.shadowMisses=0
+        self.sbiRegisters={}
+        self.sbiSkippedSelects=0
+        self.sbiSkippedWrites=0
+
+        self.ctrlHooks=[]
+
+        self.txQueue=None
+        self.txFailures=[]
+        self.txPool=[]
+        self.txDepth=32
+        self.txTimeout=1000
+
+        self.sbiTimeout=0.1
+        self.sbiPollInterval=0.0001
+        self.sbiPollIntervalMax=0.002
+        self.sbiReadStats=SerialBusStats("read")
+        self.sbiWriteStats=SerialBusStats("write")
+
+        self.programs=RegisterPrograms()
+        # Registers compared by warm_start: capture frame, PLL and serial bus clock, and the video
+        # decoder input selection, miscellaneous controls, video standard and 656 revision
+        self.warmStartRegisters=list(range(dc1100.CFSPO,dc1100.CFEPO+4))+[dc1100.PLLSO,dc1100.SICTL+2]
+        self.warmStartDecoderRegisters=[0x00,0x03,0x28,0x30]
     
-    def find(self):
-        """Find the device."""
-        usbContext=usb.USBContext()
-        for dev in usbContext.getDeviceList():
-            if dev.getVendorID() == self.VENDOR_ID and dev.getProductID() == self.PRODUCT_ID :
-                break
-            else:
-                dev=None
-        self.usbDev=dev
+    def find(self,bus=None,port=None,serial=None):
+        """Find the device. The USB context is created once and kept for later calls.
+        With several devices attached, a device is selected by its bus number, its port path
+        (e.g. "1.4", as in sysfs) and/or its serial number. The selection is kept for later
+        calls and for reattaching.
+        """
+        if bus is not None or port is not None or serial is not None :
+            self.usbBus=bus
+            self.usbPort=port
+            self.usbSerial=serial
+        if self.usbContext is None :
+            self.usbContext=usb.USBContext()
+        if self.usbBus is None and self.usbPort is None and self.usbSerial is None :
+            self.usbDev=self.usbContext.getByVendorIDAndProductID(self.VENDOR_ID,self.PRODUCT_ID,skip_on_error=True)
+            return
+        self.usbDev=None
+        for bus,port,serial,dev in self.list_devices() :
+            if self.device_selected(bus,port,serial) :
+                self.usbDev=dev
+                return
+
+    def list_devices(self):
+        """Return the attached devices as a list of (bus, port path, serial number, usb1 device).
+        The serial number is None if the device has none or can't be opened.
+        """
+        if self.usbContext is None :
+            self.usbContext=usb.USBContext()
+        devices=[]
+        for dev in self.usbContext.getDeviceList(skip_on_error=True) :
+            if dev.getVendorID() != self.VENDOR_ID or dev.getProductID() != self.PRODUCT_ID :
+                continue
+            devices.append((dev.getBusNumber(),self.device_port(dev),self.device_serial(dev),dev))
+        return devices
+
+    def device_port(self,dev):
+        """Return the port path of a usb1 device, e.g. "1.4"."""
+        return ".".join(str(p) for p in dev.getPortNumberList())
+
+    def device_serial(self,dev):
+        """Return the serial number of a usb1 device, or None."""
+        if not dev.getSerialNumberDescriptor() :
+            return None
+        try:
+            return dev.getSerialNumber()
+        except usb.USBError :
+            return None
+
+    def device_selected(self,bus,port,serial):
+        """Return True if a device at bus, port with serial matches the device selection."""
+        return ((self.usbBus is None or self.usbBus == bus) and
+                (self.usbPort is None or self.usbPort == port) and
+                (self.usbSerial is None or self.usbSerial == serial))
+
+    def device_matches(self,dev):
+        """Return True if a usb1 device is the selected device, e.g. on a hotplug event."""
+        if dev.getVendorID() != self.VENDOR_ID or dev.getProductID() != self.PRODUCT_ID :
+            return False
+        if self.usbBus is None and self.usbPort is None and self.usbSerial is None :
+            return True
+        serial=self.device_serial(dev) if self.usbSerial is not None else None
+        return self.device_selected(dev.getBusNumber(),self.device_port(dev),serial)
+
+    def device_is_current(self,dev):
+        """Return True if a usb1 device is the found device, e.g. on a device left event."""
+        if self.usbDev is None :
+            return False
+        return dev.getBusNumber() == self.usbDev.getBusNumber() and dev.getDeviceAddress() == self.usbDev.getDeviceAddress()
+
+    def device_id(self):
+        """Return the id of the found device: its serial number, or bus-port path as in sysfs, e.g. "3-1.4"."""
+        if self.usbDev is None :
+            return None
+        serial=self.device_serial(self.usbDev)
+        if serial :
+            return serial
+        return "{b}-{p}".format(b=self.usbDev.getBusNumber(),p=self.device_port(self.usbDev))
         
     def open(self):
         """Open the device."""
         self.usbDevh=self.usbDev.open()
+        self.usbOpened=True
+        self.txPool=[]
+        self.configured={}
+        self.shadow_invalidate()
+
+    def detach(self):
+        """Forget the device after it left the bus."""
+        if self.usbDevh :
+            try:
+                self.usbDevh.close()
+            except usb.USBError:
+                pass
+        self.usbDev=None
+        self.usbDevh=None
+        self.usbOpened=False
+        self.txPool=[]
+        self.configured={}
+        self.shadow_invalidate()
+
+    def reattach(self,dev):
+        """Open a device which arrived again and restore the last video source with its
+        video standard, capture frame, audio source and tuner frequency.
+        """
+        self.usbDev=dev
+        self.open()
+        self.gpio_led(True)
+        self.set_video_source(self.videoSource)
     
     def reset(self):
         """Reset the device."""
         if self.usbDevh :
             self.usbDevh.resetDevice()
+        self.configured={}
+        self.shadow_invalidate()
             
     def close(self):
         """Close the device."""
-        self.usbDevh.close()
+        if self.usbDevh :
+            self.usbDevh.close()
+        self.usbOpened=False
     
     def ctrl_tx(self,index,value):
-        """Do a USB control write."""
-        r = self.usbDevh.controlWrite(0x40,1,value,index,[])
+        """Do a USB control write, or queue it if a transaction is open."""
+        if self.txQueue is not None :
+            self.txQueue.append((index,value,self.ctrl_stack() if self.ctrlHooks else None))
+        else :
+            if self.usbDevh is None :
+                raise M026Error("ctrl_tx: Device is not attached!")
+            t0=time.perf_counter() if self.ctrlHooks else 0
+            r = self.usbDevh.controlWrite(0x40,1,value,index,[])
+            if self.ctrlHooks :
+                self.ctrl_hook("w",index,value,t0,self.ctrl_stack())
+        if self.shadowEnabled and index in dc1100.SHADOWED :
+            self.shadowRegisters[index]=value
 
     def ctrl_rx(self,index):
         """Do a USB control read."""
+        if self.txQueue :
+            self.tx_flush()
+        if self.usbDevh is None :
+            raise M026Error("ctrl_rx: Device is not attached!")
+        t0=time.perf_counter() if self.ctrlHooks else 0
         r = self.usbDevh.controlRead(0xc0,0,0x0000,index,1)
+        if self.ctrlHooks :
+            self.ctrl_hook("r",index,r[0],t0,self.ctrl_stack())
+        if self.shadowEnabled and index in dc1100.SHADOWED :
+            self.shadowRegisters[index]=r[0]
         return r[0]
+
+    def ctrl_stack(self,owner=None):
+        """Return the names of the methods of this device (or of owner) on the call stack of a
+        control transfer, outermost first, without the transfer method itself.
+        """
+        if owner is None :
+            owner=self
+        names=[]
+        f=sys._getframe(2)
+        while f is not None :
+            if f.f_locals.get('self') is owner :
+                names.append(f.f_code.co_name)
+            f=f.f_back
+        names.reverse()
+        return tuple(names)
+
+    def ctrl_hook(self,direction,index,value,start,stack):
+        """Call the control transfer hooks for a transfer which started at start (time.perf_counter()).
+        Hooks in ctrlHooks are called as hook(direction,index,value,start,duration,stack) with
+        direction "w" or "r" and stack from ctrl_stack(). Without hooks no time is measured.
+        """
+        duration=time.perf_counter()-start
+        for hook in self.ctrlHooks :
+            hook(direction,index,value,start,duration,stack)
+
+    def ctrl_rx_shadow(self,index):
+        """Return the shadowed value of a USB control register, read it if it isn't shadowed."""
+        if self.shadowEnabled and index not in dc1100.VOLATILE :
+            if index in self.shadowRegisters :
+                self.shadowHits+=1
+                return self.shadowRegisters[index]
+            self.shadowMisses+=1
+        return self.ctrl_rx(index)
+
+    def shadow_enable(self,on):
+        """Enable or disable the register shadow.
+        The register shadow also tracks the selected serial bus device and the last written
+        registers of the serial bus devices in dc1100.SBI_SHADOWED, so that selecting the
+        selected device again and writing an unchanged register are skipped.
+        """
+        self.shadowEnabled=on
+        self.shadowRegisters={}
+        self.sbiRegisters={}
+
+    def shadow_invalidate(self,index=None):
+        """Forget the shadowed value of a register, or of all registers if index is None.
+        The capture frame is read back by the next get_video_capture if it is invalidated.
+        """
+        if index is None :
+            self.shadowRegisters={}
+            self.sbiRegisters={}
+            self.captureFrameValid=False
+        else :
+            self.shadowRegisters.pop(index,None)
+            if dc1100.CFSPO <= index < dc1100.CFEPO+4 :
+                self.captureFrameValid=False
+
+    def sbi_invalidate(self,sda=None,ra=None):
+        """Forget the last written value of serial bus device registers.
+        All registers of device sda if ra is None, all devices if sda is None.
+        """
+        if sda is None :
+            self.sbiRegisters={}
+        elif ra is None :
+            for key in [k for k in self.sbiRegisters if k[0] == sda] :
+                del self.sbiRegisters[key]
+        else :
+            self.sbiRegisters.pop((sda,ra),None)
+
+    def sbi_saved_transfers(self):
+        """Return the number of control transfers saved by skipped selects and writes.
+        A skipped write saves at least four transfers: SBUSW, SBUSW+1, SICTL and a status read.
+        """
+        return self.sbiSkippedSelects+4*self.sbiSkippedWrites
+
+    def print_shadow_stats(self):
+        """Print hit/miss counters of the register shadow."""
+        print("Register shadow: {n} registers, {h} hits, {m} misses".format(n=len(self.shadowRegisters),h=self.shadowHits,m=self.shadowMisses))
+        print("Serial bus shadow: {n} registers, {s} selects and {w} writes skipped, {t} transfers saved".format(n=len(self.sbiRegisters),s=self.sbiSkippedSelects,w=self.sbiSkippedWrites,t=self.sbi_saved_transfers()))
  
+    @contextlib.contextmanager
+    def transaction(self):
+        """Queue control writes and submit them as a pipeline of asynchronous transfers.
+        Usage: with m026.transaction(): ...
+        A control read inside the transaction submits the queued writes first, so
+        serial bus operations keep their order. Nested transactions join the outer one.
+        Failed writes are collected and raised once as M026TransactionError at the end.
+        If the block raises, writes which are still queued are discarded.
+        """
+        if self.txQueue is not None :
+            yield self
+            return
+        self.txQueue=[]
+        self.txFailures=[]
+        try:
+            yield self
+            self.tx_flush()
+        except BaseException:
+            for index,value,stack in self.txQueue :
+                self.shadow_invalidate(index)
+            raise
+        finally:
+            self.txQueue=None
+        if self.txFailures :
+            failures=self.txFailures
+            self.txFailures=[]
+            raise M026TransactionError(failures)
+
+    def tx_flush(self):
+        """Submit queued control writes, at most txDepth in flight, and wait for their completion."""
+        queue=self.txQueue
+        if not queue :
+            return
+        self.txQueue=[]
+        if self.usbDevh is None :
+            raise M026Error("tx_flush: Device is not attached!")
+        if self.usbContext is None :
+            for index,value,stack in queue :
+                t0=time.perf_counter() if stack is not None else 0
+                try:
+                    self.usbDevh.controlWrite(0x40,1,value,index,[])
+                except usb.USBError as e:
+                    self.tx_failed(index,value,e)
+                if stack is not None :
+                    self.ctrl_hook("w",index,value,t0,stack)
+            return
+        while len(self.txPool) < min(len(queue),self.txDepth) :
+            self.txPool.append(self.usbDevh.getTransfer())
+        # The callbacks can run on any thread handling the events of the context, e.g. the
+        # hotplug thread: the count of transfers in flight is only changed under pendingLock
+        pending=[0]
+        pendingLock=threading.Lock()
+        def completed(transfer):
+            status=transfer.getStatus()
+            index,value,stack,t0=transfer.getUserData()
+            if status != usb.TRANSFER_COMPLETED :
+                self.tx_failed(index,value,status)
+            if stack is not None :
+                self.ctrl_hook("w",index,value,t0,stack)
+            with pendingLock:
+                pending[0]-=1
+        done=0
+        try:
+            for i in range(0,len(queue),self.txDepth):
+                for transfer,(index,value,stack) in zip(self.txPool,queue[i:i+self.txDepth]):
+                    t0=time.perf_counter() if stack is not None else 0
+                    transfer.setControl(0x40,1,value,index,b'',callback=completed,user_data=(index,value,stack,t0),timeout=self.txTimeout)
+                    with pendingLock:
+                        pending[0]+=1
+                    try:
+                        transfer.submit()
+                    except usb.USBError as e:
+                        with pendingLock:
+                            pending[0]-=1
+                        self.tx_failed(index,value,e)
+                while pending[0] > 0 :
+                    self.usbContext.handleEvents()
+                done=i+self.txDepth
+        finally:
+            if pending[0] > 0 or done < len(queue) :
+                self.tx_abort(pending,queue[done:])
+
+    def tx_abort(self,pending,unsent):
+        """Clean up a tx_flush interrupted by an exception: forget the shadowed values of the writes
+        not known to be done, cancel the transfers in flight and wait briefly for their cancellation.
+        """
+        for index,value,stack in unsent :
+            self.shadow_invalidate(index)
+        for transfer in self.txPool :
+            if transfer.isSubmitted() :
+                try:
+                    transfer.cancel()
+                except usb.USBError:
+                    pass
+        deadline=time.perf_counter()+0.1
+        while pending[0] > 0 and time.perf_counter() < deadline :
+            try:
+                self.usbContext.handleEventsTimeout(0.01)
+            except usb.USBError:
+                break
+        # Transfers still submitted can't be reused
+        self.txPool=[transfer for transfer in self.txPool if not transfer.isSubmitted()]
+
+    def tx_failed(self,index,value,status):
+        """Record a failed write of a transaction."""
+        self.txFailures.append((index,value,status))
+        self.shadow_invalidate(index)
+
+    def programs_compile(self,names,params=None):
+        """Compile register programs into one operation list without redundant writes and selects."""
+        return self.programs.compile(names,params or {},dc1100.VOLATILE,self.sbi_register_tracked)
+
+    def run_programs(self,names,params=None):
+        """Run register programs (see m026Programs) in a transaction.
+        The programs are compiled into one operation list first, which is cached.
+        """
+        ops=self.programs_compile(names,params)
+        with self.transaction():
+            for op in ops :
+                if op[0] == "ctrl" or op[0] == "ctrl_force" :
+                    self.ctrl_tx(op[1],op[2])
+                elif op[0] == "ctrl_read" :
+                    self.ctrl_rx_shadow(op[1])
+                elif op[0] == "select" :
+                    self.sbi_select_device(op[1])
+                elif op[0] == "sbi" :
+                    self.sbi_write(op[1],op[2])
+                elif op[0] == "sbi_force" :
+                    self.sbi_write(op[1],op[2],force=True)
+                elif op[0] == "sbi_read" :
+                    self.sbi_read(op[1])
+
     def print_register(self,reg):
         """Print value of a USB control register"""
         val=self.ctrl_rx(reg)
@@ -215,13 +750,13 @@ class M026Device():
  
     def set_register_bit(self,reg,bit):
         """Set a USB control register bit."""
-        val=self.ctrl_rx(reg)
+        val=self.ctrl_rx_shadow(reg)
         val=utils.set_bit(val,bit)
         self.ctrl_tx(reg,val)
 
     def clear_register_bit(self,reg,bit):
         """Clear a USB control register bit."""
-        val=self.ctrl_rx(reg)
+        val=self.ctrl_rx_shadow(reg)
         val=utils.clear_bit(val,bit)
         self.ctrl_tx(reg,val)
 
@@ -231,46 +766,111 @@ class M026Device():
     
     def sbi_select_device(self,sda):
         """Select a serial bus device."""
+        if self.sbi_select_skippable(sda) :
+            return
         self.ctrl_tx(dc1100.SICTL+3,sda)
 
+    def sbi_select_skippable(self,sda):
+        """Return True and count it if the serial bus device sda is already selected."""
+        if self.shadowEnabled and self.shadowRegisters.get(dc1100.SICTL+3) == sda :
+            self.sbiSkippedSelects+=1
+            return True
+        return False
+
+    def sbi_register_key(self,wa):
+        """Return the register shadow key of register wa of the selected serial bus device, None if it isn't tracked.
+        Status and interrupt registers (0x80 and above) and the reset register 0x05 of the video decoder aren't tracked.
+        """
+        if not self.shadowEnabled :
+            return None
+        sda=self.shadowRegisters.get(dc1100.SICTL+3)
+        if not self.sbi_register_tracked(sda,wa) :
+            return None
+        return (sda,wa)
+
+    def sbi_register_tracked(self,sda,wa):
+        """Return True if the last written value of register wa of serial bus device sda can be tracked."""
+        return sda in dc1100.SBI_SHADOWED and wa < 0x80 and not (sda == 0xba and wa == 0x05)
+
+    def sbi_write_skippable(self,key,wd):
+        """Return True and count it if the tracked register key already holds wd."""
+        if key is not None and self.sbiRegisters.get(key) == wd :
+            self.sbiSkippedWrites+=1
+            return True
+        return False
+
     def sbi_read(self,ra):
-        """Do register read from a serial bus device."""
+        """Do register read from a serial bus device.
+        Raises M026SerialBusError if the read doesn't complete in sbiTimeout seconds.
+        """
+        t0=time.perf_counter()
         self.ctrl_tx(dc1100.SBUSR,ra)
         self.ctrl_tx(dc1100.SICTL,0x0020)   # Read now
-        rf=self.sbi_read_finish(1000)
+        rf,polls=self.sbi_wait(0x01,self.sbiTimeout)
+        self.sbiReadStats.add(time.perf_counter()-t0,polls,rf)
+        if not rf :
+            raise M026SerialBusError("sbi_read: Serial bus interface can not read register 0x{r:02x}!".format(r=ra))
         rd=self.ctrl_rx(dc1100.SBUSR+1)
         return rd   
    
-    def sbi_write(self,wa,wd):
-        """Write register of a serial bus device."""
+    def sbi_write(self,wa,wd,force=False):
+        """Write register of a serial bus device, unless it is known to hold wd and not force.
+        Raises M026SerialBusError if the write doesn't complete in sbiTimeout seconds.
+        """
+        key=self.sbi_register_key(wa)
+        if not force and self.sbi_write_skippable(key,wd) :
+            return
+        t0=time.perf_counter()
         self.ctrl_tx(dc1100.SBUSW,wa)
         self.ctrl_tx(dc1100.SBUSW+1,wd)
         self.ctrl_tx(dc1100.SICTL,0x0005) # Retry Write on Failed ACK + Access Immediately
-        wf=self.sbi_write_finish(1000)
-
-    def sbi_write_finish(self, max_try):
-        """Wait until write operation completed."""
-        c = self.ctrl_rx(dc1100.SICTL+1) 
+        wf,polls=self.sbi_wait(0x04,self.sbiTimeout)
+        self.sbiWriteStats.add(time.perf_counter()-t0,polls,wf)
+        if key is not None :
+            if wf :
+                self.sbiRegisters[key]=wd
+            else :
+                self.sbiRegisters.pop(key,None)
+        if not wf :
+            raise M026SerialBusError("sbi_write: Serial bus interface can not write register 0x{r:02x}!".format(r=wa))
+
+    def sbi_wait(self,done,timeout):
+        """Poll serial bus status until it is done (0x04: write, 0x01: read) or timeout seconds passed.
+        The poll interval starts at sbiPollInterval and doubles up to sbiPollIntervalMax.
+        Return (completed, number of status reads).
+        """
+        deadline=time.perf_counter()+timeout
+        interval=self.sbiPollInterval
         q=1
-        while c != 0x04 :
+        c = self.ctrl_rx(dc1100.SICTL+1)
+        while c != done :
+            now=time.perf_counter()
+            if now >= deadline :
+                return False,q
+            time.sleep(min(interval,deadline-now))
+            interval=min(2*interval,self.sbiPollIntervalMax)
             c = self.ctrl_rx(dc1100.SICTL+1)
             q+=1
-            if q == max_try :
-                print('sbi_write_finish: Serial bus interface can not write!')
-                return False
-        return True
+        return True,q
+
+    def sbi_write_finish(self, timeout):
+        """Wait until write operation completed."""
+        wf,polls=self.sbi_wait(0x04,timeout)
+        if not wf :
+            print('sbi_write_finish: Serial bus interface can not write!')
+        return wf
     
-    def sbi_read_finish(self, max_try):
+    def sbi_read_finish(self, timeout):
         """Wait until read operation completed."""
-        c = self.ctrl_rx(dc1100.SICTL+1) 
-        q=1
-        while c != 0x01 :
-            c = self.ctrl_rx(dc1100.SICTL+1)
-            q+=1
-            if q == max_try :
-                print('sbi_read_finish: Serial bus interface can not read!')
-                return False
-        return True
+        rf,polls=self.sbi_wait(0x01,timeout)
+        if not rf :
+            print('sbi_read_finish: Serial bus interface can not read!')
+        return rf
+
+    def print_sbi_stats(self):
+        """Print latency and poll count histograms of serial bus transfers."""
+        self.sbiReadStats.print()
+        self.sbiWriteStats.print()
         
     def gpio_led(self,on):
         """Turn the LED on the device on or off."""
@@ -282,12 +882,7 @@ class M026Device():
             
     def tg_set_timings(self):
         """Set timing generator."""
-        self.ctrl_tx(0x0300,0x0012)
-        self.ctrl_tx(0x0350,0x002d)
-        self.ctrl_tx(0x0351,0x0001)
-        self.ctrl_tx(0x0352,0x0000)
-        self.ctrl_tx(0x0353,0x0000)
-        self.ctrl_tx(0x0300,0x0080)    
+        self.run_programs(["timings"])
     
     def vdi_start_capture(self):
         """Start video capture."""
@@ -299,44 +894,40 @@ class M026Device():
         
     def vdi_set_capture_frame(self,frame):
         """Set capture frame."""
-        x0=frame.start.x
-        y0=frame.start.y
-        x1=frame.end.x
-        y1=frame.end.y
-        
-        xL=x0&0x00FF
-        xH=(x0&0xFF00)>>8
-        self.ctrl_tx(dc1100.CFSPO_STX_L,xL)
-        self.ctrl_tx(dc1100.CFSPO_STX_H,xH)
-
-        yL=y0&0x00FF
-        yH=(y0&0xFF00)>>8
-        self.ctrl_tx(dc1100.CFSPO_STY_L,yL)
-        self.ctrl_tx(dc1100.CFSPO_STY_H,yH)
-
-        xL=x1&0x00FF
-        xH=(x1&0xFF00)>>8
-        self.ctrl_tx(dc1100.CFEPO_ENX_L,xL)
-        self.ctrl_tx(dc1100.CFEPO_ENX_H,xH)
-
-        if y1 > 287:
-            y1=287
-        yL=y1&0x00FF
-        yH=(y1&0xFF00)>>8
-        self.ctrl_tx(dc1100.CFEPO_ENY_L,yL)
-        self.ctrl_tx(dc1100.CFEPO_ENY_H,yH)      
-        
+        self.vdi_write_capture_frame(*frame.coordinates())
+
+    def vdi_write_capture_frame(self,x0,y0,x1,y1):
+        """Set capture frame (x0,y0,x1,y1) in register coordinates."""
+        x0,y0,x1,y1=self.vdi_capture_frame_registers(x0,y0,x1,y1)
+        self.run_programs(["capture_frame"],self.vdi_capture_frame_params(x0,y0,x1,y1))
         # print("vdi_set_capture_frame: ({},{}) - ({},{})".format(x0,y0,x1,y1))
-        
+        self.vdi_store_capture_frame(x0,y0,x1,y1)
+        self.configured['frame']=(x0,y0,x1,y1)
+
+    def vdi_capture_frame_registers(self,x0,y0,x1,y1):
+        """Return the capture frame (x0,y0,x1,y1) as written to the registers, y1 is limited to 287."""
+        return x0,y0,x1,min(y1,287)
+
+    def vdi_capture_frame_params(self,x0,y0,x1,y1):
+        """Return the parameters of the capture_frame register program."""
+        return {"stx_l":x0&0x00FF,"stx_h":(x0&0xFF00)>>8,
+                "sty_l":y0&0x00FF,"sty_h":(y0&0xFF00)>>8,
+                "enx_l":x1&0x00FF,"enx_h":(x1&0xFF00)>>8,
+                "eny_l":y1&0x00FF,"eny_h":(y1&0xFF00)>>8}
+
+    def vdi_store_capture_frame(self,x0,y0,x1,y1):
+        """Store capture frame for current video source and set video size."""
+        self.vd_capture_frame.set(x0,y0,x1,y1)
+        self.captureFrameValid=True
         if self.videoSource == VIDEO_SOURCE_TV :
-            self.vdCaptureFrameTv=Frame(Position(x0,y0),Position(x1,y1))
+            self.vdCaptureFrameTv.set(x0,y0,x1,y1)
         if self.videoSource == VIDEO_SOURCE_COMPOSITE :
-            self.vdCaptureFrameComposite=Frame(Position(x0,y0),Position(x1,y1))
+            self.vdCaptureFrameComposite.set(x0,y0,x1,y1)
         if self.videoSource == VIDEO_SOURCE_S_VIDEO :
-            self.vdCaptureFrameSVideo=Frame(Position(x0,y0),Position(x1,y1))
+            self.vdCaptureFrameSVideo.set(x0,y0,x1,y1)
         
-        self.videoCaptureSize.width=int((x1-x0)//2)
-        self.videoCaptureSize.height=int((y1-y0)*2)
+        X0,Y0,X1,Y1,W,H=frame_to_pixels(x0,y0,x1,y1)
+        self.videoCaptureSize.set(W,H)
         
     def vdi_get_capture_frame(self):
         """Get capture frame, store it for current video source and set video size."""
@@ -353,17 +944,7 @@ class M026Device():
         yH=self.ctrl_rx(dc1100.CFEPO_ENY_H)
         y1=256*yH + yL
         
-        self.vd_capture_frame=Frame(Position(x0,y0),Position(x1,y1))
-        
-        if self.videoSource == VIDEO_SOURCE_TV :
-            self.vdCaptureFrameTv=Frame(Position(x0,y0),Position(x1,y1))
-        if self.videoSource == VIDEO_SOURCE_COMPOSITE :
-            self.vdCaptureFrameComposite=Frame(Position(x0,y0),Position(x1,y1))
-        if self.videoSource == VIDEO_SOURCE_S_VIDEO :
-            self.vdCaptureFrameSVideo=Frame(Position(x0,y0),Position(x1,y1))
-            
-        self.videoCaptureSize.width=int((x1-x0)//2)
-        self.videoCaptureSize.height=int((y1-y0)*2)
+        self.vdi_store_capture_frame(x0,y0,x1,y1)
      
     def print_video_capture(self):
         """Print video capture geometry."""
@@ -377,21 +958,25 @@ class M026Device():
         print ("({x0},{y0}) - ({x1},{y1}) : {w}x{h}".format(x0=x0,y0=y0,x1=x1,y1=y1,w=w,h=h)) 
      
     def get_video_capture (self):
-        """Get start position, end position and size of video capture frame.""" 
+        """Get start position, end position and size of video capture frame.
+        The capture frame is kept up to date on write, so it is only read back from the
+        device after it was opened or reset, or after a failed write.
+        """ 
+        if not self.captureFrameValid :
+            self.vdi_get_capture_frame()
+        self.video_capture_update()
+
+    def refresh(self):
+        """Read the capture frame back from the device and update the video capture."""
         self.vdi_get_capture_frame()
-        x0=self.vd_capture_frame.start.x
-        y0=self.vd_capture_frame.start.y
-        x1=self.vd_capture_frame.end.x
-        y1=self.vd_capture_frame.end.y
-        X0=x0//2
-        X1=x1//2
-        Y0=y0*2
-        Y1=y1*2
-        W=X1-X0
-        H=Y1-Y0
-        self.videoCaptureStart=Position(X0,Y0)
-        self.videoCaptureEnd=Position(X1,Y1)
-        self.videoCaptureSize=Size(W,H)
+        self.video_capture_update()
+
+    def video_capture_update(self):
+        """Set start position, end position and size of video capture from the capture frame."""
+        X0,Y0,X1,Y1,W,H=frame_to_pixels(*self.vd_capture_frame.coordinates())
+        self.videoCaptureStart.set(X0,Y0)
+        self.videoCaptureEnd.set(X1,Y1)
+        self.videoCaptureSize.set(W,H)
         
     def set_video_capture(self,X,Y,W,H):
         """Set video capture frame WxH+X+Y""" 
@@ -403,13 +988,8 @@ class M026Device():
             W = 720
         if H > 576 :
             H = 576
-            
-        x0 = X*2
-        y0 = Y//2
-        x1=(X+W)*2
-        y1=(Y+H)//2
 
-        self.vdi_set_capture_frame(Frame(Position(x0,y0),Position(x1,y1)))
+        self.vdi_write_capture_frame(*frame_from_pixels(X,Y,W,H))
         
     def video_decoder_status_video_standard(self):
         """Get Status #5 of the video decoder chip TVP5150AM1.
@@ -502,18 +1082,38 @@ class M026Device():
             
     def video_decoder_set_video_standard(self,vs):
         """Select video standard of the video decoder chip TVP5150AM1."""
-        self.sbi_select_device(0xba)
-        self.sbi_write(0x28,vs)
+        self.run_programs(["standard"],{"standard":vs})
+        self.configured['standard']=vs
     
     def video_decoder_get_vertical_line_count(self):
         """Return vertical line count of the video decoder chip TVP5150AM1."""
-        self.sbi_select_device(0xba)
-        vlc_h=self.sbi_read(0x84)
-        vlc_l=self.sbi_read(0x85)
+        vlc_h,vlc_l=self.video_decoder_read_block(0x84,2)
         vlc=256*vlc_h+vlc_l
         self.vdVerticalLineCount=vlc
 
     
+    def video_decoder_read_block(self,start,count):
+        """Read count consecutive registers from start of the video decoder chip TVP5150AM1.
+        The serial bus interface reads one register per read command, so the device is selected
+        once and the reads run in a transaction: the address and read command writes of a
+        register go out together, pipelined, before its status poll and data read.
+        Return the values as bytes.
+        """
+        with self.transaction():
+            self.sbi_select_device(0xba)
+            return bytes([self.sbi_read(ra) for ra in range(start,start+count)])
+
+    def video_decoder_snapshot(self):
+        """Read status #1 - #5 and the vertical line count of the video decoder chip TVP5150AM1
+        as one device operation, the decoder selected once for both ranges. Return a DecoderStatus.
+        """
+        with self.transaction():
+            self.sbi_select_device(0xba)
+            vlc=[self.sbi_read(ra) for ra in range(0x84,0x86)]
+            status=bytes([self.sbi_read(ra) for ra in range(0x88,0x8d)])
+        self.vdVerticalLineCount=256*vlc[0]+vlc[1]
+        return DecoderStatus(time.time(),status,self.vdVerticalLineCount)
+
     def video_decoder_status(self,n):
         """Return the nth status byte of the video decoder chip TVP5150AM1."""
         self.sbi_select_device(0xba)
@@ -530,6 +1130,18 @@ class M026Device():
             s=self.sbi_read(0x8c)
         return s
     
+    def video_decoder_store_sync_status(self,status1):
+        """Store sync lock state from status #1 of the video decoder chip TVP5150AM1."""
+        print("Video decoder status 1: 0x{s:02x} {b}".format(s=status1,b=utils.byte2bits(status1)))
+
+        self.vdVerticalSyncLocked=utils.get_bit(status1,2)
+        self.vdHorizontalSyncLocked=utils.get_bit(status1,1)
+        
+        if self.vdVerticalSyncLocked and self.vdHorizontalSyncLocked :
+            self.vdVideoDetected=True
+        else :
+            self.vdVideoDetected=False
+
     def video_decoder_set_brightness(self,brightness):
         """Set video brightness."""
         if brightness < 0.0 :
@@ -574,196 +1186,146 @@ class M026Device():
         
     def set_audio_source(self,audio_source):
         """Select audio source."""
-        if audio_source == AUDIO_SOURCE_NONE:
-            self.audioSource=AUDIO_SOURCE_NONE
-            c = self.ctrl_rx(dc1100.GCTRL+2)
-            self.ctrl_tx(dc1100.GCTRL+2,0x00e8)
-            c = self.ctrl_rx(dc1100.GCTRL+3)
-            self.ctrl_tx(dc1100.GCTRL+3,0x0001)
-            c = self.ctrl_rx(dc1100.GCTRL)
-            self.ctrl_tx(dc1100.GCTRL,0x001a)
-            c = self.ctrl_rx(dc1100.GCTRL+1)
-            self.ctrl_tx(dc1100.GCTRL+2,0x0002)
-        if audio_source == AUDIO_SOURCE_AUX :
-            self.audioSource=AUDIO_SOURCE_AUX
-            c = self.ctrl_rx(dc1100.GCTRL+2)
-            self.ctrl_tx(dc1100.GCTRL+2,0x00e8)
-            c = self.ctrl_rx(dc1100.GCTRL+3)
-            self.ctrl_tx(dc1100.GCTRL+3,0x0001)
-            c = self.ctrl_rx(dc1100.GCTRL)
-            self.ctrl_tx(dc1100.GCTRL,0x009a)
-            c = self.ctrl_rx(dc1100.GCTRL+1)
-            self.ctrl_tx(dc1100.GCTRL+1,0x0002)
-        if audio_source == AUDIO_SOURCE_TV_TUNER :
-            self.audioSource=AUDIO_SOURCE_TV_TUNER
-            c = self.ctrl_rx(dc1100.GCTRL+2)
-            self.ctrl_tx(dc1100.GCTRL+2,0x00e8)
-            c = self.ctrl_rx(dc1100.GCTRL+3)
-            self.ctrl_tx(dc1100.GCTRL+3,0x0001)
-            c = self.ctrl_rx(dc1100.GCTRL)
-            self.ctrl_tx(dc1100.GCTRL,0x001a)
-            c = self.ctrl_rx(dc1100.GCTRL+1)
-            self.ctrl_tx(dc1100.GCTRL+1,0x0003)
+        if audio_source in audio_source_programs :
+            self.run_programs([audio_source_programs[audio_source]])
+            self.audioSource=audio_source
+        self.configured['audio']=audio_source
         
-    def set_video_source(self,video_source):
-        """Select video source."""
+    def video_source_config(self,video_source):
+        """Return (video standard, capture frame, input select, misc controls, audio source) of a video source.
+        S-Video uses the composite video standard and capture frame, as the full set_video_source sequence does.
+        """
         if video_source == VIDEO_SOURCE_TV :
-            print("Setting video source: TV")
-            self.videoSource=VIDEO_SOURCE_TV   
-            print("  Tuner frequency: {f:.2f} MHz".format(f=self.tvTunerFrequency))
-            print("  Video standard:",list_video_standards[self.vdVideoStandardTv])
-            print("  Capture frame:",self.vdCaptureFrameTv)
-             
-            vdVideoStandard=self.vdVideoStandardTv
-      
-            self.ctrl_tx(dc1100.GCTRL,0x0028) # GCTRL:GV
-            self.ctrl_tx(dc1100.GCTRL+2,0x0068) # GCTRL:GDIR
-            self.ctrl_tx(dc1100.RMCTL+1,0x0000) # RMCTL:RWP Remote Wakeup Polarity (GPIO[9:8])
-            self.ctrl_tx(dc1100.RMCTL+3,0x0002) # RMCTL:RWC Remote Wakeup Control (GPIO[9:8])
-
-            self.tg_set_timings()
-
-            self.ctrl_tx(0x0018,0x0010) # PLLSO 
-            self.ctrl_tx(0x0019,0x0000) # PLLSO 
-
-            self.sbi_clock_divider(0x1e) # SICTL:CD
-        
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0082)
-            self.sbi_write(0x000f,0x000a) # Configuration Shared Pins Register
-            self.sbi_write(0x0030,0x0001) # 656 Revision Select Register 1 = Adheres to ITU-R BT.656.3 timing
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-            self.set_audio_source(AUDIO_SOURCE_NONE)
-            
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0003)
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0000,0x0002) # Video Input Source Selection #1 Register: 0x02 -  Composite AIP1B
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0003)
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0000,0x0001) # Video Input Source Selection #1 Register: 0x01 - S-Video AIP1A (luminance), AIP1B (chrominance)
-            self.sbi_write(0x0003,0x002f) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0003)
-            
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0000,0x0000) # Video Input Source Selection #1 Register: 0x00 - -  Composite AIP1A (default)
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-
-            self.video_decoder_set_video_standard(self.vdVideoStandardTv)
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0030,0x0000)   # 656 Revision Select Register: 0000 = Adheres to ITU-R BT.656.4 and BT.656.5 timing (default)
-                                            # 656 Revision Select Register: 0001 = Adheres to ITU-R BT.656.3 timing
-
-            self.vdi_set_capture_frame(self.vdCaptureFrameTv)
-
-            #   === Set audio source  
-            self.set_audio_source(AUDIO_SOURCE_TV_TUNER)
-
-            #   === Tuner frequency  setting    
-            self.set_tv_tuner(self.tvTunerFrequency)
-        
-            self.get_video_capture()
-            self.vdi_start_capture() 
-
+            return self.vdVideoStandardTv,self.vdCaptureFrameTv,0x0000,0x006f,AUDIO_SOURCE_TV_TUNER
         if video_source == VIDEO_SOURCE_COMPOSITE :
-            print("Setting video source: Composite")
-            self.videoSource = VIDEO_SOURCE_COMPOSITE
-          
-            print("  Video standard:",list_video_standards[self.vdVideoStandardComposite])
-            print("  Capture frame:",self.vdCaptureFrameComposite)
-          
-            self.ctrl_tx(dc1100.GCTRL,0x0028) # GCTRL:GV
-            self.ctrl_tx(dc1100.GCTRL+2,0x0068) # GCTRL:GDIR
-            self.ctrl_tx(0x000d,0x0000) # RMCTL:RWP Remote Wakeup Polarity (GPIO[9:8])
-            self.ctrl_tx(0x000f,0x0002) # RMCTL:RWC Remote Wakeup Control (GPIO[9:8])
-
-            self.tg_set_timings()
-                
-            self.ctrl_tx(0x0018,0x0010) # ?
-            self.ctrl_tx(0x0019,0x0000) # ?
-                
-            self.sbi_clock_divider(0x1e)    # SICTL:CD
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0082)
-            self.sbi_write(0x000f,0x000a) # Configuration Shared Pins Register
-            self.sbi_write(0x0030,0x0001) # 656 Revision Select Register 1 = Adheres to ITU-R BT.656.3 timing
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0003)
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0000,0x0002) # Video Input Source Selection #1 Register: 0x02 -  Composite AIP1B
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.video_decoder_set_video_standard(self.vdVideoStandardComposite)
-
-            self.sbi_write(0x0030,0x0000)
-
-            self.vdi_set_capture_frame(self.vdCaptureFrameComposite)
-            self.get_video_capture()
-            
-            #   === Set audio source 
-            self.set_audio_source(AUDIO_SOURCE_AUX)
- 
+            return self.vdVideoStandardComposite,self.vdCaptureFrameComposite,0x0002,0x006f,AUDIO_SOURCE_AUX
+        return self.vdVideoStandardComposite,self.vdCaptureFrameComposite,0x0001,0x000d,AUDIO_SOURCE_AUX
+
+    def video_source_configured(self,video_source,standard,frame,vsel,misc,audio):
+        """Record the state written by a video source switch."""
+        self.videoSource=video_source
+        self.audioSource=audio
+        self.vdi_store_capture_frame(*frame)
+        self.configured.update(input=(vsel,misc),standard=standard,frame=frame,audio=audio)
+
+    def set_video_source_delta(self,video_source):
+        """Select video source by writing only what differs from the configured state.
+        The configured state is recorded by the full set_video_source sequence and kept up to
+        date by the register setters.
+        """
+        print("Setting video source (differential):",list_video_sources[video_source])
+        standard,frame,vsel,misc,audio=self.video_source_config(video_source)
+        frameRegisters=self.vdi_capture_frame_registers(*frame.coordinates())
+        names=[]
+        params={}
+        if self.configured.get('input') != (vsel,misc) :
+            names.append("input_select")
+            params.update(input=vsel,misc=misc)
+        if self.configured.get('standard') != standard :
+            names.append("standard")
+            params['standard']=standard
+        if self.configured.get('frame') != frameRegisters :
+            names.append("capture_frame")
+            params.update(self.vdi_capture_frame_params(*frameRegisters))
+        if self.configured.get('audio') != audio :
+            names.append(audio_source_programs[audio])
+        with self.transaction():
+            self.videoSource=video_source
+            self.run_programs(names,params)
+            self.video_source_configured(video_source,standard,frameRegisters,vsel,misc,audio)
+            if video_source == VIDEO_SOURCE_TV and self.configured.get('tuner') != self.tvTunerFrequency :
+                self.set_tv_tuner(self.tvTunerFrequency)
             self.get_video_capture()
             self.vdi_start_capture()
 
-        if video_source == VIDEO_SOURCE_S_VIDEO :
-            print("Setting video source: S-Video")
-            print("  Video standard:",list_video_standards[self.vdVideoStandardSVideo])
-            print("  Capture frame:",self.vdCaptureFrameSVideo)
-            
-            self.videoSource = VIDEO_SOURCE_S_VIDEO
-
-            self.vdi_set_capture_frame(self.vdCaptureFrameSVideo)
-
-
-            self.ctrl_tx(dc1100.GCTRL,0x0028) # GCTRL:GV
-            self.ctrl_tx(dc1100.GCTRL+2,0x0068) # GCTRL:GDIR
-            self.ctrl_tx(0x000d,0x0000) # RMCTL:RWP Remote Wakeup Polarity (GPIO[9:8])
-            self.ctrl_tx(0x000f,0x0002) # RMCTL:RWC Remote Wakeup Control (GPIO[9:8])
-
-            self.tg_set_timings()
-                
-            self.ctrl_tx(0x0018,0x0010) # ?
-            self.ctrl_tx(0x0019,0x0000) # ?
-                
-            self.sbi_clock_divider(0x1e)    # SICTL:CD
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0082)
-            self.sbi_write(0x000f,0x000a) # Configuration Shared Pins Register
-            self.sbi_write(0x0030,0x0001) # 656 Revision Select Register 1 = Adheres to ITU-R BT.656.3 timing
-            self.sbi_write(0x0003,0x006f) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            c = self.sbi_read(0x0003)
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.sbi_write(0x0000,0x0001) # Video Input Source Selection #1 Register: 0x01 -  Composite AIP1B
-            self.sbi_write(0x0003,0x000d) # Miscellaneous Controls Register
-
-            self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-            self.video_decoder_set_video_standard(self.vdVideoStandardComposite)
-
-            self.sbi_write(0x0030,0x0000)
-
-            self.vdi_set_capture_frame(self.vdCaptureFrameComposite)
-            self.get_video_capture()
-
+    def video_source_state(self,video_source):
+        """Return the register state the full set_video_source sequence leaves for a video source:
+        ({control register: value}, {video decoder register: value}).
+        """
+        standard,frame,vsel,misc,audio=self.video_source_config(video_source)
+        params=self.vdi_capture_frame_params(*self.vdi_capture_frame_registers(*frame.coordinates()))
+        params['standard']=standard
+        ctrl,sbi=self.programs.state([video_source_programs[video_source]],params)
+        decoder={ra:v for (sda,ra),v in sbi.items() if sda == 0xba}
+        return ctrl,decoder
+
+    def fingerprint(self):
+        """Read the warm start registers: ({control register: value}, {video decoder register: value})."""
+        ctrl={index:self.ctrl_rx(index) for index in self.warmStartRegisters}
+        with self.transaction():
+            self.sbi_select_device(0xba)
+            decoder={ra:self.sbi_read(ra) for ra in self.warmStartDecoderRegisters}
+        return ctrl,decoder
+
+    def warm_start(self,video_source):
+        """Take over the configuration the device kept from a previous session.
+        The warm start registers are read and compared with the state set_video_source would
+        leave for video_source with its video standard and capture frame. If they match, only
+        the audio source, the tuner (its divider can't be read back) and capture start are set,
+        and the configured state is recorded as after set_video_source. Return True then;
+        False if they differ and the full set_video_source is needed.
+        """
+        ctrlExpected,decoderExpected=self.video_source_state(video_source)
+        ctrl,decoder=self.fingerprint()
+        differences=["0x{i:03x}: 0x{v:02x} != 0x{e:02x}".format(i=i,v=v,e=ctrlExpected[i]) for i,v in ctrl.items() if i in ctrlExpected and v != ctrlExpected[i]]
+        differences+=["decoder 0x{r:02x}: 0x{v:02x} != 0x{e:02x}".format(r=r,v=v,e=decoderExpected[r]) for r,v in decoder.items() if r in decoderExpected and v != decoderExpected[r]]
+        if differences :
+            print("Warm start: device state differs, initializing:",", ".join(differences))
+            return False
+        print("Warm start:",list_video_sources[video_source])
+        standard,frame,vsel,misc,audio=self.video_source_config(video_source)
+        self.configured={}
+        self.videoSource=video_source
+        self.video_source_configured(video_source,standard,self.vdi_capture_frame_registers(*frame.coordinates()),vsel,misc,audio)
+        if self.shadowEnabled :
+            for ra,v in decoder.items() :
+                if self.sbi_register_tracked(0xba,ra) :
+                    self.sbiRegisters[(0xba,ra)]=v
+        with self.transaction():
+            self.set_audio_source(audio)
+            if video_source == VIDEO_SOURCE_TV :
+                self.set_tv_tuner(self.tvTunerFrequency)
+            self.vdi_start_capture()
+        self.configured['base']=True
+        return True
 
-            #   === Set audio source 
-            self.set_audio_source(AUDIO_SOURCE_AUX) 
-            
+    def set_video_source(self,video_source):
+        """Select video source.
+        The register sequence of each video source is a register program of self.programs.
+        If differentialSwitching is on and the full sequence configured the device since it
+        was opened or reset, only the registers which differ for the new source are written.
+        The full sequence is done, with the register shadow and the serial bus write cache
+        cleared, if the differential switch fails.
+        """
+        if self.differentialSwitching and self.configured.get('base') :
+            try:
+                self.set_video_source_delta(video_source)
+                return
+            except (M026Error,usb.USBError) as e:
+                print("set_video_source: Differential switch failed, doing the full sequence:",e)
+                # The state of the registers the switch was writing is unknown: no write of the
+                # full sequence may be skipped for a last written or shadowed value
+                self.sbi_invalidate()
+                self.shadow_invalidate()
+        self.configured={}
+        standard,frame,vsel,misc,audio=self.video_source_config(video_source)
+        frameRegisters=self.vdi_capture_frame_registers(*frame.coordinates())
+        print("Setting video source:",list_video_sources[video_source])
+        if video_source == VIDEO_SOURCE_TV :
+            print("  Tuner frequency: {f:.2f} MHz".format(f=self.tvTunerFrequency))
+        print("  Video standard:",list_video_standards[standard])
+        print("  Capture frame:",frame)
+        params=self.vdi_capture_frame_params(*frameRegisters)
+        params['standard']=standard
+        with self.transaction():
+            self.videoSource=video_source
+            self.run_programs([video_source_programs[video_source]],params)
+            self.video_source_configured(video_source,standard,frameRegisters,vsel,misc,audio)
+            if video_source == VIDEO_SOURCE_TV :
+                self.set_tv_tuner(self.tvTunerFrequency)
             self.get_video_capture()
             self.vdi_start_capture()
+        self.configured['base']=True
            
     def tv_tuner_select_band(self,frequencyMHz):
         """Return band select byte.
@@ -793,36 +1355,62 @@ class M026Device():
         DB2=VFRQ&0x00FF
         DB1=(VFRQ>>8)&0x00FF
         # print("VFRQ_H,VFRQ_L: 0x{h:02x} 0x{l:02x}".format(h=DB1,l=DB2))
-        CB=0x8e
         BB=self.tv_tuner_select_band(frequencyMHz)
-        self.sbi_select_device(0x42) # Slave address
-        self.sbi_select_device(0xc2) # Subaddress
-        self.sbi_write(DB1,DB2)
-        self.sbi_write(CB,BB)
+        self.run_programs(["tuner_frequency"],{"db1":DB1,"db2":DB2,"bb":BB})
         
+    def tv_tuner_band_name(self,frequencyMHz):
+        """Return the name of the band of a frequency, see tv_tuner_select_band."""
+        bb=self.tv_tuner_select_band(frequencyMHz)
+        return {0x01:"VHF-L",0x02:"VHF-H",0x08:"UHF"}.get(bb,"gap")
+
+    def tv_tuner_wait_lock(self):
+        """Poll sync lock of the video decoder after tuning.
+        Status #1 is read every tunerPollInterval seconds, after tunerSettleMin seconds to let the
+        lock of the previous channel drop, until horizontal and vertical sync are locked for
+        tunerLockReads reads in a row or tunerSettleMax seconds passed.
+        Return (locked, settle time, number of status reads, last status #1).
+        """
+        t0=time.perf_counter()
+        deadline=t0+self.tunerSettleMax
+        time.sleep(self.tunerSettleMin)
+        locked=0
+        polls=0
+        while True :
+            status1=self.video_decoder_status(1)
+            polls+=1
+            if status1 & 0x06 == 0x06 :
+                locked+=1
+            else :
+                locked=0
+            now=time.perf_counter()
+            if locked >= self.tunerLockReads or now >= deadline :
+                break
+            time.sleep(min(self.tunerPollInterval,deadline-now))
+        return locked >= self.tunerLockReads,now-t0,polls,status1
+
+    def print_tuner_stats(self):
+        """Print settle time histograms of the tuner bands."""
+        for band in self.tunerSettleStats :
+            self.tunerSettleStats[band].print()
+
     def set_tv_tuner(self,frequencyMHz): 
-        """Set TV tuner."""
+        """Set TV tuner.
+        Returns as soon as the video decoder is locked, see tv_tuner_wait_lock; the settle
+        time is recorded in tunerSettleStats per band.
+        """
         self.tv_tuner_set_frequency(frequencyMHz)
-        time.sleep(0.5)
-        self.sbi_select_device(0x00ba) # TVP5150AM1 Chip
-        status1=self.video_decoder_status(1)
-        print("Video decoder status 1: 0x{s:02x} {b}".format(s=status1,b=utils.byte2bits(status1)))
-
-        self.vdVerticalSyncLocked=utils.get_bit(status1,2)
-        self.vdHorizontalSyncLocked=utils.get_bit(status1,1)
-        
-        if self.vdVerticalSyncLocked and self.vdHorizontalSyncLocked :
-            self.vdVideoDetected=True
-        else :
-            self.vdVideoDetected=False
+        locked,settle,polls,status1=self.tv_tuner_wait_lock()
+        band=self.tv_tuner_band_name(frequencyMHz)
+        if band not in self.tunerSettleStats :
+            self.tunerSettleStats[band]=TunerSettleStats(band)
+        self.tunerSettleStats[band].add(settle,polls,locked)
+        print("Tuner: {f:.2f} MHz, {b}, settled in {t:.0f} ms".format(f=frequencyMHz,b=band,t=1000*settle))
+        self.video_decoder_store_sync_status(status1)
     
-        self.sbi_select_device(0x0042)
-        self.sbi_select_device(0x0086)
-        self.sbi_write(0x0000,0x00d6)
-        self.sbi_write(0x0001,0x0070)
-        self.sbi_write(0x0002,0x0049)
+        self.run_programs(["tuner_if"])
         
         self.tvTunerFrequency=frequencyMHz
+        self.configured['tuner']=frequencyMHz
         return True
 
  
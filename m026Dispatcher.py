@@ -0,0 +1,123 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Device command dispatcher module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+"""
+
+import itertools
+import queue
+import threading
+import concurrent.futures
+
+#===============================================================================
+
+# Priorities of device operations, lower values run first
+PRIORITY_TUNE=0         # Tuning and video source switching
+PRIORITY_CAPTURE=1      # Capture control, capture frame, video standard and audio source
+PRIORITY_STATUS=2       # Status reads and everything else
+PRIORITY_COSMETIC=3     # Picture settings and the LED
+PRIORITY_STOP=4
+
+#===============================================================================
+
+class M026Dispatcher(object):
+    """Single owner thread of an M026Device.
+    Device operations submitted from any thread are queued by priority, in submission order
+    within a priority, and run one at a time on the dispatcher thread, so multi-step serial
+    bus sequences of different threads never interleave.
+    Operations submitted from the dispatcher thread itself run directly.
+    """
+
+    def __init__(self,m026):
+        self.m026=m026
+        self.queue=queue.PriorityQueue()
+        self.sequence=itertools.count()
+        self.thread=None
+
+    def start(self):
+        """Start the dispatcher thread."""
+        self.thread=threading.Thread(target=self.run,name="m026-dispatcher",daemon=True)
+        self.thread.start()
+
+    def stop(self,timeout=None):
+        """Run the queued operations and stop the dispatcher thread."""
+        if self.thread is None :
+            return
+        if threading.current_thread() is self.thread :
+            raise RuntimeError("M026Dispatcher.stop: called from the dispatcher thread")
+        self.queue.put((PRIORITY_STOP,next(self.sequence),None,None,None,None))
+        self.thread.join(timeout)
+        self.thread=None
+
+    def submit(self,priority,fn,*args,**kwargs):
+        """Queue fn(*args,**kwargs) and return a concurrent.futures.Future of its result."""
+        future=concurrent.futures.Future()
+        if threading.current_thread() is self.thread :
+            self.execute(future,fn,args,kwargs)
+        else :
+            self.queue.put((priority,next(self.sequence),future,fn,args,kwargs))
+        return future
+
+    def call(self,priority,fn,*args,**kwargs):
+        """Run fn(*args,**kwargs) on the dispatcher thread and return its result."""
+        return self.submit(priority,fn,*args,**kwargs).result()
+
+    def run(self):
+        while True :
+            priority,sequence,future,fn,args,kwargs=self.queue.get()
+            if future is None :
+                break
+            self.execute(future,fn,args,kwargs)
+
+    def execute(self,future,fn,args,kwargs):
+        if not future.set_running_or_notify_cancel() :
+            return
+        try:
+            future.set_result(fn(*args,**kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+#===============================================================================
+
+class M026DeviceProxy(object):
+    """Stands in for an M026Device: its methods run on the dispatcher thread, with the
+    priority given in PRIORITIES, and the caller waits for their results. Attributes are
+    read and set directly.
+    """
+    PRIORITIES={
+        "set_video_source":PRIORITY_TUNE,
+        "set_video_source_delta":PRIORITY_TUNE,
+        "set_tv_tuner":PRIORITY_TUNE,
+        "tv_tuner_set_frequency":PRIORITY_TUNE,
+        "vdi_start_capture":PRIORITY_CAPTURE,
+        "vdi_stop_capture":PRIORITY_CAPTURE,
+        "vdi_set_capture_frame":PRIORITY_CAPTURE,
+        "set_video_capture":PRIORITY_CAPTURE,
+        "set_audio_source":PRIORITY_CAPTURE,
+        "video_decoder_set_video_standard":PRIORITY_CAPTURE,
+        "video_decoder_set_brightness":PRIORITY_COSMETIC,
+        "video_decoder_set_contrast":PRIORITY_COSMETIC,
+        "video_decoder_set_hue":PRIORITY_COSMETIC,
+        "video_decoder_set_saturation":PRIORITY_COSMETIC,
+        "gpio_led":PRIORITY_COSMETIC,
+    }
+
+    def __init__(self,dispatcher):
+        object.__setattr__(self,"dispatcher",dispatcher)
+
+    def __getattr__(self,name):
+        attr=getattr(self.dispatcher.m026,name)
+        if not callable(attr) :
+            return attr
+        priority=self.PRIORITIES.get(name,PRIORITY_STATUS)
+        dispatcher=self.dispatcher
+        def call(*args,**kwargs):
+            return dispatcher.call(priority,attr,*args,**kwargs)
+        return call
+
+    def __setattr__(self,name,value):
+        setattr(self.dispatcher.m026,name,value)
@@ -538,15 +538,9 @@ class AppSettings(object):
             
     def set_v4l2_device(self,event):
         
-        self.streamer.terminate()
-        
-        self.streamDevice.frame_width=self.m026.videoCaptureSize.width
-        self.streamDevice.frame_height=self.m026.videoCaptureSize.height
-        self.streamDevice.pixel_format=PixelFormat.YUYV
-        self.streamDevice.set() 
+        # The running streamer reads the capture frame and sets the v4l2 format (SIGUSR1)
+        self.streamer.update(self.m026.videoCaptureSize.width,self.m026.videoCaptureSize.height)
         self.update_gui_frame_v4l2_settings(self)    
-        
-        self.streamer.start(self.m026.videoCaptureSize.width,self.m026.videoCaptureSize.height)
     
     def video_standard_selected(self,event):
         
@@ -555,7 +549,8 @@ class AppSettings(object):
         
         self.m026.vdVideoStandard=int(self.indexVideoStandard*2)
         self.m026.video_decoder_set_video_standard(self.m026.vdVideoStandard)
-        time.sleep(1)
+        # Status #5 is read as soon as the decoder locked to the new standard
+        self.m026.tv_tuner_wait_lock()
         self.m026.video_decoder_status_video_standard()
 
         # -- Video size class ---------
@@ -691,16 +686,13 @@ class AppSettings(object):
         #---------------------------------  
         
         self.vlcApp.videoPlayer.stop()
+        # The streamer keeps the device but stops streaming while the capture is restarted
+        self.streamer.pause()
         self.m026.vdi_stop_capture()
-    
-        self.streamer.terminate()
+        self.m026.vdi_start_capture()
         
+        # The streamer reads the new capture frame and resumes streaming
         self.set_v4l2_device(event=None)
-
-        self.streamer.start(self.captureWidth, self.captureHeight)
-
-        self.m026.get_video_capture()
-        self.m026.vdi_start_capture()
         
         #---------------------------------  
         
@@ -708,7 +700,6 @@ class AppSettings(object):
         print("Capture height:",self.m026.videoCaptureSize.height) 
     
         self.vlcApp.videoPlayer.play()
-        self.set_v4l2_device(event=None)
     
     # =============================================================================
     
@@ -0,0 +1,110 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Hotplug module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+"""
+
+import queue
+import threading
+import usb1 as usb
+
+from m026Device import *
+from m026Dispatcher import *
+
+#===============================================================================
+
+class M026Hotplug(object):
+    """Reattaches the device when it arrives on the bus again.
+    libusb hotplug events of the device are handled on an event thread using the USB context of
+    the device. Hotplug callbacks can't do synchronous USB transfers, so the events are handed to
+    the dispatcher which owns the device:
+      - left: M026Device.detach(), then the onLeft callbacks
+      - arrived: M026Device.reattach(), then the onArrived callbacks
+    The callbacks run on the dispatcher thread, e.g. to stop and relaunch the streamer.
+    With several devices attached, only the events of the device selected by M026Device.find()
+    are handled.
+    """
+
+    def __init__(self,dispatcher):
+        self.dispatcher=dispatcher
+        self.m026=dispatcher.m026
+        self.onArrived=[]
+        self.onLeft=[]
+        self.events=queue.Queue()
+        self.handle=None
+        self.thread=None
+        self.running=False
+        self.eventTimeout=0.5
+
+    def start(self):
+        """Register the hotplug callback and start the event thread.
+        Return False if libusb has no hotplug support on this platform.
+        """
+        if not usb.hasCapability(usb.CAP_HAS_HOTPLUG) :
+            print("Hotplug: not supported by libusb, the device isn't reattached")
+            return False
+        m026=self.m026
+        self.handle=m026.usbContext.hotplugRegisterCallback(self.hotplug,
+            events=usb.HOTPLUG_EVENT_DEVICE_ARRIVED|usb.HOTPLUG_EVENT_DEVICE_LEFT,
+            flags=0,vendor_id=m026.VENDOR_ID,product_id=m026.PRODUCT_ID)
+        self.running=True
+        self.thread=threading.Thread(target=self.run,name="m026-hotplug",daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Deregister the hotplug callback and stop the event thread."""
+        if self.thread is None :
+            return
+        self.running=False
+        self.thread.join()
+        self.thread=None
+        self.m026.usbContext.hotplugDeregisterCallback(self.handle)
+        self.handle=None
+
+    def hotplug(self,context,device,event):
+        """libusb hotplug callback, runs inside event handling."""
+        self.events.put((event,device))
+        return False
+
+    def run(self):
+        context=self.m026.usbContext
+        while self.running :
+            context.handleEventsTimeout(self.eventTimeout)
+            while not self.events.empty() :
+                event,device=self.events.get()
+                if event == usb.HOTPLUG_EVENT_DEVICE_LEFT :
+                    self.dispatcher.submit(PRIORITY_TUNE,self.left,device)
+                else :
+                    self.dispatcher.submit(PRIORITY_TUNE,self.arrived,device)
+
+    def left(self,device):
+        if not self.m026.device_is_current(device) :
+            return
+        print("Hotplug: AVerTV USB2.0 left")
+        self.release()
+
+    def release(self):
+        """Run the onLeft callbacks, then detach the device: the callbacks stop the users of the
+        handle, e.g. the capture engine cancels its transfers, before the handle is closed.
+        """
+        for callback in self.onLeft :
+            callback()
+        self.m026.detach()
+
+    def arrived(self,device):
+        if self.m026.usbDevh is not None or not self.m026.device_matches(device) :
+            return
+        print("Hotplug: AVerTV USB2.0 arrived")
+        try:
+            self.m026.reattach(device)
+        except (M026Error,usb.USBError) as e:
+            print("Hotplug: Reattaching failed:",e)
+            self.release()
+            return
+        for callback in self.onArrived :
+            callback()
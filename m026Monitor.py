@@ -0,0 +1,112 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Video decoder status monitor module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+"""
+
+import collections
+import threading
+import usb1 as usb
+
+from m026Device import *
+from m026Dispatcher import *
+
+#===============================================================================
+
+class M026Monitor(object):
+    """Samples the video decoder status of an M026Device every interval seconds.
+    A sample is a DecoderStatus - status #1 - #5 and the vertical line count - read by one
+    status operation on the dispatcher, so it never stalls the callers of the device. The
+    last samples are kept in a ring of size samples.
+    Callbacks, called on the monitor thread:
+      - onSample(sample): every sample
+      - onLockLost(sample), onLockGained(sample): sync lock changed
+      - onStandardChanged(previousStandard, sample): detected video standard changed
+    GUI callbacks should hand over to the GUI thread, e.g. with tkinter after().
+    Sampling is paused while the device is detached, and by pause() e.g. during a channel scan.
+    """
+
+    def __init__(self,dispatcher,interval=0.25,size=64):
+        self.dispatcher=dispatcher
+        self.m026=dispatcher.m026
+        self.interval=interval
+        self.samples=collections.deque(maxlen=size)
+        self.onSample=[]
+        self.onLockLost=[]
+        self.onLockGained=[]
+        self.onStandardChanged=[]
+        self.paused=False
+        self.running=False
+        self.thread=None
+        self.wakeup=threading.Event()
+
+    def start(self):
+        """Start the monitor thread."""
+        self.running=True
+        self.thread=threading.Thread(target=self.run,name="m026-monitor",daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the monitor thread. Call it before stopping the dispatcher."""
+        if self.thread is None :
+            return
+        self.running=False
+        self.wakeup.set()
+        self.thread.join()
+        self.thread=None
+
+    def pause(self):
+        self.paused=True
+
+    def resume(self):
+        """Resume sampling. The first sample after resuming doesn't report changes."""
+        self.samples.clear()
+        self.paused=False
+
+    def latest(self):
+        """Return the last sample, or None."""
+        return self.samples[-1] if self.samples else None
+
+    def history(self):
+        """Return the samples in the ring, oldest first."""
+        return list(self.samples)
+
+    def run(self):
+        while self.running :
+            if not self.paused and self.m026.usbDevh is not None :
+                self.sample()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def sample(self,force=False):
+        """Take a sample and report the changes since the previous one. While paused, a sample is
+        only taken if force, e.g. by a channel scan reading the status after each tuning itself.
+        """
+        try:
+            sample=self.dispatcher.call(PRIORITY_STATUS,self.m026.video_decoder_snapshot)
+        except (M026Error,usb.USBError) as e:
+            print("Monitor: Reading the video decoder status failed:",e)
+            self.samples.clear()
+            return None
+        if self.paused and not force :
+            return None
+        previous=self.latest()
+        self.samples.append(sample)
+        for callback in self.onSample :
+            callback(sample)
+        if previous is None :
+            return sample
+        if previous.locked and not sample.locked :
+            for callback in self.onLockLost :
+                callback(sample)
+        if sample.locked and not previous.locked :
+            for callback in self.onLockGained :
+                callback(sample)
+        if sample.standard != previous.standard :
+            for callback in self.onStandardChanged :
+                callback(previous.standard,sample)
+        return sample
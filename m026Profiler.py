@@ -0,0 +1,132 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Control transfer profiler module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+"""
+
+import csv
+import json
+import time
+
+#===============================================================================
+
+# Transfer methods, not reported as the caller of a transfer
+TRANSFER_METHODS=frozenset(["ctrl_tx","ctrl_rx","ctrl_rx_shadow","ctrl_tx_many","control","tx_flush","transaction"])
+
+#===============================================================================
+
+class M026Profiler(object):
+    """Records every control transfer of an M026Device through its ctrlHooks.
+    A record is (start, duration, direction, index, value, stack) where start is seconds since
+    the profiler started and stack the device methods on the call stack, outermost first.
+    Records are aggregated per operation - the outermost device method, e.g. set_video_source,
+    set_tv_tuner or vdi_set_capture_frame - and per caller - the innermost device method which
+    isn't a transfer method, e.g. sbi_write.
+    Usage:
+        profiler=M026Profiler(m026)
+        profiler.start()
+        m026.set_video_source(VIDEO_SOURCE_TV)
+        profiler.stop()
+        profiler.print()
+    """
+
+    def __init__(self,m026):
+        self.m026=m026
+        self.records=[]
+        self.t0=0.0
+
+    def start(self):
+        """Start recording control transfers."""
+        self.t0=time.perf_counter()
+        if self.record not in self.m026.ctrlHooks :
+            self.m026.ctrlHooks.append(self.record)
+
+    def stop(self):
+        """Stop recording control transfers."""
+        if self.record in self.m026.ctrlHooks :
+            self.m026.ctrlHooks.remove(self.record)
+
+    def reset(self):
+        self.records=[]
+        self.t0=time.perf_counter()
+
+    def record(self,direction,index,value,start,duration,stack):
+        """Control transfer hook of M026Device."""
+        self.records.append((start-self.t0,duration,direction,index,value,stack))
+
+    def operation(self,stack):
+        """Return the operation of a transfer: the outermost device method."""
+        return stack[0] if stack else "-"
+
+    def caller(self,stack):
+        """Return the caller of a transfer: the innermost device method which isn't a transfer method."""
+        for name in reversed(stack) :
+            if name not in TRANSFER_METHODS :
+                return name
+        return "-"
+
+    def summary(self):
+        """Return a list of dicts with transfers, reads, writes, total and maximum time per operation and caller."""
+        rows={}
+        for start,duration,direction,index,value,stack in self.records :
+            key=(self.operation(stack),self.caller(stack))
+            if key not in rows :
+                rows[key]={"operation":key[0],"caller":key[1],"transfers":0,"reads":0,"writes":0,"time":0.0,"max":0.0}
+            row=rows[key]
+            row["transfers"]+=1
+            row["reads" if direction == "r" else "writes"]+=1
+            row["time"]+=duration
+            row["max"]=max(row["max"],duration)
+        return sorted(rows.values(),key=lambda row:(row["operation"],-row["time"]))
+
+    def operations(self):
+        """Return transfers and total time per operation, as {operation: (transfers, time)}."""
+        totals={}
+        for row in self.summary() :
+            transfers,t=totals.get(row["operation"],(0,0.0))
+            totals[row["operation"]]=(transfers+row["transfers"],t+row["time"])
+        return totals
+
+    def print(self):
+        """Print the summary."""
+        print("Control transfers: {n}".format(n=len(self.records)))
+        totals=self.operations()
+        for row in self.summary() :
+            transfers,t=totals[row["operation"]]
+            print("{o:<28} {c:<32} {n:>6} {r:>6}r {w:>6}w {t:>10.3f} ms {x:>8.3f} ms".format(
+                o=row["operation"],c=row["caller"],n=row["transfers"],r=row["reads"],w=row["writes"],t=1000*row["time"],x=1000*row["max"]))
+        for operation in totals :
+            transfers,t=totals[operation]
+            print("{o:<28} {n:>6} transfers {t:>10.3f} ms".format(o=operation,n=transfers,t=1000*t))
+
+    def write_json(self,file):
+        """Write the summary and the per operation totals as JSON."""
+        totals=self.operations()
+        data={"transfers":len(self.records),
+              "operations":{o:{"transfers":n,"time":t} for o,(n,t) in totals.items()},
+              "summary":self.summary()}
+        with open(file,"w") as f:
+            json.dump(data,f,indent=2)
+
+    def write_csv(self,file):
+        """Write the records as CSV, one row per control transfer."""
+        with open(file,"w",newline="") as f:
+            w=csv.writer(f)
+            w.writerow(["start","duration","direction","index","value","operation","caller","stack"])
+            for start,duration,direction,index,value,stack in self.records :
+                w.writerow(["{s:.6f}".format(s=start),"{d:.6f}".format(d=duration),direction,"0x{i:03x}".format(i=index),
+                            "" if value is None else "0x{v:02x}".format(v=value),self.operation(stack),self.caller(stack),";".join(stack)])
+
+    def write_folded(self,file):
+        """Write folded stacks (stack;transfer microseconds per line) for flame graph tools."""
+        folded={}
+        for start,duration,direction,index,value,stack in self.records :
+            key=";".join(stack+("{d} 0x{i:03x}".format(d=direction,i=index),))
+            folded[key]=folded.get(key,0)+duration
+        with open(file,"w") as f:
+            for key in sorted(folded) :
+                f.write("{k} {t}\n".format(k=key,t=max(1,int(round(1e6*folded[key])))))
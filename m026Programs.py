@@ -0,0 +1,327 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Register programs module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+
+Register sequences of the device as data. A program is a list of operations:
+  ("ctrl", index, value)      Write a USB control register
+  ("ctrl_read", index)        Read a USB control register (from the register shadow if enabled)
+  ("select", address)         Select a serial bus device
+  ("sbi", register, value)    Write a register of the selected serial bus device
+  ("sbi_read", register)      Read a register of the selected serial bus device
+  ("ctrl_force", index, value)   Write a USB control register, never deduplicated
+  ("sbi_force", register, value) Write a register of the selected serial bus device, never deduplicated
+  ("program", name)           Include another program
+A register or value given as a name is a parameter, resolved when the programs are compiled.
+Forced writes are the sequencing writes the original driver repeats deliberately.
+"""
+
+import xml.etree.ElementTree as ET
+
+#===============================================================================
+
+PROGRAMS = {
+    # GPIO and remote wakeup
+    "gpio" : [
+        ("ctrl",0x000,0x28),    # GCTRL:GV
+        ("ctrl",0x002,0x68),    # GCTRL:GDIR
+        ("ctrl",0x00d,0x00),    # RMCTL:RWP Remote Wakeup Polarity (GPIO[9:8])
+        ("ctrl",0x00f,0x02)],   # RMCTL:RWC Remote Wakeup Control (GPIO[9:8])
+    # Timing generator
+    "timings" : [
+        ("ctrl",0x300,0x12),
+        ("ctrl",0x350,0x2d),
+        ("ctrl",0x351,0x01),
+        ("ctrl",0x352,0x00),
+        ("ctrl",0x353,0x00),
+        ("ctrl",0x300,0x80)],
+    "pll" : [
+        ("ctrl",0x018,0x10),    # PLLSO
+        ("ctrl",0x019,0x00)],
+    # Serial bus clock divider
+    "sbi_clock" : [
+        ("ctrl",0x202,0x1e)],   # SICTL:CD
+    # TVP5150AM1 video decoder
+    "decoder_init" : [
+        ("select",0xba),
+        ("sbi_read",0x82),
+        ("sbi",0x0f,0x0a),      # Configuration Shared Pins Register
+        ("sbi",0x30,0x01),      # 656 Revision Select Register: Adheres to ITU-R BT.656.3 timing
+        ("sbi",0x03,0x6f)],     # Miscellaneous Controls Register
+    "decoder_656" : [
+        ("select",0xba),
+        ("sbi",0x30,0x00)],     # 656 Revision Select Register: Adheres to ITU-R BT.656.4 and BT.656.5 timing (default)
+    "standard" : [
+        ("select",0xba),
+        ("sbi",0x28,"standard")],   # Video Standard Register
+    # Video input of the decoder; the TV input is selected after cycling through the others
+    "input_tv" : [
+        ("select",0xba),
+        ("sbi_read",0x03),
+        ("sbi",0x00,0x02),      # Video Input Source Selection #1 Register: Composite AIP1B
+        ("sbi_force",0x03,0x6f),
+        ("sbi_read",0x03),
+        ("sbi",0x00,0x01),      # S-Video AIP1A (luminance), AIP1B (chrominance)
+        ("sbi_force",0x03,0x2f),
+        ("sbi_read",0x03),
+        ("sbi",0x00,0x00),      # Composite AIP1A (default)
+        ("sbi_force",0x03,0x6f)],
+    "input_composite" : [
+        ("select",0xba),
+        ("sbi_read",0x03),
+        ("sbi",0x00,0x02),      # Composite AIP1B
+        ("sbi_force",0x03,0x6f)],
+    "input_svideo" : [
+        ("select",0xba),
+        ("sbi_read",0x03),
+        ("sbi",0x00,0x01),      # S-Video
+        ("sbi_force",0x03,0x0d)],
+    "input_select" : [
+        ("select",0xba),
+        ("sbi",0x00,"input"),
+        ("sbi",0x03,"misc")],
+    # Capture frame start and end positions (CFSPO, CFEPO)
+    "capture_frame" : [
+        ("ctrl",0x110,"stx_l"),
+        ("ctrl",0x111,"stx_h"),
+        ("ctrl",0x112,"sty_l"),
+        ("ctrl",0x113,"sty_h"),
+        ("ctrl",0x114,"enx_l"),
+        ("ctrl",0x115,"enx_h"),
+        ("ctrl",0x116,"eny_l"),
+        ("ctrl",0x117,"eny_h")],
+    "capture_start" : [
+        ("ctrl",0x100,0xb3)],   # DCTRL
+    "capture_stop" : [
+        ("ctrl",0x100,0x33)],
+    # Audio routes, GCTRL is read before each write and written as the original driver does
+    "audio_none" : [
+        ("ctrl_read",0x002),("ctrl_force",0x002,0xe8),
+        ("ctrl_read",0x003),("ctrl_force",0x003,0x01),
+        ("ctrl_read",0x000),("ctrl_force",0x000,0x1a),
+        ("ctrl_read",0x001),("ctrl_force",0x002,0x02)],
+    "audio_aux" : [
+        ("ctrl_read",0x002),("ctrl_force",0x002,0xe8),
+        ("ctrl_read",0x003),("ctrl_force",0x003,0x01),
+        ("ctrl_read",0x000),("ctrl_force",0x000,0x9a),
+        ("ctrl_read",0x001),("ctrl_force",0x001,0x02)],
+    "audio_tv_tuner" : [
+        ("ctrl_read",0x002),("ctrl_force",0x002,0xe8),
+        ("ctrl_read",0x003),("ctrl_force",0x003,0x01),
+        ("ctrl_read",0x000),("ctrl_force",0x000,0x1a),
+        ("ctrl_read",0x001),("ctrl_force",0x001,0x03)],
+    # LG TALN-M205T tuner
+    "tuner_frequency" : [
+        ("select",0x42),        # Slave address
+        ("select",0xc2),        # Subaddress
+        ("sbi","db1","db2"),    # Divider bytes
+        ("sbi",0x8e,"bb")],     # Control byte, band select byte
+    "tuner_if" : [
+        ("select",0x42),
+        ("select",0x86),
+        ("sbi",0x00,0xd6),
+        ("sbi",0x01,0x70),
+        ("sbi",0x02,0x49)],
+    # Common initialization of all video sources
+    "source_init" : [
+        ("program","gpio"),
+        ("program","timings"),
+        ("program","pll"),
+        ("program","sbi_clock"),
+        ("program","decoder_init")],
+    # Video sources, set_video_source sets the tuner and starts capture after them
+    "source_tv" : [
+        ("program","source_init"),
+        ("program","audio_none"),
+        ("program","input_tv"),
+        ("program","standard"),
+        ("program","decoder_656"),
+        ("program","capture_frame"),
+        ("program","audio_tv_tuner")],
+    "source_composite" : [
+        ("program","source_init"),
+        ("program","input_composite"),
+        ("program","standard"),
+        ("program","decoder_656"),
+        ("program","capture_frame"),
+        ("program","audio_aux")],
+    "source_svideo" : [
+        ("program","source_init"),
+        ("program","input_svideo"),
+        ("program","standard"),
+        ("program","decoder_656"),
+        ("program","capture_frame"),
+        ("program","audio_aux")],
+}
+
+# Names of the register and value fields of the operations in program files
+FIELDS = {
+    "ctrl" : ("index","value"),
+    "ctrl_read" : ("index",),
+    "select" : ("address",),
+    "sbi" : ("register","value"),
+    "sbi_read" : ("register",),
+    "ctrl_force" : ("index","value"),
+    "sbi_force" : ("register","value"),
+    "program" : ("name",),
+}
+
+# Upper limits of the register and value fields
+LIMITS = {
+    "ctrl" : (0xffff,0xff),
+    "ctrl_read" : (0xffff,),
+    "select" : (0xff,),
+    "sbi" : (0xff,0xff),
+    "sbi_read" : (0xff,),
+    "ctrl_force" : (0xffff,0xff),
+    "sbi_force" : (0xff,0xff),
+}
+
+#===============================================================================
+
+class RegisterProgramError(ValueError):
+    """A register program is invalid."""
+
+class RegisterPrograms(object):
+    """Named register programs, compiled into minimal ordered operation lists."""
+
+    def __init__(self):
+        self.programs=dict(PROGRAMS)
+        self.compiled={}
+        self.compiledMax=64
+
+    def read(self,file):
+        """Read programs from an XML file, replacing the programs with the same names."""
+        root=ET.parse(file).getroot()
+        for p in root.findall('program'):
+            ops=[]
+            for e in p :
+                if e.tag not in FIELDS :
+                    raise RegisterProgramError("{f}: program {p}: unknown operation {o}".format(f=file,p=p.get('name'),o=e.tag))
+                fields=[]
+                for f in FIELDS[e.tag] :
+                    v=e.get(f)
+                    if v is None :
+                        raise RegisterProgramError("{f}: program {p}: {o} has no {a}".format(f=file,p=p.get('name'),o=e.tag,a=f))
+                    if e.tag != "program" :
+                        try:
+                            v=int(v,0)
+                        except ValueError:
+                            pass
+                    fields.append(v)
+                ops.append(tuple([e.tag]+fields))
+            self.programs[p.get('name')]=ops
+        self.compiled={}
+        self.validate()
+
+    def write(self,file):
+        """Write the programs to an XML file."""
+        root=ET.Element("registerPrograms")
+        for name in self.programs :
+            p=ET.SubElement(root,"program",name=name)
+            for op in self.programs[name] :
+                attrs={}
+                for f,v in zip(FIELDS[op[0]],op[1:]) :
+                    attrs[f]=v if isinstance(v,str) else "0x{v:02x}".format(v=v)
+                ET.SubElement(p,op[0],attrs)
+        ET.indent(root)
+        ET.ElementTree(root).write(file,encoding="utf-8",xml_declaration=True)
+
+    def validate(self):
+        """Check operations, register and value ranges and program includes of all programs."""
+        for name in self.programs :
+            self.expand(name,{},[])
+
+    def expand(self,name,params,stack):
+        """Return the operations of a program with includes expanded and parameters resolved.
+        Parameters missing in params are left as names.
+        """
+        if name not in self.programs :
+            raise RegisterProgramError("Unknown program: {n}".format(n=name))
+        if name in stack :
+            raise RegisterProgramError("Recursive program: {s}".format(s=" > ".join(stack+[name])))
+        ops=[]
+        for op in self.programs[name] :
+            kind=op[0]
+            if kind not in FIELDS or len(op) != len(FIELDS[kind])+1 :
+                raise RegisterProgramError("Program {n}: invalid operation {o}".format(n=name,o=op))
+            if kind == "program" :
+                ops+=self.expand(op[1],params,stack+[name])
+                continue
+            args=[]
+            for v,limit in zip(op[1:],LIMITS[kind]) :
+                if isinstance(v,str) :
+                    v=params.get(v,v)
+                if not isinstance(v,str) and not 0 <= v <= limit :
+                    raise RegisterProgramError("Program {n}: {o} out of range".format(n=name,o=op))
+                args.append(v)
+            ops.append(tuple([kind]+args))
+        return ops
+
+    def state(self,names,params):
+        """Return the register state programs leave behind:
+        ({control register: value}, {(serial bus address, register): value}).
+        """
+        ctrl={}
+        sbi={}
+        selected=None
+        for name in names :
+            for op in self.expand(name,params,[]) :
+                if op[0] in ("ctrl","ctrl_force") :
+                    ctrl[op[1]]=op[2]
+                elif op[0] == "select" :
+                    selected=op[1]
+                elif op[0] in ("sbi","sbi_force") :
+                    sbi[(selected,op[1])]=op[2]
+        return ctrl,sbi
+
+    def compile(self,names,params,volatile=(),tracked=None):
+        """Merge programs into one ordered operation list without redundant operations.
+        Writes of a value a register already got earlier in the list and selects of the
+        selected serial bus device are dropped; reads, value changes and forced writes are kept
+        in order.
+        volatile are control registers never deduplicated, tracked(address,register) tells
+        if writes to a serial bus device register can be deduplicated.
+        """
+        key=(tuple(names),tuple(sorted(params.items())))
+        if key in self.compiled :
+            return self.compiled[key]
+        ops=[]
+        for name in names :
+            ops+=self.expand(name,params,[])
+        ctrl={}
+        sbi={}
+        selected=None
+        merged=[]
+        for op in ops :
+            kind=op[0]
+            for v in op[1:] :
+                if isinstance(v,str) :
+                    raise RegisterProgramError("Program parameter {v} isn't given".format(v=v))
+            if kind == "ctrl" :
+                if op[1] not in volatile :
+                    if ctrl.get(op[1]) == op[2] :
+                        continue
+                    ctrl[op[1]]=op[2]
+            elif kind == "select" :
+                if selected == op[1] :
+                    continue
+                selected=op[1]
+            elif kind == "sbi" :
+                if tracked is not None and tracked(selected,op[1]) :
+                    if sbi.get((selected,op[1])) == op[2] :
+                        continue
+                    sbi[(selected,op[1])]=op[2]
+            elif kind == "ctrl_force" :
+                ctrl[op[1]]=op[2]
+            elif kind == "sbi_force" :
+                sbi[(selected,op[1])]=op[2]
+            merged.append(op)
+        if len(self.compiled) >= self.compiledMax :
+            self.compiled={}
+        self.compiled[key]=merged
+        return merged
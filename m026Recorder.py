@@ -0,0 +1,135 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Control transfer record and replay module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+
+Log format (little endian):
+  header  8s d      magic b"M026LOG1", wall clock time of the start of the recording
+  record  i I B H B start (microseconds after the start of the previous record), duration (microseconds),
+                    direction (0: write, 1: read), register index, value written or read
+"""
+
+import struct
+import time
+
+from m026Device import *
+
+#===============================================================================
+
+LOG_MAGIC=b"M026LOG1"
+LOG_HEADER=struct.Struct("<8sd")
+LOG_RECORD=struct.Struct("<iIBHB")
+
+def read_log(file):
+    """Return the wall clock start time and the records (start, duration, direction, index, value)
+    of a log, start and duration in seconds, start relative to the start of the recording.
+    """
+    with open(file,"rb") as f:
+        data=f.read()
+    magic,wallTime=LOG_HEADER.unpack_from(data,0)
+    if magic != LOG_MAGIC :
+        raise ValueError("{f} is not a control transfer log".format(f=file))
+    records=[]
+    start=0
+    for delta,duration,direction,index,value in LOG_RECORD.iter_unpack(data[LOG_HEADER.size:]) :
+        start+=delta
+        records.append((start/1e6,duration/1e6,"r" if direction else "w",index,value))
+    return wallTime,records
+
+#===============================================================================
+
+class M026Recorder(object):
+    """Records the control transfers of an M026Device to a log file through its ctrlHooks.
+    Usage:
+        recorder=M026Recorder(m026)
+        recorder.start("session.m026log")
+        ...
+        recorder.stop()
+    """
+
+    def __init__(self,m026):
+        self.m026=m026
+        self.file=None
+        self.t0=0.0
+        self.previous=0
+        self.count=0
+
+    def start(self,file):
+        """Start recording to file."""
+        self.file=open(file,"wb")
+        self.file.write(LOG_HEADER.pack(LOG_MAGIC,time.time()))
+        self.t0=time.perf_counter()
+        self.previous=0
+        self.count=0
+        self.m026.ctrlHooks.append(self.record)
+
+    def stop(self):
+        """Stop recording and close the log file."""
+        if self.record in self.m026.ctrlHooks :
+            self.m026.ctrlHooks.remove(self.record)
+        if self.file :
+            self.file.close()
+            self.file=None
+
+    def record(self,direction,index,value,start,duration,stack):
+        """Control transfer hook of M026Device."""
+        start=int(1e6*(start-self.t0))
+        self.file.write(LOG_RECORD.pack(start-self.previous,int(1e6*duration),direction == "r",index,value or 0))
+        self.previous=start
+        self.count+=1
+
+#===============================================================================
+
+class M026Replayer(object):
+    """Replays a control transfer log on the handle of an M026Device, a real or a simulated device.
+    Writes are written as recorded. Reads are done and compared with the recorded values; a read of
+    the serial bus status (SICTL+1) is repeated until it returns the recorded value or syncTimeout
+    seconds passed, so serial bus transfers complete as they did in the recording even if the
+    replay is faster.
+    Timing modes: "fast" (as fast as possible) or "original" (each transfer at its recorded time).
+    """
+
+    def __init__(self,m026):
+        self.m026=m026
+        self.syncTimeout=0.1
+        self.transfers=0
+        self.mismatches=0
+        self.polls=0
+        self.elapsed=0.0
+
+    def replay(self,file,timing="fast"):
+        """Replay a log. Return the elapsed time in seconds."""
+        if timing not in ("fast","original") :
+            raise ValueError("Unknown timing mode: {t}".format(t=timing))
+        wallTime,records=read_log(file)
+        h=self.m026.usbDevh
+        self.transfers=0
+        self.mismatches=0
+        self.polls=0
+        t0=time.perf_counter()
+        for start,duration,direction,index,value in records :
+            if timing == "original" :
+                wait=t0+start-time.perf_counter()
+                if wait > 0 :
+                    time.sleep(wait)
+            self.transfers+=1
+            if direction == "w" :
+                h.controlWrite(0x40,1,value,index,[])
+                continue
+            r=h.controlRead(0xc0,0,0x0000,index,1)[0]
+            if index == dc1100.SICTL+1 and value in (0x01,0x04) :
+                deadline=time.perf_counter()+self.syncTimeout
+                while r != value and time.perf_counter() < deadline :
+                    r=h.controlRead(0xc0,0,0x0000,index,1)[0]
+                    self.polls+=1
+            if r != value :
+                self.mismatches+=1
+        self.elapsed=time.perf_counter()-t0
+        return self.elapsed
+
+    def print(self):
+        print("Replay: {n} transfers in {t:.3f} s, {m} read mismatches, {p} extra status polls".format(n=self.transfers,t=self.elapsed,m=self.mismatches,p=self.polls))
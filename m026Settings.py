@@ -9,12 +9,20 @@ License:    GPL v2
 """
 
 import os
+import copy
 import platform
 import xml.etree.ElementTree as ET
         
 class Settings():
-    def __init__(self):
+    """Application settings.
+    With several devices, each device has its own settings section <device id="..."> in the
+    settings file, selected by the device id (bus-port path or serial number, see
+    M026Device.device_id). Without a device id the top level settings are used.
+    """
+    def __init__(self,device=None):
+        self.device=device
         self.fileSettings="tvM026-settings.xml"    
+        self.filePrograms="tvM026-programs.xml"
         self.guiVideoHeight=640
         self.guiVideoAspectRatio=16/9
         self.vlcCropLeft=10
@@ -50,6 +58,10 @@ class Settings():
     def read (self,file):
         tree=ET.parse(file)
         root=tree.getroot()
+        if self.device is not None :
+            section=self.find_section(root)
+            if section is not None :
+                root=section
         self.v4l2Device=root.find('v4l2_device').text  
         self.audioSource=root.find('audio_source').text
         if self.audioSource=='None' :
@@ -77,6 +89,33 @@ class Settings():
         self.m026CompositeCaptureEndX=int(root.find('m026_composite_capture_end_x').text)
         self.m026CompositeCaptureEndY=int(root.find('m026_composite_capture_end_y').text)
         
+    def find_section(self,root):
+        """Return the settings section of the device, or None."""
+        for section in root.findall("device") :
+            if section.get("id") == self.device :
+                return section
+        return None
+
+    def merge(self,file,element):
+        """Return the settings tree to write with element as the top level settings, or as the
+        section of the device, keeping the other sections of file.
+        """
+        previous=ET.parse(file).getroot() if os.path.exists(file) else None
+        if self.device is None :
+            if previous is not None :
+                element.extend(previous.findall("device"))
+            return element
+        element.tag="device"
+        element.set("id",self.device)
+        if previous is None :
+            previous=ET.Element("settings")
+            previous.extend(copy.deepcopy(list(element)))
+        section=self.find_section(previous)
+        if section is not None :
+            previous.remove(section)
+        previous.append(element)
+        return previous
+
     def write(self,file):
         root = ET.Element("settings")
         r=ET.SubElement(root,"v4l2_device").text="{}".format(self.v4l2Device)
@@ -104,7 +143,7 @@ class Settings():
         r=ET.SubElement(root,"m026_svideo_capture_end_x").text="{}".format(self.m026SVideoCaptureEndX)
         r=ET.SubElement(root,"m026_svideo_capture_end_y").text="{}".format(self.m026SVideoCaptureEndY)
         
-        tree = ET.ElementTree(root)
+        tree = ET.ElementTree(self.merge(file,root))
         tree.write(file,encoding="utf-8", xml_declaration=True)
         from shutil import which
         if which('xml') :
@@ -117,6 +156,8 @@ class Settings():
 
     def print(self):
         print("Application Settings:")
+        if self.device is not None :
+            print(" Device:",self.device)
         print(" v4l2 loopback device:",self.v4l2Device)
         print(" Audio player source:",self.audioSource)
         print(" Audio source volume:","{v:.2f}".format(v=self.audioSourceVolume))
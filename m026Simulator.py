@@ -0,0 +1,408 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Simulated device module
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+
+A usb1 compatible simulation of the AVerMedia AVerTV USB2.0 (07ca:0026) for runs without the device:
+    m026=M026Device()
+    m026.usbContext=SimulatedContext(SimulatedDevice(lockFrequencies=[189.25,503.25]))
+    m026.find()
+    m026.open()
+"""
+
+import time
+import usb1 as usb
+
+#===============================================================================
+
+# Registers of the CT-DC1100 controller used by the serial bus state machine
+SICTL=0x200
+SBUSW=0x204
+SBUSR=0x208
+
+# Serial bus addresses
+TVP5150=0xba
+TUNER_PLL=0xc2
+TUNER_IF=0x86
+
+# Status #5 video standard codes of the TVP5150AM1 for the Video Standard Register values
+# (NTSC M/J, PAL B/G/H/I/N, PAL M, PAL Nc, NTSC 4.43, SECAM)
+STANDARD_CODES={0x02:1,0x04:3,0x06:5,0x08:7,0x0a:9,0x0c:11}
+STANDARD_LINES={0x02:525,0x04:625,0x06:525,0x08:625,0x0a:525,0x0c:625}
+
+#===============================================================================
+
+class SimulatedTransfer(object):
+    """Asynchronous control transfer of a SimulatedDeviceHandle."""
+
+    def __init__(self,handle):
+        self.handle=handle
+        self.status=None
+        self.buffer=b''
+        self.actualLength=0
+
+    def setControl(self,request_type,request,value,index,buffer_or_len,callback=None,user_data=None,timeout=0):
+        self.requestType=request_type
+        self.request=request
+        self.value=value
+        self.index=index
+        self.length=buffer_or_len if isinstance(buffer_or_len,int) else len(buffer_or_len)
+        self.callback=callback
+        self.userData=user_data
+
+    def submit(self):
+        self.handle.submit(self)
+
+    def isSubmitted(self):
+        return self in self.handle.pending
+
+    def cancel(self):
+        """Cancel the transfer; the callback is called at once with TRANSFER_CANCELLED."""
+        if self not in self.handle.pending :
+            raise usb.USBErrorNotFound
+        self.handle.pending.remove(self)
+        self.status=usb.TRANSFER_CANCELLED
+        if self.callback :
+            self.callback(self)
+
+    def getStatus(self):
+        return self.status
+
+    def getUserData(self):
+        return self.userData
+
+    def getBuffer(self):
+        return self.buffer
+
+    def getActualLength(self):
+        return self.actualLength
+
+class SimulatedDeviceHandle(object):
+    """usb1.USBDeviceHandle of a SimulatedDevice: control transfers to its register file."""
+
+    def __init__(self,device):
+        self.device=device
+        self.pending=[]
+
+    def controlWrite(self,request_type,request,value,index,data,timeout=0):
+        self.device.transfer_wait()
+        self.device.write(index,value)
+        return 0
+
+    def controlRead(self,request_type,request,value,index,length,timeout=0):
+        self.device.transfer_wait()
+        return bytes([self.device.read(index)])
+
+    def getTransfer(self,iso_packets=0):
+        return SimulatedTransfer(self)
+
+    def submit(self,transfer):
+        if not self.device.plugged :
+            raise usb.USBErrorNoDevice()
+        transfer.due=time.perf_counter()+self.device.transferLatency
+        self.pending.append(transfer)
+
+    def complete(self,transfer):
+        """Do a submitted transfer and call its callback."""
+        device=self.device
+        if not device.plugged :
+            transfer.status=usb.TRANSFER_NO_DEVICE
+        elif transfer.requestType & 0x80 :
+            transfer.buffer=bytes([device.read(transfer.index)])
+            transfer.actualLength=1
+            transfer.status=usb.TRANSFER_COMPLETED
+        else :
+            device.write(transfer.index,transfer.value)
+            transfer.actualLength=0
+            transfer.status=usb.TRANSFER_COMPLETED
+        if transfer.callback :
+            transfer.callback(transfer)
+
+    def resetDevice(self):
+        self.device.reset()
+
+    def close(self):
+        self.pending=[]
+        if self in self.device.handles :
+            self.device.handles.remove(self)
+
+class SimulatedDevice(object):
+    """Simulated CT-DC1100 with a TVP5150AM1 video decoder and an LG TALN-M205T tuner.
+    - DC1100 register file; writing SICTL starts a serial bus write (0x05) or read (0x20) which
+      completes after sbiWriteDelay / sbiReadDelay seconds (SICTL+1: 0x04 / 0x01, 0x00 while busy).
+      Transfers to an address without a device never complete.
+    - TVP5150AM1 registers; status #1 - #5 (0x88-0x8c) and the vertical line count (0x84/0x85)
+      follow the selected input, the video standard and the signal on the input.
+    - Tuner PLL (divider and control bytes) and IF demodulator registers; the tuner locks on the
+      frequencies in lockFrequencies, tunerSettleTime seconds after tuning.
+    - Every control transfer takes transferLatency seconds; asynchronous transfers overlap.
+    """
+
+    def __init__(self,lockFrequencies=(),tunerSettleTime=0.15,sbiWriteDelay=0.0003,sbiReadDelay=0.0003,transferLatency=0.0001):
+        self.vendorID=0x07ca
+        self.productID=0x0026
+        self.busNumber=1
+        self.portNumber=1
+        self.deviceAddress=2
+        self.serialNumber=""
+        self.lockFrequencies=list(lockFrequencies)
+        self.tunerSettleTime=tunerSettleTime
+        self.sbiWriteDelay=sbiWriteDelay
+        self.sbiReadDelay=sbiReadDelay
+        self.transferLatency=transferLatency
+        self.compositeSignal=True
+        self.sVideoSignal=True
+        self.signalStandard=0x04
+        self.plugged=True
+        self.handles=[]
+        self.reset()
+
+    def reset(self):
+        """Power on state."""
+        self.registers=bytearray(0x400)
+        self.sbiBusy=None
+        self.sbiDone=0
+        self.sbiDevices={TVP5150:bytearray(0x100),TUNER_PLL:{},TUNER_IF:bytearray(0x100)}
+        decoder=self.sbiDevices[TVP5150]
+        decoder[0x03]=0x01
+        decoder[0x80]=0x51  # Device ID
+        decoder[0x81]=0x50
+        decoder[0x82]=0x04  # ROM version
+        decoder[0x83]=0x00
+        self.tunerFrequency=None
+        self.tunerTuned=0.0
+        self.writes=0
+        self.reads=0
+
+    # usb1.USBDevice
+
+    def getVendorID(self):
+        return self.vendorID
+
+    def getProductID(self):
+        return self.productID
+
+    def getBusNumber(self):
+        return self.busNumber
+
+    def getPortNumber(self):
+        return self.portNumber
+
+    def getPortNumberList(self):
+        return [self.portNumber]
+
+    def getDeviceAddress(self):
+        return self.deviceAddress
+
+    def getSerialNumberDescriptor(self):
+        return 3 if self.serialNumber else 0
+
+    def getSerialNumber(self):
+        return self.serialNumber
+
+    def open(self):
+        if not self.plugged :
+            raise usb.USBErrorNoDevice()
+        handle=SimulatedDeviceHandle(self)
+        self.handles.append(handle)
+        return handle
+
+    # Register file
+
+    def transfer_wait(self):
+        if not self.plugged :
+            raise usb.USBErrorNoDevice()
+        if self.transferLatency :
+            time.sleep(self.transferLatency)
+
+    def write(self,index,value):
+        self.writes+=1
+        self.registers[index]=value&0xff
+        if index == SICTL :
+            if value & 0x20 :
+                self.sbiBusy=(time.perf_counter()+self.sbiReadDelay,0x01)
+            elif value & 0x01 :
+                self.sbiBusy=(time.perf_counter()+self.sbiWriteDelay,0x04)
+            self.sbiDone=0x00
+
+    def read(self,index):
+        self.reads+=1
+        if index == SICTL+1 :
+            self.sbi_update()
+            return self.sbiDone
+        return self.registers[index]
+
+    def sbi_update(self):
+        """Complete a serial bus transfer whose time has come."""
+        if self.sbiBusy is None or time.perf_counter() < self.sbiBusy[0] :
+            return
+        done=self.sbiBusy[1]
+        self.sbiBusy=None
+        address=self.registers[SICTL+3]
+        if address not in self.sbiDevices :
+            return  # No acknowledge
+        if done == 0x04 :
+            self.sbi_write(address,self.registers[SBUSW],self.registers[SBUSW+1])
+        else :
+            self.registers[SBUSR+1]=self.sbi_read(address,self.registers[SBUSR])
+        self.sbiDone=done
+
+    # Serial bus devices
+
+    def sbi_write(self,address,ra,value):
+        if address == TUNER_PLL :
+            if ra == 0x8e :
+                self.sbiDevices[TUNER_PLL]['bb']=value
+            else :
+                self.tunerFrequency=(((ra<<8)|value)-618)/16
+                self.tunerTuned=time.perf_counter()
+            return
+        self.sbiDevices[address][ra]=value
+
+    def sbi_read(self,address,ra):
+        if address == TUNER_PLL :
+            return 0x40 if self.tuner_locked() else 0x00   # Status byte: FL (PLL lock)
+        if address == TVP5150 :
+            return self.decoder_read(ra)
+        return self.sbiDevices[address][ra]
+
+    def tuner_locked(self):
+        """Return True if the tuner is tuned to a lock frequency and settled."""
+        if self.tunerFrequency is None :
+            return False
+        if time.perf_counter()-self.tunerTuned < self.tunerSettleTime :
+            return False
+        for f in self.lockFrequencies :
+            if abs(f-self.tunerFrequency) < 0.0625 :
+                return True
+        return False
+
+    def decoder_signal(self):
+        """Return True if there is a signal on the selected input of the video decoder."""
+        decoder=self.sbiDevices[TVP5150]
+        if decoder[0x00] == 0x00 :
+            return self.tuner_locked()
+        if decoder[0x00] == 0x02 :
+            return self.compositeSignal
+        return self.sVideoSignal
+
+    def decoder_standard(self):
+        """Return the video standard (Video Standard Register value) and if it was autoswitched."""
+        standard=self.sbiDevices[TVP5150][0x28]
+        if standard in STANDARD_CODES :
+            return standard,False
+        return self.signalStandard,True
+
+    def decoder_read(self,ra):
+        decoder=self.sbiDevices[TVP5150]
+        signal=self.decoder_signal()
+        standard,autoswitched=self.decoder_standard()
+        if ra == 0x84 :
+            return STANDARD_LINES[standard]>>8 if signal else 0
+        if ra == 0x85 :
+            return STANDARD_LINES[standard]&0xff if signal else 0
+        if ra == 0x88 :
+            return 0x6e if signal else 0x00   # Status #1: color subcarrier, vertical and horizontal sync locked
+        if ra == 0x89 or ra == 0x8a or ra == 0x8b :
+            return 0x00
+        if ra == 0x8c :
+            return STANDARD_CODES[standard] | (0x80 if autoswitched else 0x00)
+        return decoder[ra]
+
+#===============================================================================
+
+class SimulatedContext(object):
+    """usb1.USBContext with simulated devices.
+    unplug() and plug() simulate the device leaving and arriving, delivered to hotplug
+    callbacks by the next event handling.
+    """
+
+    def __init__(self,*devices):
+        self.devices=list(devices) or [SimulatedDevice()]
+        self.hotplugCallbacks={}
+        self.hotplugHandle=0
+        self.hotplugEvents=[]
+
+    def getDeviceList(self,skip_on_access_error=False,skip_on_error=False):
+        return [d for d in self.devices if d.plugged]
+
+    def getByVendorIDAndProductID(self,vendor_id,product_id,skip_on_access_error=False,skip_on_error=False):
+        for d in self.getDeviceList() :
+            if d.getVendorID() == vendor_id and d.getProductID() == product_id :
+                return d
+        return None
+
+    def openByVendorIDAndProductID(self,vendor_id,product_id,skip_on_access_error=False,skip_on_error=False):
+        d=self.getByVendorIDAndProductID(vendor_id,product_id)
+        return d.open() if d else None
+
+    def handleEvents(self):
+        """Complete the submitted transfers, waiting for the first one if none is due yet."""
+        self.handleEventsTimeout(None)
+
+    def handleEventsTimeout(self,tv=0):
+        """Deliver hotplug events and complete the due transfers, waiting up to tv seconds (None: no limit)."""
+        while self.hotplugEvents :
+            device,event=self.hotplugEvents.pop(0)
+            for handle,callback in list(self.hotplugCallbacks.items()) :
+                if callback(self,device,event) :
+                    del self.hotplugCallbacks[handle]
+        handles=[h for d in self.devices for h in d.handles if h.pending]
+        if not handles :
+            if tv :
+                time.sleep(tv)
+            return
+        due=min(t.due for h in handles for t in h.pending)
+        wait=due-time.perf_counter()
+        if wait > 0 :
+            if tv is not None and tv < wait :
+                time.sleep(tv)
+                return
+            time.sleep(wait)
+        now=time.perf_counter()
+        for h in handles :
+            transfers=[t for t in h.pending if t.due <= now]
+            h.pending=[t for t in h.pending if t.due > now]
+            for t in transfers :
+                h.complete(t)
+
+    def getPollFDList(self):
+        return []
+
+    def setPollFDNotifiers(self,added_cb=None,removed_cb=None,user_data=None):
+        pass
+
+    def getNextTimeout(self):
+        """Return seconds until the next submitted transfer is due, None if there is none."""
+        due=[t.due for d in self.devices for h in d.handles for t in h.pending]
+        if not due :
+            return None
+        return max(0.0,min(due)-time.perf_counter())
+
+    def hotplugRegisterCallback(self,callback,events=usb.HOTPLUG_EVENT_DEVICE_ARRIVED|usb.HOTPLUG_EVENT_DEVICE_LEFT,flags=0,vendor_id=-1,product_id=-1,dev_class=-1):
+        # Handles aren't reused, as in libusb: a handle stays unique after others are deregistered
+        self.hotplugHandle+=1
+        handle=self.hotplugHandle
+        self.hotplugCallbacks[handle]=callback
+        return handle
+
+    def hotplugDeregisterCallback(self,handle):
+        self.hotplugCallbacks.pop(handle,None)
+
+    def unplug(self,device=None):
+        """Simulate the device leaving the bus."""
+        device=device or self.devices[0]
+        device.plugged=False
+        self.hotplugEvents.append((device,usb.HOTPLUG_EVENT_DEVICE_LEFT))
+
+    def plug(self,device=None):
+        """Simulate the device arriving on the bus, in its power on state."""
+        device=device or self.devices[0]
+        device.reset()
+        device.deviceAddress+=1
+        device.plugged=True
+        self.hotplugEvents.append((device,usb.HOTPLUG_EVENT_DEVICE_ARRIVED))
@@ -50,26 +50,917 @@ class StreamDevice(object):
 
 
 import os
+import re
+import sys
+import time
 import signal
+import collections
+import threading
+import subprocess
 from subprocess import check_output
 
 class Streamer(object):
-    def __init__(self,streamer,streamDevice):
+    """Runs m026-streamer as a child process writing to the v4l2 loopback device streamDevice.
+    The stderr output of the streamer is read by a thread: it is echoed, the last lines are kept
+    in log and the capture geometry the streamer reports is parsed to width and height.
+    A streamer left running by a previous session can be adopted: it is signalled and stopped as
+    the own one, but its output and exit status aren't known.
+    """
+
+    GEOMETRY=re.compile(r"\* m026: (Width|Height): (\d+)")
+    FORMAT_FAILED="Setting v4l2 stream data format failed"
+
+    def __init__(self,streamer,streamDevice,usbBus=None,usbPort=None,usbSerial=None):
         self.streamer=streamer
         self.streamDevice=streamDevice
+        # Device selection of the streamer, None streams from the first device
+        self.usbBus=usbBus
+        self.usbPort=usbPort
+        self.usbSerial=usbSerial
+        self.process=None
+        self.orphanPid=None
+        self.reader=None
+        self.log=collections.deque(maxlen=100)
+        self.width=None
+        self.height=None
+        self.formatFailed=False
+        # Set when the streamer reported its capture geometry
+        self.ready=threading.Event()
+        self.stopping=False
+
     def get_pid(self):
+        """Return the pid of the streamer while it runs, the started or the adopted one."""
+        if self.process is not None :
+            return self.process.pid if self.process.poll() is None else None
+        if self.orphanPid is not None and pid_alive(self.orphanPid) :
+            return self.orphanPid
+        return None
+
+    def find_pid(self):
+        """Return the pid of a streamer writing to streamDevice not started by this Streamer,
+        e.g. left running by a previous session.
+        """
         try:
-            pid=int(check_output(["pidof",self.streamer]))
+            pid=int(check_output(["pgrep","-n","-f","{s} -d {d} ".format(s=self.streamer,d=self.streamDevice)]))
         except:
             pid=None
         return pid
-    
-    def terminate(self):
+
+    def adopt(self):
+        """Adopt the streamer of a previous session writing to streamDevice. Return its pid, or None."""
+        if self.process is None :
+            self.orphanPid=self.find_pid()
+        return self.get_pid()
+
+    @property
+    def returncode(self):
+        """Exit status of the last streamer, None while it runs or if none was started."""
+        if self.process is None :
+            return None
+        return self.process.poll()
+
+    def terminate(self,timeout=2.0):
+        """Stop the streamer, see stop(). A streamer of a previous session is adopted and stopped."""
+        if self.process is None :
+            self.adopt()
+        return self.stop(timeout)
+
+    def stop(self,timeout=2.0):
+        """Send SIGTERM to the streamer and wait up to timeout seconds for it to release the device
+        and exit, kill it after that. Return its exit status, None for an adopted streamer.
+        """
+        if self.process is None :
+            self.stop_orphan(timeout)
+            return None
+        self.stopping=True
+        if self.process.poll() is None :
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                print("Streamer: No exit in {t} s, killing it".format(t=timeout))
+                self.process.kill()
+                self.process.wait()
+        self.reader.join()
+        self.stopping=False
+        return self.process.returncode
+
+    def stop_orphan(self,timeout=2.0):
+        """Stop the adopted streamer as stop() does. It isn't a child of this process, so its exit
+        is polled.
+        """
+        pid=self.orphanPid
+        self.orphanPid=None
+        if pid is None :
+            return
+        try:
+            os.kill(pid,signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        if not pid_wait(pid,timeout) :
+            print("Streamer: No exit in {t} s, killing it".format(t=timeout))
+            try:
+                os.kill(pid,signal.SIGKILL)
+            except ProcessLookupError:
+                return
+            pid_wait(pid,timeout)
+
+    def pause(self):
+        """Stop streaming, keeping the device (SIGUSR2)."""
+        self.signal(signal.SIGUSR2)
+
+    def resume(self):
+        """Resume streaming; the streamer also reads the capture geometry again (SIGUSR1)."""
+        self.signal(signal.SIGUSR1)
+
+    def update(self,width,height,timeout=2.0):
+        """Make the streamer stream the capture frame set on the device, width x height.
+        The running streamer reads the geometry again (SIGUSR1); if it doesn't report width x height
+        in timeout seconds it is restarted. An adopted streamer reports nothing: it is restarted.
+        Return True if the streamer reports width x height.
+        """
+        if self.process is None or self.get_pid() is None :
+            self.start(width,height)
+            return self.wait_ready(timeout)
+        self.ready.clear()
+        self.formatFailed=False
+        self.resume()
+        if self.wait_ready(timeout) and (self.width,self.height) == (width,height) :
+            return True
+        print("Streamer: Capture update failed, restarting the streamer")
+        self.stop()
+        self.start(width,height)
+        return self.wait_ready(timeout)
+
+    def signal(self,signum):
         pid=self.get_pid()
-        if pid:
-            os.kill(pid,signal.SIGTERM)    
+        if pid :
+            os.kill(pid,signum)
+
+    def wait_ready(self,timeout=2.0):
+        """Wait up to timeout seconds until the streamer reported its capture geometry. Return True
+        if it did and set the v4l2 format.
+        """
+        return self.ready.wait(timeout) and not self.formatFailed
+
+    def device_options(self):
+        """Return the device selection options of the streamer."""
+        options=[]
+        if self.usbBus is not None :
+            options+=["-b",str(self.usbBus)]
+        if self.usbPort is not None :
+            options+=["-p",self.usbPort]
+        if self.usbSerial is not None :
+            options+=["-s",self.usbSerial]
+        return options
 
     def start(self,width,height):
-        cmd="{s} -d {d} -w {w} -h {h} &".format(s=self.streamer,d=self.streamDevice, w=width, h=height)
-        os.system(cmd) 
-        print("Command executed:",cmd)
+        """Start the streamer, stopping the running or adopted one."""
+        if self.get_pid() is not None :
+            self.stop()
+        cmd=[self.streamer,"-d",self.streamDevice,"-w",str(width),"-h",str(height)]+self.device_options()
+        self.ready.clear()
+        self.formatFailed=False
+        self.width=None
+        self.height=None
+        self.process=subprocess.Popen(cmd,stderr=subprocess.PIPE,text=True,bufsize=1)
+        self.reader=threading.Thread(target=self.read_stderr,args=(self.process,),name="m026-streamer-stderr",daemon=True)
+        self.reader.start()
+        print("Streamer started:"," ".join(cmd),"pid",self.process.pid)
+
+    def read_stderr(self,process):
+        """Reader thread: parse the stderr output of the streamer until it exits."""
+        for line in process.stderr :
+            sys.stderr.write(line)
+            line=line.rstrip()
+            self.log.append(line)
+            m=self.GEOMETRY.search(line)
+            if m :
+                if m.group(1) == "Width" :
+                    self.width=int(m.group(2))
+                else :
+                    self.height=int(m.group(2))
+                    self.ready.set()
+            if self.FORMAT_FAILED in line :
+                self.formatFailed=True
+                self.ready.set()
+        process.stderr.close()
+        returncode=process.wait()
+        if not self.stopping :
+            print("Streamer: Exited with status",returncode)
+
+def pid_alive(pid):
+    """Return True if the process pid runs. A zombie has exited and released its devices, it is
+    only waiting for its parent to reap it.
+    """
+    try:
+        with open("/proc/{p}/stat".format(p=pid)) as f :
+            stat=f.read()
+    except (FileNotFoundError,ProcessLookupError):
+        return False
+    return stat[stat.rindex(")")+2] != "Z"
+
+def pid_wait(pid,timeout):
+    """Wait up to timeout seconds for the process pid to exit. Return True if it did."""
+    deadline=time.monotonic()+timeout
+    while pid_alive(pid) :
+        if time.monotonic() >= deadline :
+            return False
+        time.sleep(0.02)
+    return True
+
+#===============================================================================
+
+import struct
+import socket
+import usb1 as usb
+from multiprocessing import shared_memory, resource_tracker
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+class FrameAssembler(object):
+    """Assembles the frames from the isochronous packets as getData_M026 of m026-streamer does.
+    A packet starts with 2 header bytes, the second one tells the field: 0x40 or 0xc0 the first,
+    0x00 the second field. The lines of the first field go to the even, the lines of the second
+    field to the odd lines of the frame. Each complete frame is passed to the onFrame callbacks
+    as a memoryview of the frame buffer, which is overwritten by the next frame: consumers keeping
+    the frame have to copy it.
+    """
+
+    def __init__(self,width,height):
+        self.width=width
+        self.height=height
+        self.lineSize=width*2
+        self.frameSize=self.lineSize*height
+        self.frame=bytearray(self.frameSize)
+        self.lineBuffer=bytearray(self.lineSize)
+        self.onFrame=[]
+        self.field=0
+        self.previousField=0
+        self.line=0
+        self.lineOffset=0
+        self.videoOffset=0
+        self.frames=0
+        self.bytesInFrame=0
+        # Fields with video data in the frame being assembled, and in the last frame
+        self.fields=0
+        self.frameFields=0
+
+    def transfer(self,transfer):
+        """Process the packets of a completed usb1 isochronous transfer."""
+        packet=self.packet
+        for status,data in transfer.iterISO() :
+            packet(data)
+
+    def packet(self,data):
+        """Process an isochronous packet, data truncated to its actual length."""
+        l=len(data)
+        if l > 1 :
+            self.header(data[1])
+        if l > 10 :
+            self.lines(memoryview(data)[2:])
+            self.end_of_packet(l-2)
+        self.previousField=self.field
+
+    def header(self,flags):
+        """Follow the field of the packet header flags."""
+        if flags == 0x40 or flags == 0xc0 :
+            self.field=1
+        if flags == 0x00 :
+            self.field=2
+        if self.previousField == 2 and self.field == 1 :
+            self.lineOffset=0
+            self.line=0
+            self.videoOffset=0
+            self.bytesInFrame=0
+        if self.previousField == 1 and self.field == 2 :
+            self.lineOffset=0
+            self.line=1
+            self.videoOffset=self.lineSize
+
+    def end_of_packet(self,length):
+        """Pass the frame to the onFrame callbacks if its last line is complete."""
+        self.videoOffset%=self.frameSize
+        self.fields|=self.field
+        if self.line >= self.height-1 :
+            self.frames+=1
+            self.frameFields=self.fields
+            self.fields=0
+            frame=memoryview(self.frame)
+            for callback in self.onFrame :
+                callback(frame)
+            self.line=0
+            self.lineOffset=0
+            self.videoOffset=0
+        self.bytesInFrame+=length
+
+    def lines(self,video):
+        """Copy the video data of a packet line by line to the frame."""
+        lineSize=self.lineSize
+        remain=len(video)
+        offset=0
+        while remain > 0 :
+            toCopy=lineSize-self.lineOffset
+            if remain < toCopy :
+                self.lineBuffer[self.lineOffset:self.lineOffset+remain]=video[offset:offset+remain]
+                self.lineOffset+=remain
+                return
+            self.lineBuffer[self.lineOffset:lineSize]=video[offset:offset+toCopy]
+            n=min(lineSize,self.frameSize-self.videoOffset)
+            if n > 0 :
+                self.frame[self.videoOffset:self.videoOffset+n]=self.lineBuffer[:n]
+            self.videoOffset+=2*lineSize
+            self.line+=2
+            self.lineOffset=0
+            offset+=toCopy
+            remain-=toCopy
+
+class NumpyFrameAssembler(FrameAssembler):
+    """FrameAssembler vectorized with NumPy: the packets of a transfer are a view of the transfer
+    buffer and the frame a (height, width*2) array. The video data of a run of packets of the same
+    field is gathered in one array, without the packet headers, and goes to every other row of the
+    frame in one strided copy: each byte is copied twice, by NumPy, no Python code runs per byte,
+    line or packet of a run. As in FrameAssembler a line goes to the frame once it is complete, the
+    bytes of an incomplete line are carried over in the line buffer, so the frames are the same.
+    Needs numpy.
+    """
+
+    def __init__(self,width,height):
+        FrameAssembler.__init__(self,width,height)
+        self.rows=numpy.frombuffer(self.frame,dtype=numpy.uint8).reshape(height,self.lineSize)
+        self.carry=numpy.frombuffer(self.lineBuffer,dtype=numpy.uint8)
+
+    def transfer(self,transfer):
+        setup=transfer.getISOSetupList()
+        count=len(setup)
+        packets=numpy.frombuffer(transfer.getBuffer(),dtype=numpy.uint8).reshape(count,-1)
+        packetSize=packets.shape[1]
+        lengths=[packet['actual_length'] for packet in setup]
+        headers=packets[:,1].tolist()
+        i=0
+        while i < count :
+            l=lengths[i]
+            if l > 1 :
+                self.header(headers[i])
+            if l <= 10 :
+                self.previousField=self.field
+                i+=1
+                continue
+            # Run of packets with video data and the same header, up to the one completing the frame
+            j=i+1
+            while j < count and lengths[j] > 10 and headers[j] == headers[i] :
+                j+=1
+            sizes=numpy.cumsum(lengths[i:j])-2*numpy.arange(1,j-i+1)
+            missing=(self.height-self.line)//2
+            j=i+min(int(numpy.searchsorted(sizes,missing*self.lineSize-self.lineOffset)),j-i-1)+1
+            if min(lengths[i:j]) == packetSize :
+                video=packets[i:j,2:].reshape(-1)
+            else :
+                video=numpy.concatenate([packets[p,2:lengths[p]] for p in range(i,j)])
+            self.lines(video)
+            self.end_of_packet(len(video))
+            self.previousField=self.field
+            i=j
+
+    def packet(self,data):
+        l=len(data)
+        if l > 1 :
+            self.header(data[1])
+        if l > 10 :
+            self.lines(numpy.frombuffer(data,dtype=numpy.uint8,offset=2))
+            self.end_of_packet(l-2)
+        self.previousField=self.field
+
+    def lines(self,video):
+        """Copy video data to every other row of the frame, from the current line on."""
+        lineSize=self.lineSize
+        rows=self.rows
+        carry=self.carry
+        remain=len(video)
+        offset=0
+        if self.lineOffset :
+            n=min(lineSize-self.lineOffset,remain)
+            carry[self.lineOffset:self.lineOffset+n]=video[:n]
+            offset=n
+            remain-=n
+            self.lineOffset+=n
+            if self.lineOffset < lineSize :
+                return
+            if self.line < self.height :
+                rows[self.line]=carry
+            self.lineOffset=0
+            self.line+=2
+        lines=remain//lineSize
+        if lines :
+            # Rows past the end of the frame are dropped
+            n=min(lines,max(0,(self.height-self.line+1)//2))
+            if n :
+                rows[self.line:self.line+2*n:2]=video[offset:offset+n*lineSize].reshape(n,lineSize)
+            offset+=lines*lineSize
+            remain-=lines*lineSize
+            self.line+=2*lines
+        if remain :
+            carry[:remain]=video[offset:]
+            self.lineOffset=remain
+
+class FrameRing(object):
+    """Ring of capacity preallocated frame slots, written by one producer (the capture engine) and
+    read by any number of FrameRingReaders, each with its own cursor.
+    Every frame gets a sequence number. The producer never waits for the readers: it overwrites
+    the oldest frame. Readers get memoryviews of the slots, no copies; a reader still using a frame
+    after capacity-1 newer frames were written checks with valid(sequence) whether the slot was
+    overwritten meanwhile. The lock is only used to wake up waiting readers.
+    """
+
+    def __init__(self,width,height,capacity=8):
+        self.width=width
+        self.height=height
+        self.frameSize=width*2*height
+        self.capacity=capacity
+        self.buffer=bytearray(self.frameSize*capacity)
+        view=memoryview(self.buffer)
+        self.slots=[view[i*self.frameSize:(i+1)*self.frameSize] for i in range(capacity)]
+        # Sequence number of the frame in each slot, -1 while it is written
+        self.sequences=[-1]*capacity
+        self.times=[0.0]*capacity
+        self.sequence=0
+        self.condition=threading.Condition()
+
+    def write(self,frame):
+        """Copy frame to the slot of the oldest frame and publish it, return its sequence number."""
+        sequence=self.sequence
+        i=sequence%self.capacity
+        self.sequences[i]=-1
+        self.slots[i][:]=frame
+        self.times[i]=time.time()
+        self.sequences[i]=sequence
+        self.sequence=sequence+1
+        with self.condition:
+            self.condition.notify_all()
+        return sequence
+
+    def valid(self,sequence):
+        """Return True if the frame sequence is still in its slot."""
+        return self.sequences[sequence%self.capacity] == sequence
+
+    def get(self,sequence):
+        """Return (sequence, time, frame) of a frame in the ring, or None if it was overwritten."""
+        i=sequence%self.capacity
+        frame=self.slots[i]
+        t=self.times[i]
+        if self.sequences[i] != sequence :
+            return None
+        return sequence,t,frame
+
+    def latest(self):
+        """Return (sequence, time, frame) of the last frame, or None."""
+        if self.sequence == 0 :
+            return None
+        return self.get(self.sequence-1)
+
+    def reader(self):
+        """Return a reader starting at the next frame."""
+        return FrameRingReader(self)
+
+class FrameRingReader(object):
+    """Reads the frames of a FrameRing in order. A reader falling behind skips the overwritten
+    frames, counted in dropped.
+    """
+
+    def __init__(self,ring):
+        self.ring=ring
+        self.cursor=ring.sequence
+        self.dropped=0
+
+    def read(self,timeout=None):
+        """Return (sequence, time, frame) of the next frame, waiting up to timeout seconds for it
+        (forever if None), or None on timeout.
+        """
+        ring=self.ring
+        if self.cursor >= ring.sequence :
+            with ring.condition:
+                if not ring.condition.wait_for(lambda: self.cursor < ring.sequence,timeout) :
+                    return None
+        while True :
+            # The slot of the oldest frame is the next to be overwritten
+            oldest=ring.sequence-ring.capacity+1
+            if self.cursor < oldest :
+                self.dropped+=oldest-self.cursor
+                self.cursor=oldest
+            r=ring.get(self.cursor)
+            if r is not None :
+                self.cursor+=1
+                return r
+            self.dropped+=1
+            self.cursor+=1
+
+    def pending(self):
+        """Return the number of frames written and not read yet."""
+        return self.ring.sequence-self.cursor
+
+BUS_MAGIC=b"M026BUS1"
+BUS_READERS=16
+# magic, capacity, frame size, width, height, pixel format, sequence of the next frame
+BUS_HEADER=struct.Struct("<8sIIII4sq")
+# reader table: 1 for each registered reader
+BUS_READER_TABLE=struct.Struct("<{n}B".format(n=BUS_READERS))
+# sequence (-1 while written), time, width, height, pixel format, field flags (bit 0: field 1, bit 1: field 2)
+BUS_SLOT_HEADER=struct.Struct("<qdII4sI")
+BUS_SLOT_DATA=64
+
+def bus_reader_address(name,index):
+    """Abstract unix socket address of the wakeup socket of a reader."""
+    return "\0m026-bus-{n}-{i}".format(n=name,i=index)
+
+class FrameBus(object):
+    """Publishes frames to other processes in a shared memory segment (multiprocessing.shared_memory)
+    of capacity frame slots. Each slot has a header: sequence number, time, width, height, pixel
+    format and field flags. Readers - FrameBusReader in any process - attach to the segment by its
+    name; the bus wakes them up with a datagram on their unix socket when a frame is published.
+    As the FrameRing, the bus overwrites the oldest frame and never waits for the readers.
+    Linux only: the wakeup sockets are in the abstract namespace.
+    """
+
+    def __init__(self,name,width,height,capacity=4,pixelFormat=b"YUYV"):
+        self.name=name
+        self.width=width
+        self.height=height
+        self.capacity=capacity
+        self.pixelFormat=pixelFormat
+        self.frameSize=width*2*height
+        self.slotSize=BUS_SLOT_DATA+self.frameSize
+        self.slotsOffset=BUS_HEADER.size+BUS_READER_TABLE.size
+        self.shm=shared_memory.SharedMemory(name=name,create=True,size=self.slotsOffset+capacity*self.slotSize)
+        self.buffer=self.shm.buf
+        self.sequence=0
+        BUS_HEADER.pack_into(self.buffer,0,BUS_MAGIC,capacity,self.frameSize,width,height,pixelFormat,0)
+        for i in range(capacity) :
+            BUS_SLOT_HEADER.pack_into(self.buffer,self.slot_offset(i),-1,0.0,width,height,pixelFormat,0)
+        self.socket=socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+
+    def slot_offset(self,i):
+        return self.slotsOffset+i*self.slotSize
+
+    def publish(self,frame,fields=0):
+        """Copy frame to the slot of the oldest frame, publish it and wake up the readers.
+        Return its sequence number.
+        """
+        sequence=self.sequence
+        offset=self.slot_offset(sequence%self.capacity)
+        struct.pack_into("<q",self.buffer,offset,-1)
+        self.buffer[offset+BUS_SLOT_DATA:offset+BUS_SLOT_DATA+self.frameSize]=frame
+        BUS_SLOT_HEADER.pack_into(self.buffer,offset,sequence,time.time(),self.width,self.height,self.pixelFormat,fields)
+        self.sequence=sequence+1
+        struct.pack_into("<q",self.buffer,BUS_HEADER.size-8,self.sequence)
+        self.wakeup(sequence)
+        return sequence
+
+    def wakeup(self,sequence):
+        """Send the sequence number to the registered readers, unregister the gone ones."""
+        message=struct.pack("<q",sequence)
+        # The view of the table is released on any error, the segment can't be closed while it is exported
+        with self.buffer[BUS_HEADER.size:BUS_HEADER.size+BUS_READERS] as table:
+            for i in range(BUS_READERS) :
+                if not table[i] :
+                    continue
+                try:
+                    self.socket.sendto(message,socket.MSG_DONTWAIT,bus_reader_address(self.name,i))
+                except BlockingIOError:
+                    # The reader doesn't read its socket, it will find the frame anyway
+                    pass
+                except (ConnectionRefusedError,FileNotFoundError):
+                    table[i]=0
+
+    def close(self):
+        """Close and remove the segment. The readers keep their mapping until they close."""
+        self.socket.close()
+        self.buffer=None
+        self.shm.close()
+        self.shm.unlink()
+
+class FrameBusReader(object):
+    """Reads the frames of the FrameBus name, in order, in another process. A reader falling
+    behind skips the overwritten frames, counted in dropped. The frames are memoryviews of the
+    shared memory: valid(sequence) tells if a frame was overwritten meanwhile.
+    """
+
+    def __init__(self,name):
+        self.name=name
+        self.shm=shared_memory.SharedMemory(name=name)
+        # The segment belongs to the publisher: it mustn't be removed when this process exits
+        resource_tracker.unregister(self.shm._name,"shared_memory")
+        self.buffer=self.shm.buf
+        magic,self.capacity,self.frameSize,self.width,self.height,self.pixelFormat,sequence=BUS_HEADER.unpack_from(self.buffer,0)
+        if magic != BUS_MAGIC :
+            self.shm.close()
+            raise ValueError("{n} is not a frame bus".format(n=name))
+        self.slotSize=BUS_SLOT_DATA+self.frameSize
+        self.slotsOffset=BUS_HEADER.size+BUS_READER_TABLE.size
+        self.cursor=sequence
+        self.dropped=0
+        self.index=None
+        self.socket=socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+        # Binding the address of a free entry of the reader table registers the reader
+        for i in range(BUS_READERS) :
+            try:
+                self.socket.bind(bus_reader_address(name,i))
+            except OSError:
+                continue
+            self.index=i
+            self.buffer[BUS_HEADER.size+i]=1
+            break
+        if self.index is None :
+            self.close()
+            raise ValueError("Too many readers of {n}".format(n=name))
+
+    def sequence(self):
+        """Return the sequence number of the next frame to be published."""
+        return struct.unpack_from("<q",self.buffer,BUS_HEADER.size-8)[0]
+
+    def slot_offset(self,sequence):
+        return self.slotsOffset+(sequence%self.capacity)*self.slotSize
+
+    def valid(self,sequence):
+        """Return True if the frame sequence is still in its slot."""
+        return struct.unpack_from("<q",self.buffer,self.slot_offset(sequence))[0] == sequence
+
+    def get(self,sequence):
+        """Return (sequence, time, width, height, pixel format, fields, frame), or None if the frame
+        was overwritten.
+        """
+        offset=self.slot_offset(sequence)
+        header=BUS_SLOT_HEADER.unpack_from(self.buffer,offset)
+        if header[0] != sequence :
+            return None
+        return header+(self.buffer[offset+BUS_SLOT_DATA:offset+BUS_SLOT_DATA+self.frameSize],)
+
+    def wait(self,timeout):
+        """Wait for a wakeup up to timeout seconds, forever if None. Return False on timeout."""
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.recv(8)
+        except (socket.timeout,BlockingIOError):
+            return False
+        # Drop the wakeups of the frames published meanwhile
+        self.socket.setblocking(False)
+        try:
+            while True :
+                self.socket.recv(8)
+        except BlockingIOError:
+            pass
+        return True
+
+    def read(self,timeout=None):
+        """Return the next frame as get() does, waiting up to timeout seconds for it (forever if
+        None), or None on timeout.
+        """
+        deadline=None if timeout is None else time.monotonic()+timeout
+        while self.cursor >= self.sequence() :
+            remaining=None if deadline is None else max(0,deadline-time.monotonic())
+            if not self.wait(remaining) and self.cursor >= self.sequence() :
+                return None
+        while True :
+            oldest=self.sequence()-self.capacity+1
+            if self.cursor < oldest :
+                self.dropped+=oldest-self.cursor
+                self.cursor=oldest
+            r=self.get(self.cursor)
+            self.cursor+=1
+            if r is not None :
+                return r
+            self.dropped+=1
+
+    def close(self):
+        """Unregister the reader and detach from the segment."""
+        if self.index is not None :
+            self.buffer[BUS_HEADER.size+self.index]=0
+            self.index=None
+        self.socket.close()
+        self.buffer=None
+        self.shm.close()
+
+class CaptureEngine(object):
+    """In-process alternative to m026-streamer: captures the video of an M026Device with usb1
+    asynchronous isochronous transfers on endpoint 0x82 (interface 0, alternate setting 5) and
+    writes the frames to the v4l2 loopback device. Python consumers get the frames from the
+    onFrame(frame) callbacks, see FrameAssembler, or read them from the frame ring: consumers
+    such as preview, recording and analysis each get a reader with engine.ring.reader() after
+    start(). With busName the frames are published to other processes on the FrameBus busName.
+    The frames are assembled by NumpyFrameAssembler if numpy is installed.
+    It has the start(width,height), terminate(), update(), pause(), resume() and wait_ready()
+    methods of Streamer, so it can replace it.
+    The engine opens the device in a USB context of its own, so the events of its transfers are
+    handled only by the event thread of the engine and the callbacks are called on it, not by the
+    event handling of the device control or of the hotplug monitor in the context of m026.
+    """
+
+    ENDPOINT=0x82
+    INTERFACE=0
+    ALT_SETTING=5
+    TRANSIENT_ERRORS=(usb.TRANSFER_TIMED_OUT,usb.TRANSFER_OVERFLOW,usb.TRANSFER_ERROR)
+
+    def __init__(self,m026,streamDevice,transfers=4,packets=64,packetSize=3072,timeout=2000,ringSize=8,busName=None):
+        self.m026=m026
+        self.streamDevice=streamDevice
+        self.transferCount=transfers
+        self.packets=packets
+        self.packetSize=packetSize
+        self.timeout=timeout
+        self.assembler=None
+        self.ringSize=ringSize
+        self.ring=None
+        self.busName=busName
+        self.bus=None
+        self.onFrame=[]
+        # Called with the error message when capturing stops on a fatal transfer error
+        self.onError=[]
+        self.transferErrors=0
+        self.transfers=[]
+        self.usbContext=None
+        self.usbDevh=None
+        self.fd=None
+        self.running=False
+        self.paused=False
+        self.thread=None
+
+    def get_pid(self):
+        """Return the pid of this process while capturing, as Streamer.get_pid does for the streamer."""
+        return os.getpid() if self.running else None
+
+    def find_pid(self):
+        return self.get_pid()
+
+    def adopt(self):
+        return self.get_pid()
+
+    def pause(self):
+        """Stop passing the frames on, keeping the device, as Streamer.pause does."""
+        self.paused=True
+
+    def resume(self):
+        """Resume passing the frames on."""
+        self.paused=False
+
+    def wait_ready(self,timeout=2.0):
+        """start() is synchronous: return True while capturing."""
+        return self.running
+
+    def update(self,width,height,timeout=2.0):
+        """Capture the capture frame set on the device, width x height."""
+        self.start(width,height)
+        return self.running
+
+    def start(self,width,height):
+        """Start capturing frames of width x height."""
+        if self.running :
+            self.terminate()
+        h=self.open_device()
+        if h is None :
+            print("Capture engine: No device")
+            return False
+        if h.kernelDriverActive(self.INTERFACE) :
+            h.detachKernelDriver(self.INTERFACE)
+        h.claimInterface(self.INTERFACE)
+        if h.getConfiguration() != 1 :
+            h.setConfiguration(1)
+        h.setInterfaceAltSetting(self.INTERFACE,self.ALT_SETTING)
+        self.usbDevh=h
+        self.open_output(width,height)
+        self.assembler=NumpyFrameAssembler(width,height) if numpy else FrameAssembler(width,height)
+        self.assembler.onFrame.append(self.frame)
+        # Readers of the ring keep reading across restarts with the same frame size
+        if self.ring is None or self.ring.width != width or self.ring.height != height :
+            self.ring=FrameRing(width,height,self.ringSize)
+        if self.busName and (self.bus is None or self.bus.width != width or self.bus.height != height) :
+            if self.bus :
+                self.bus.close()
+            self.bus=FrameBus(self.busName,width,height)
+        self.transfers=[]
+        self.paused=False
+        self.transferErrors=0
+        for i in range(self.transferCount) :
+            transfer=h.getTransfer(iso_packets=self.packets)
+            # A bytearray buffer is used in place by libusb, the assembler reads it without a copy
+            transfer.setIsochronous(self.ENDPOINT,bytearray(self.packets*self.packetSize),callback=self.completed,timeout=self.timeout)
+            self.transfers.append(transfer)
+        self.running=True
+        for transfer in self.transfers :
+            transfer.submit()
+        self.thread=threading.Thread(target=self.run,name="m026-capture",daemon=True)
+        self.thread.start()
+        print("Capture engine: {w}x{h}, {t} transfers of {p} packets".format(w=width,h=height,t=self.transferCount,p=self.packets))
+        return True
+
+    def open_device(self):
+        """Open the device of m026 in the USB context of the engine. Return the handle, or None.
+        The USB context is created once and kept for later calls.
+        """
+        if self.usbContext is None :
+            self.usbContext=usb.USBContext()
+        for dev in self.usbContext.getDeviceList(skip_on_error=True) :
+            if self.m026.device_is_current(dev) :
+                return dev.open()
+        return None
+
+    def open_output(self,width,height):
+        """Set the format of the v4l2 loopback device and open it for writing."""
+        self.streamDevice.pixel_format=PixelFormat.YUYV
+        self.streamDevice.frame_width=width
+        self.streamDevice.frame_height=height
+        self.streamDevice.set()
+        self.fd=os.open(self.streamDevice.v4l2Device,os.O_RDWR)
+        os.write(self.fd,bytes(width*2*height))
+
+    def frame(self,frame):
+        """Write a frame to the v4l2 loopback device and the ring, pass it to the onFrame callbacks."""
+        if self.paused :
+            return
+        try:
+            os.write(self.fd,frame)
+        except OSError as e:
+            print("Capture engine: Writing the frame failed:",e)
+        self.ring.write(frame)
+        if self.bus :
+            self.bus.publish(frame,self.assembler.frameFields)
+        for callback in self.onFrame :
+            callback(frame)
+
+    def completed(self,transfer):
+        """Transfer callback: assemble the packets and resubmit the transfer.
+        As m026-streamer does, a transfer failing with a transient error (timeout, overflow,
+        transfer error) is resubmitted; a stall, the device leaving or a failed resubmission
+        stops capturing, see failed().
+        """
+        status=transfer.getStatus()
+        if status == usb.TRANSFER_CANCELLED :
+            return
+        if status == usb.TRANSFER_COMPLETED :
+            self.assembler.transfer(transfer)
+        elif status in self.TRANSIENT_ERRORS :
+            self.transferErrors+=1
+        else :
+            self.failed("Transfer failed with status {s}".format(s=status))
+            return
+        if not self.running :
+            return
+        try:
+            transfer.submit()
+        except usb.USBError as e:
+            self.failed("Resubmitting the transfer failed: {e}".format(e=e))
+
+    def failed(self,message):
+        """Stop capturing on a fatal transfer error and pass the error to the onError callbacks."""
+        if not self.running :
+            return
+        self.running=False
+        print("Capture engine:",message)
+        for callback in self.onError :
+            callback(message)
+
+    def run(self):
+        context=self.usbContext
+        while self.running or any(transfer.isSubmitted() for transfer in self.transfers) :
+            try:
+                context.handleEventsTimeout(0.1)
+            except usb.USBErrorInterrupted:
+                pass
+
+    def terminate(self):
+        """Stop capturing and release the interface."""
+        if self.thread is None :
+            return
+        self.running=False
+        for transfer in self.transfers :
+            if transfer.isSubmitted() :
+                try:
+                    transfer.cancel()
+                except usb.USBError:
+                    pass
+        self.thread.join()
+        self.thread=None
+        for transfer in self.transfers :
+            transfer.close()
+        self.transfers=[]
+        try:
+            self.usbDevh.setInterfaceAltSetting(self.INTERFACE,0)
+            self.usbDevh.releaseInterface(self.INTERFACE)
+        except usb.USBError as e:
+            print("Capture engine: Releasing the interface failed:",e)
+        self.usbDevh.close()
+        self.usbDevh=None
+        if self.fd is not None :
+            os.close(self.fd)
+            self.fd=None
+
+    def close(self):
+        """Stop capturing, remove the frame bus and close the USB context of the engine."""
+        self.terminate()
+        if self.bus :
+            self.bus.close()
+            self.bus=None
+        if self.usbContext :
+            self.usbContext.close()
+            self.usbContext=None
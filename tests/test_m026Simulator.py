@@ -0,0 +1,202 @@
+"""
+================================================
+A TV app for the AVerMedia AVerTV USB2.0
+Device control tests on the simulated device
+================================================
+Version:    0.1
+Author:     Sinan Güngör
+License:    GPL v2
+
+    python -m unittest discover tests
+The simulated device runs without delays, so the control transfer counts are exact.
+"""
+
+import os
+import sys
+import io
+import time
+import tempfile
+import unittest
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+from m026Device import *
+from m026Simulator import *
+from m026Recorder import *
+
+#===============================================================================
+
+LOCK_FREQUENCY=503.25
+
+def simulated_device():
+    return SimulatedDevice(lockFrequencies=[LOCK_FREQUENCY],tunerSettleTime=0,sbiWriteDelay=0,sbiReadDelay=0,transferLatency=0)
+
+def open_device(video_source=None,dev=None):
+    """Return a found and opened M026Device on a simulated device, with video_source set."""
+    dev=dev or simulated_device()
+    m026=M026Device()
+    m026.usbContext=SimulatedContext(dev)
+    m026.find()
+    m026.open()
+    m026.shadow_enable(True)
+    m026.vdVideoStandardTv=VIDEO_STANDARD_PAL_B_G_H_I_N
+    m026.vdVideoStandardComposite=VIDEO_STANDARD_PAL_B_G_H_I_N
+    m026.tvTunerFrequency=LOCK_FREQUENCY
+    if video_source is not None :
+        m026.set_video_source(video_source)
+    return m026,dev
+
+def transfers(dev):
+    return dev.writes+dev.reads
+
+class SimulatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # The device control reports on stdout
+        self.stdout=contextlib.redirect_stdout(io.StringIO())
+        self.stdout.__enter__()
+
+    def tearDown(self):
+        self.stdout.__exit__(None,None,None)
+
+#===============================================================================
+
+class TestSourceSwitch(SimulatorTestCase):
+
+    def test_full_sequence_transfers(self):
+        for video_source,expected in ((VIDEO_SOURCE_TV,130),(VIDEO_SOURCE_COMPOSITE,65),(VIDEO_SOURCE_S_VIDEO,65)) :
+            m026,dev=open_device()
+            m026.set_video_source(video_source)
+            self.assertEqual(transfers(dev),expected,list_video_sources[video_source])
+
+    def test_differential_switch_transfers(self):
+        m026,dev=open_device(VIDEO_SOURCE_TV)
+        m026.differentialSwitching=True
+        n=transfers(dev)
+        m026.set_video_source(VIDEO_SOURCE_COMPOSITE)
+        self.assertEqual(transfers(dev)-n,10)
+        n=transfers(dev)
+        m026.set_video_source(VIDEO_SOURCE_TV)
+        self.assertEqual(transfers(dev)-n,9)
+
+    def test_differential_switch_state(self):
+        # The differential switch leaves the registers the full sequence leaves
+        full,fullDev=open_device(VIDEO_SOURCE_COMPOSITE)
+        m026,dev=open_device(VIDEO_SOURCE_TV)
+        m026.differentialSwitching=True
+        m026.set_video_source(VIDEO_SOURCE_COMPOSITE)
+        ctrl,decoder=full.video_source_state(VIDEO_SOURCE_COMPOSITE)
+        for index,value in ctrl.items() :
+            self.assertEqual(dev.registers[index],fullDev.registers[index],hex(index))
+        for ra in decoder :
+            self.assertEqual(dev.sbiDevices[TVP5150][ra],fullDev.sbiDevices[TVP5150][ra],hex(ra))
+
+#===============================================================================
+
+class TestTransaction(SimulatorTestCase):
+
+    def test_rollback_discards_queued_writes(self):
+        m026,dev=open_device()
+        indexes=[dc1100.CFSPO+i for i in range(8)]
+        writes=dev.writes
+        with self.assertRaises(RuntimeError):
+            with m026.transaction():
+                for index in indexes :
+                    m026.ctrl_tx(index,0x10)
+                raise RuntimeError()
+        self.assertEqual(dev.writes,writes)
+        for index in indexes :
+            self.assertNotIn(index,m026.shadowRegisters)
+        self.assertFalse(m026.captureFrameValid)
+
+    def test_interrupted_flush(self):
+        m026,dev=open_device()
+        m026.txDepth=4
+        context=m026.usbContext
+        handleEvents=context.handleEvents
+        calls=[0]
+        def interrupted():
+            calls[0]+=1
+            if calls[0] == 2 :
+                raise KeyboardInterrupt()
+            handleEvents()
+        context.handleEvents=interrupted
+        indexes=[dc1100.CFSPO+i for i in range(8)]
+        with self.assertRaises(KeyboardInterrupt):
+            with m026.transaction():
+                for index in indexes :
+                    m026.ctrl_tx(index,0x10)
+        context.handleEvents=handleEvents
+        self.assertEqual([h.pending for h in dev.handles],[[]])
+        for index in indexes[4:] :
+            self.assertNotIn(index,m026.shadowRegisters)
+        with m026.transaction():
+            for index in indexes :
+                m026.ctrl_tx(index,0x20)
+        self.assertEqual([dev.read(index) for index in indexes],[0x20]*8)
+
+#===============================================================================
+
+class TestSerialBus(SimulatorTestCase):
+
+    def test_read_deadline(self):
+        # Transfers to an address without a device never complete
+        m026,dev=open_device()
+        m026.sbiTimeout=0.05
+        m026.sbi_select_device(0x20)
+        t0=time.perf_counter()
+        with self.assertRaises(M026SerialBusError):
+            m026.sbi_read(0x00)
+        self.assertLess(time.perf_counter()-t0,0.5)
+
+    def test_write_deadline(self):
+        m026,dev=open_device()
+        m026.sbiTimeout=0.05
+        m026.sbi_select_device(0x20)
+        t0=time.perf_counter()
+        with self.assertRaises(M026SerialBusError):
+            m026.sbi_write(0x00,0x01)
+        self.assertLess(time.perf_counter()-t0,0.5)
+
+#===============================================================================
+
+class TestRecordReplay(SimulatorTestCase):
+
+    def test_round_trip(self):
+        m026,dev=open_device()
+        recorder=M026Recorder(m026)
+        with tempfile.TemporaryDirectory() as directory :
+            log=os.path.join(directory,"session.m026log")
+            recorder.start(log)
+            m026.set_video_source(VIDEO_SOURCE_TV)
+            recorder.stop()
+            wallTime,records=read_log(log)
+            self.assertEqual(len(records),recorder.count)
+            self.assertEqual(len(records),transfers(dev))
+            replayed,replayedDev=open_device()
+            replayer=M026Replayer(replayed)
+            replayer.replay(log)
+        self.assertEqual(replayer.transfers,len(records))
+        self.assertEqual(replayer.mismatches,0)
+        self.assertEqual(replayedDev.registers,dev.registers)
+        self.assertEqual(replayedDev.sbiDevices[TVP5150],dev.sbiDevices[TVP5150])
+
+#===============================================================================
+
+class TestHotplug(SimulatorTestCase):
+
+    def test_callback_handles(self):
+        context=SimulatedContext(simulated_device())
+        events=[]
+        first=context.hotplugRegisterCallback(lambda c,d,e: events.append(("first",e)))
+        second=context.hotplugRegisterCallback(lambda c,d,e: events.append(("second",e)))
+        context.hotplugDeregisterCallback(first)
+        third=context.hotplugRegisterCallback(lambda c,d,e: events.append(("third",e)))
+        self.assertEqual(len({first,second,third}),3)
+        context.unplug()
+        context.handleEventsTimeout(0)
+        self.assertEqual(events,[("second",usb.HOTPLUG_EVENT_DEVICE_LEFT),("third",usb.HOTPLUG_EVENT_DEVICE_LEFT)])
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -9,17 +9,39 @@ Author:     Sinan Güngör
 License:    GPL v2
 """
 
+import queue
+
 #===============================================================================
 
 from m026Device import *
-m026 = M026Device()
-m026.find()
+from m026Dispatcher import *
+# The device is used by the GUI callbacks through a dispatcher thread which owns it
+m026Dispatcher = M026Dispatcher(M026Device())
+m026Dispatcher.start()
+m026 = M026DeviceProxy(m026Dispatcher)
+
+import argparse
+parser=argparse.ArgumentParser(description="Channel scanner for the AVerMedia AVerTV USB2.0")
+parser.add_argument("--device",help="device id, bus-port path as in sysfs (e.g. 3-1.4) or serial number; selects the device and its settings section")
+parser.add_argument("--list",action="store_true",help="list the attached devices")
+parser.add_argument("--capture",action="store_true",help="capture in-process with the Python capture engine instead of m026-streamer")
+parser.add_argument("--bus",help="with --capture, publish the frames to other processes on the shared memory frame bus BUS")
+args=parser.parse_args()
+if args.list :
+    for bus,port,serial,dev in m026.list_devices() :
+        print("{b}-{p}  serial: {s}".format(b=bus,p=port,s=serial))
+    m026Dispatcher.stop()
+    exit()
+deviceSelection=parse_device_id(args.device) if args.device else (None,None,None)
+
+m026.find(*deviceSelection)
 if m026.usbDev == None :
     print ("AVerTV USB2.0 not found!") 
     exit()
 print ("AVerTV USB2.0 found!") 
 
 m026.open() 
+m026.shadow_enable(True)
 m026.gpio_led(True)
 print("----------------------------------------------------------------")
 
@@ -27,7 +49,7 @@ print("----------------------------------------------------------------")
 
 from m026Settings import *
 
-tvM026Settings=Settings()
+tvM026Settings=Settings(args.device)
 fileSettings=tvM026Settings.fileSettings
 
 isFile = os.path.isfile(fileSettings)
@@ -39,6 +61,10 @@ else:
 tvM026Settings.print()
 print("----------------------------------------------------------------")
 
+# Register programs of a board variant replace the default ones
+if os.path.isfile(tvM026Settings.filePrograms):
+    m026.programs.read(tvM026Settings.filePrograms)
+
 frameTv=Frame(Position(tvM026Settings.m026TvCaptureStartX,tvM026Settings.m026TvCaptureStartY),Position(tvM026Settings.m026TvCaptureEndX,tvM026Settings.m026TvCaptureEndY))
 m026.vdVideoStandardTv = tvM026Settings.m026TvVideoStandard
 m026.vdCaptureFrameTv=frameTv
@@ -113,7 +139,10 @@ print("----------------------------------------------------------------")
 from m026Stream import *
 
 streamDevice=StreamDevice(tvM026Settings.v4l2Device)
-streamer=Streamer(tvM026Settings.streamer,streamDevice.v4l2Device)
+if args.capture :
+    streamer=CaptureEngine(m026,streamDevice,busName=args.bus)
+else :
+    streamer=Streamer(tvM026Settings.streamer,streamDevice.v4l2Device,*deviceSelection)
 
 #===============================================================================
 
@@ -135,6 +164,28 @@ else :
     m026.set_video_capture(0,0,720,480)
 streamer.start(m026.videoCaptureSize.width,m026.videoCaptureSize.height)    
 
+#===============================================================================
+from m026Hotplug import *
+
+# Reattach the device and relaunch the streamer if the device drops off the bus
+m026Hotplug=M026Hotplug(m026Dispatcher)
+m026Hotplug.onLeft.append(streamer.terminate)
+m026Hotplug.onArrived.append(lambda: streamer.start(m026.videoCaptureSize.width,m026.videoCaptureSize.height))
+m026Hotplug.start()
+
+#===============================================================================
+from m026Monitor import *
+
+# Video decoder status monitor, the GUI reacts to its events instead of reading the status
+m026Monitor=M026Monitor(m026Dispatcher)
+m026Monitor.onLockLost.append(lambda sample: print("Monitor: Sync lock lost:",sample))
+m026Monitor.onLockGained.append(lambda sample: print("Monitor: Sync lock gained:",sample))
+# Tkinter isn't thread-safe: the samples for the GUI are queued on the monitor thread and
+# taken by poll_monitor() on the Tk thread
+monitorSamples=queue.Queue()
+m026Monitor.onSample.append(monitorSamples.put)
+m026Monitor.start()
+
 #===============================================================================
 
 from m026Vlc import *
@@ -601,7 +652,6 @@ class TvM026ChannelScanner(ttk.Frame):
             self.gui_update_channel_list()
             self.gui_update_channel_name()
             self.set_tv_channel(tvChannel)
-            m026.video_decoder_get_vertical_line_count()
                     
     def channel_update(self,event):
         newTvChannels.channel=self.comboboxChannel.current() 
@@ -623,9 +673,19 @@ class TvM026ChannelScanner(ttk.Frame):
         if d.yesNo == 'Yes':
             newTvChannels.write()
 
-    def update_channel_infos(self,freqName,freqMHz):
+    def update_channel_infos(self,freqName,freqMHz,sample=None,tuned=False):
+        """Update the channel infos; sync lock and line count from sample, by default the last
+        sample of the status monitor. If tuned, from the sync lock set_tv_tuner read and the line
+        count read after it.
+        """
         self.labelChannelName['text']=freqName
         self.labelChannelFrequency['text']="{f:6.2f} MHz".format(f=freqMHz)
+        if sample is None and not tuned :
+            sample=m026Monitor.latest()
+        if sample is not None :
+            self.update_sync_infos(sample)
+            self.update()
+            return
         if m026.vdHorizontalSyncLocked == 1 :
             self.labelHSync['text']="Yes"
         else :
@@ -637,6 +697,27 @@ class TvM026ChannelScanner(ttk.Frame):
         self.labelLineCount['text']=m026.vdVerticalLineCount
         self.update()
 
+    def poll_monitor(self):
+        """Update the sync infos from the last sample queued by the status monitor, every 100 ms."""
+        sample=None
+        while not monitorSamples.empty() :
+            sample=monitorSamples.get()
+        if sample is not None :
+            self.update_sync_infos(sample)
+        self.after(100,self.poll_monitor)
+
+    def update_sync_infos(self,sample):
+        """Update sync lock and line count from a sample of the status monitor."""
+        if sample.hSyncLocked :
+            self.labelHSync['text']="Yes"
+        else :
+            self.labelHSync['text']="No"
+        if sample.vSyncLocked :
+            self.labelVSync['text']="Yes"
+        else :
+            self.labelVSync['text']="No"
+        self.labelLineCount['text']=sample.lineCount
+
     def gui_update_channel_list(self):
         self.valuesChannellist = ["" for i in range(len(newTvChannels.channels))] 
         for i in range(len(newTvChannels.channels)):
@@ -690,7 +771,6 @@ class TvM026ChannelScanner(ttk.Frame):
             self.channel_next(event=None)
             
         if k in ('r', 'R') : 
-            m026.video_decoder_get_vertical_line_count()
             tvChannel=newTvChannels.channels[newTvChannels.channel]
             self.update_channel_infos(tvChannel.frequencyName,tvChannel.frequencyMHz)
         
@@ -719,7 +799,8 @@ class TvM026ChannelScanner(ttk.Frame):
         
         m026.vdVideoStandard=videoStandard
         m026.video_decoder_set_video_standard(m026.vdVideoStandard)
-        time.sleep(1)
+        # Status #5 is read as soon as the decoder locked to the new standard
+        m026.tv_tuner_wait_lock()
         m026.video_decoder_status_video_standard()
         m026.get_video_capture()
         print("Size",m026.videoCaptureSize)
@@ -741,19 +822,17 @@ class TvM026ChannelScanner(ttk.Frame):
             self.canvasVideo['height']=480+8       
             self.canvasVideo['width']=(480+8)*16/9-4
     
-        streamer.terminate()
-        time.sleep(1)
         vlcApp.videoPlayer.stop()
         if self.videoSizeClass=="576" :
             print("576 Size")
             m026.set_video_capture(0,0,720,576)
-            streamer.start(720,576) 
         else :
             print("480 Size")
             m026.set_video_capture(0,0,720,480)
-            streamer.start(720,480)
-        time.sleep(1)
         m026.get_video_capture()
+        # The running streamer reads the new capture frame (SIGUSR1); the frame set on the device
+        # is clamped to the field, e.g. 720x574 for 720x576
+        streamer.update(m026.videoCaptureSize.width,m026.videoCaptureSize.height)
         vlcApp.videoPlayer.play()
 
         self.dummyEntry.focus_set()
@@ -771,57 +850,63 @@ class TvM026ChannelScanner(ttk.Frame):
     
     def scan(self,first):
         global tvChannel
-        m026.video_decoder_get_vertical_line_count()
-        frequencyNames=list(frequencyDict)
+        # The scan reads the status after each tuning itself
+        m026Monitor.pause()
+        try:
+            frequencyNames=list(frequencyDict)
         
-        freqName=frequencyNames[first]
-        frequencyMHz=frequencyDict[freqName]
-        self.update_channel_infos(freqName,frequencyMHz)
-        
-        i=first
-        for i  in range (first, len(frequencyNames)) :
-            freqName=frequencyNames[i]
+            freqName=frequencyNames[first]
             frequencyMHz=frequencyDict[freqName]
-            m026.set_tv_tuner(frequencyMHz)
-            m026.video_decoder_get_vertical_line_count()
-            print("Vertical line count:",m026.vdVerticalLineCount)
-            
             self.update_channel_infos(freqName,frequencyMHz)
+        
+            i=first
+            for i  in range (first, len(frequencyNames)) :
+                freqName=frequencyNames[i]
+                frequencyMHz=frequencyDict[freqName]
+                m026.set_tv_tuner(frequencyMHz)
+                # set_tv_tuner read the sync lock, only the line count registers are read after it
+                m026.video_decoder_get_vertical_line_count()
+                print("Vertical line count:",m026.vdVerticalLineCount)
+            
+                self.update_channel_infos(freqName,frequencyMHz,tuned=True)
             
-            if m026.vdVideoDetected :
-                print("Video detected: {c} | {f}".format(c=freqName,f=frequencyMHz))
-                tvChannel=TvChannel()
-                tvChannel.frequencyName=freqName
-                tvChannel.frequencyMHz=frequencyMHz
+                if m026.vdVideoDetected :
+                    print("Video detected: {c} | {f}".format(c=freqName,f=frequencyMHz))
+                    tvChannel=TvChannel()
+                    tvChannel.frequencyName=freqName
+                    tvChannel.frequencyMHz=frequencyMHz
                                 
-                tvChannel.name="?"
-
-                if self.merge.get() :
-                    inList=False
-                    for ch in range(newTvChannels.nChannel) :
-                        if newTvChannels.channels[ch].frequencyName == freqName :
-                            inList=True
-                            break
-                    if not inList :
-                        newTvChannels.add_channel(tvChannel)
+                    tvChannel.name="?"
+
+                    if self.merge.get() :
+                        inList=False
+                        for ch in range(newTvChannels.nChannel) :
+                            if newTvChannels.channels[ch].frequencyName == freqName :
+                                inList=True
+                                break
+                        if not inList :
+                            newTvChannels.add_channel(tvChannel)
                 
-                else :
-                    newTvChannels.add_channel(tvChannel)
+                    else :
+                        newTvChannels.add_channel(tvChannel)
                     
-                self.gui_update_channel_list()
-                self.channel_changed(event=None)
+                    self.gui_update_channel_list()
+                    self.channel_changed(event=None)
                 
-            i=i+1
+                i=i+1
          
-        newTvChannels.print()
+            newTvChannels.print()
+            m026.print_tuner_stats()
         
-        newTvChannels.channel=0
-        tvChannel=newTvChannels.channels[newTvChannels.channel] 
-        tvChannel.print()
-        self.set_tv_channel(tvChannel)
-        self.update_channel_infos(tvChannel.frequencyName,tvChannel.frequencyMHz)
-        self.gui_update_channel_list()
-        self.enable_channel_actions()
+            newTvChannels.channel=0
+            tvChannel=newTvChannels.channels[newTvChannels.channel] 
+            tvChannel.print()
+            self.set_tv_channel(tvChannel)
+            self.update_channel_infos(tvChannel.frequencyName,tvChannel.frequencyMHz)
+            self.gui_update_channel_list()
+            self.enable_channel_actions()
+        finally:
+            m026Monitor.resume()
         
     def set_tv_channel(self,tvChannel):
         vlcApp.videoPlayer.pause()
@@ -849,7 +934,6 @@ class TvM026ChannelScanner(ttk.Frame):
         print(self.frequencyName, self.frequencyMHz)
         
         m026.set_tv_tuner(self.frequencyMHz)
-        m026.video_decoder_get_vertical_line_count()
         
         self.gui_update_channel_list()
         self.update_channel_infos(newTvChannel.frequencyName,newTvChannel.frequencyMHz)        
@@ -863,7 +947,6 @@ class TvM026ChannelScanner(ttk.Frame):
             tvChannel=newTvChannels.channels[newTvChannels.channel] 
             tvChannel.print()
             self.set_tv_channel(tvChannel)
-            m026.video_decoder_get_vertical_line_count()
             self.update_channel_infos(tvChannel.frequencyName,tvChannel.frequencyMHz)
             self.gui_update_channel_list()
             self.gui_update_channel_name()
@@ -876,7 +959,6 @@ class TvM026ChannelScanner(ttk.Frame):
             tvChannel=newTvChannels.channels[newTvChannels.channel]
             tvChannel.print()
             self.set_tv_channel(tvChannel)
-            m026.video_decoder_get_vertical_line_count()
             self.update_channel_infos(tvChannel.frequencyName,tvChannel.frequencyMHz)
             self.gui_update_channel_list()
             self.gui_update_channel_name()
@@ -901,15 +983,23 @@ class TvM026ChannelScanner(ttk.Frame):
         self.quit(self)
             
     def quit(self,event):
-        m026.set_audio_source(AUDIO_SOURCE_NONE)
-        streamer.terminate()  
-        m026.gpio_led(False)
+        m026Monitor.stop()
+        m026Hotplug.stop()
+        if args.capture :
+            streamer.close()
+        else :
+            streamer.terminate()
+        if m026.usbDevh :
+            m026.set_audio_source(AUDIO_SOURCE_NONE)
+            m026.gpio_led(False)
         m026.close()
+        m026Dispatcher.stop()
         quit() 
 
 #===============================================================================
 
 channelScaner = TvM026ChannelScanner()
+channelScaner.poll_monitor()
 channelScaner.master.wait_visibility()
 channelScaner.master.resizable(False,False)
 channelScaner.mainloop()
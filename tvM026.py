@@ -10,25 +10,47 @@ License:    GPL v2
 """
 
 import sys
+import queue
 import usb1 as usb
 
 #===============================================================================
 from m026Device import *
-m026 = M026Device()
-m026.find()
+from m026Dispatcher import *
+# The device is used by the GUI callbacks through a dispatcher thread which owns it
+m026Dispatcher = M026Dispatcher(M026Device())
+m026Dispatcher.start()
+m026 = M026DeviceProxy(m026Dispatcher)
+
+import argparse
+parser=argparse.ArgumentParser(description="A TV app for the AVerMedia AVerTV USB2.0")
+parser.add_argument("--device",help="device id, bus-port path as in sysfs (e.g. 3-1.4) or serial number; selects the device and its settings section")
+parser.add_argument("--list",action="store_true",help="list the attached devices")
+parser.add_argument("--capture",action="store_true",help="capture in-process with the Python capture engine instead of m026-streamer")
+parser.add_argument("--bus",help="with --capture, publish the frames to other processes on the shared memory frame bus BUS")
+args=parser.parse_args()
+if args.list :
+    for bus,port,serial,dev in m026.list_devices() :
+        print("{b}-{p}  serial: {s}".format(b=bus,p=port,s=serial))
+    m026Dispatcher.stop()
+    exit()
+deviceSelection=parse_device_id(args.device) if args.device else (None,None,None)
+
+m026.find(*deviceSelection)
 if m026.usbDev == None :
     print ("AVerTV USB2.0 not found!") 
     exit()
 print ("AVerTV USB2.0 found!") 
 
 m026.open() 
+m026.shadow_enable(True)
+m026.differentialSwitching=True
 m026.gpio_led(True)
 print("----------------------------------------------------------------")
 
 #===============================================================================
 from m026Settings import *
 
-tvM026Settings=Settings()
+tvM026Settings=Settings(args.device)
 fileSettings=tvM026Settings.fileSettings
 
 isFile = os.path.isfile(fileSettings)
@@ -40,6 +62,10 @@ else:
 tvM026Settings.print()
 print("----------------------------------------------------------------")
 
+# Register programs of a board variant replace the default ones
+if os.path.isfile(tvM026Settings.filePrograms):
+    m026.programs.read(tvM026Settings.filePrograms)
+
 m026.audioSource=tvM026Settings.m026AudioSource
 m026.videoSource=tvM026Settings.m026VideoSource
 
@@ -98,7 +124,10 @@ print("----------------------------------------------------------------")
 from m026Stream import *
 
 streamDevice=StreamDevice(tvM026Settings.v4l2Device)
-streamer=Streamer(tvM026Settings.streamer,streamDevice.v4l2Device)
+if args.capture :
+    streamer=CaptureEngine(m026,streamDevice,busName=args.bus)
+else :
+    streamer=Streamer(tvM026Settings.streamer,streamDevice.v4l2Device,*deviceSelection)
 
 tv = False
 composite = False
@@ -113,26 +142,59 @@ if tvM026Settings.m026VideoSource == VIDEO_SOURCE_COMPOSITE :
 if tvM026Settings.m026VideoSource == VIDEO_SOURCE_S_VIDEO :
     svideo = True
     
-if composite == True or svideo == True:
-    m026.set_audio_source(AUDIO_SOURCE_AUX)
 if tv == True:
-    m026.set_audio_source(AUDIO_SOURCE_TV_TUNER)
+    tvChannel=tvChannels.channels[tvChannels.channel]
+    m026.tvTunerFrequency=tvChannel.frequencyMHz
 
-if composite == True:    
-    m026.set_video_source(VIDEO_SOURCE_COMPOSITE)
+# Skip the initialization if the device kept the configuration of the previous session
+warmStart=m026.warm_start(tvM026Settings.m026VideoSource)
 
-if svideo == True:    
-    m026.set_video_source(VIDEO_SOURCE_S_VIDEO)
+if not warmStart :
+    if composite == True or svideo == True:
+        m026.set_audio_source(AUDIO_SOURCE_AUX)
+    if tv == True:
+        m026.set_audio_source(AUDIO_SOURCE_TV_TUNER)
 
-if tv == True:
-    tvChannel=tvChannels.channels[tvChannels.channel]
-    m026.set_tv_tuner(tvChannel.frequencyMHz)
-    m026.set_video_source(VIDEO_SOURCE_TV)
+    if composite == True:    
+        m026.set_video_source(VIDEO_SOURCE_COMPOSITE)
+
+    if svideo == True:    
+        m026.set_video_source(VIDEO_SOURCE_S_VIDEO)
+
+    # set_video_source tunes to m026.tvTunerFrequency
+    if tv == True:
+        m026.set_video_source(VIDEO_SOURCE_TV)
 
 m026.video_decoder_status_video_standard()
 
-streamer.terminate()
-streamer.start(m026.videoCaptureSize.width,m026.videoCaptureSize.height)
+# A streamer still running on a warm started device is adopted and keeps streaming
+if not (warmStart and streamer.adopt()) :
+    streamer.terminate()
+    streamer.start(m026.videoCaptureSize.width,m026.videoCaptureSize.height)
+
+#===============================================================================
+from m026Hotplug import *
+
+# Reattach the device and relaunch the streamer if the device drops off the bus
+m026Hotplug=M026Hotplug(m026Dispatcher)
+m026Hotplug.onLeft.append(streamer.terminate)
+m026Hotplug.onArrived.append(lambda: streamer.start(m026.videoCaptureSize.width,m026.videoCaptureSize.height))
+m026Hotplug.start()
+
+#===============================================================================
+from m026Monitor import *
+
+# Video decoder status monitor, the GUI reacts to its events instead of reading the status
+m026Monitor=M026Monitor(m026Dispatcher)
+m026Monitor.onLockLost.append(lambda sample: print("Monitor: Sync lock lost:",sample))
+m026Monitor.onLockGained.append(lambda sample: print("Monitor: Sync lock gained:",sample))
+# Tkinter isn't thread-safe: the samples for the GUI are queued on the monitor thread and
+# taken by poll_monitor() on the Tk thread
+monitorSamples=queue.Queue()
+m026Monitor.onStandardChanged.append(lambda previous,sample: monitorSamples.put(sample))
+m026Monitor.onLockLost.append(monitorSamples.put)
+m026Monitor.onLockGained.append(monitorSamples.put)
+m026Monitor.start()
 
 #===============================================================================
 from m026Vlc import *
@@ -374,8 +436,8 @@ class TvM026(ttk.Frame):
         
     def source_changed(self, event):
         vlcApp.videoPlayer.stop()
+        # terminate() returns when the streamer released the device
         streamer.terminate()
-        time.sleep(1)
 
         if m026.videoSource == VIDEO_SOURCE_TV:
             # Composite
@@ -394,7 +456,7 @@ class TvM026(ttk.Frame):
             m026.set_video_source(VIDEO_SOURCE_TV)
             self.display_frameTVchannel()
    
-        m026.vdi_get_capture_frame()
+        m026.get_video_capture()
     
         streamDevice.frame_width=m026.videoCaptureSize.width
         streamDevice.frame_height=m026.videoCaptureSize.height
@@ -418,7 +480,7 @@ class TvM026(ttk.Frame):
         videoMedia='v4l2://'+tvM026Settings.v4l2Device
         vlcApp.set_video_media(videoMedia)
         vlcApp.videoPlayer.set_xwindow(self.videoCanvasWindowID)
-        time.sleep(1)
+        streamer.wait_ready()
         
         # player scale and crop
         widthCropped=m026.videoCaptureSize.width-tvM026Settings.vlcCropLeft-tvM026Settings.vlcCropRight
@@ -484,18 +546,35 @@ class TvM026(ttk.Frame):
         self.update_display()
         tvM026Settings.write(fileSettings)
         
-    def update_display(self):
+    def poll_monitor(self):
+        """Update the display from the last sample queued by the status monitor, every 100 ms."""
+        sample=None
+        while not monitorSamples.empty() :
+            sample=monitorSamples.get()
+        if sample is not None :
+            self.update_display(sample)
+        self.after(100,self.poll_monitor)
+
+    def update_display(self,sample=None):
+        """Update the display from a video decoder status sample, by default the last sample of
+        the status monitor. The decoder isn't read here.
+        """
+        if sample is None :
+            sample=m026Monitor.latest()
+        videoStandard=m026.vdVideoStandard
+        if sample is not None and sample.standard is not None :
+            videoStandard=sample.standard
         print("Updating display:")
         print("  Video source:",list_video_sources[m026.videoSource])
-        m026.video_decoder_get_video_standard()
-        m026.video_decoder_status_video_standard()
-        print("  Video standard",list_video_standards[m026.vdVideoStandard])
+        print("  Video standard",list_video_standards[videoStandard])
         
         txtVideoStandard="PAL"
-        if m026.vdVideoStandard == VIDEO_STANDARD_NTSC_M_J or m026.vdVideoStandard ==  VIDEO_STANDARD_NTSC :
+        if videoStandard == VIDEO_STANDARD_NTSC_M_J or videoStandard ==  VIDEO_STANDARD_NTSC :
             txtVideoStandard="NTSC"
-        if m026.vdVideoStandard == VIDEO_STANDARD_SECAM :
+        if videoStandard == VIDEO_STANDARD_SECAM :
             txtVideoStandard="SECAM"
+        if sample is not None and not sample.locked :
+            txtVideoStandard+=" (no signal)"
         
         if m026.videoSource == VIDEO_SOURCE_COMPOSITE :
             displayText="CVBS:"
@@ -509,6 +588,8 @@ class TvM026(ttk.Frame):
             
         if m026.videoSource == VIDEO_SOURCE_TV :    
             self.frameDisplay.labelChannel['text']="{fName} : {freq:.2f} MHz : {name}".format(fName=tvChannels.channels[tvChannels.channel].frequencyName,freq=tvChannels.channels[tvChannels.channel].frequencyMHz,name=tvChannels.channels[tvChannels.channel].name)
+            if sample is not None and not sample.locked :
+                self.frameDisplay.labelChannel['text']+=" (no signal)"
         
         print("Display updated:", self.frameDisplay.labelChannel['text'])
        
@@ -560,15 +641,23 @@ class TvM026(ttk.Frame):
         tvM026Settings.print()                  
         
         tvM026Settings.write(fileSettings)
-        m026.set_audio_source(AUDIO_SOURCE_NONE)
-        streamer.terminate()  
-        m026.gpio_led(False)
+        m026Monitor.stop()
+        m026Hotplug.stop()
+        if args.capture :
+            streamer.close()
+        else :
+            streamer.terminate()
+        if m026.usbDevh :
+            m026.set_audio_source(AUDIO_SOURCE_NONE)
+            m026.gpio_led(False)
         m026.close()
+        m026Dispatcher.stop()
         quit()   
         
 #===============================================================================
 
 tvM026 = TvM026()
+tvM026.poll_monitor()
 if m026.videoSource != VIDEO_SOURCE_TV :
     tvM026.frameTVchannel.grid_remove()
 tvM026.update_display()